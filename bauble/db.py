@@ -103,6 +103,135 @@ def natsort(attr, obj):
     return sorted(obj, key=utils.natsort_key)
 
 
+def _forget_updated_natsort_key(mapper, connection, instance):
+    utils.forget_natsort_key(instance)
+
+sa.event.listen(orm.Mapper, 'after_update', _forget_updated_natsort_key)
+
+
+def _forget_edited_natsort_key(target, value, oldvalue, initiator):
+    utils.forget_natsort_key(target)
+
+
+def _watch_natsort_keys(mapper, cls):
+    # objects edited and not flushed yet have another string already
+    for prop in mapper.iterate_properties:
+        if isinstance(prop, (orm.ColumnProperty, orm.RelationshipProperty)):
+            sa.event.listen(getattr(cls, prop.key), 'set',
+                            _forget_edited_natsort_key)
+
+sa.event.listen(orm.Mapper, 'mapper_configured', _watch_natsort_keys)
+
+
+def fill_sort_keys(table, bind=None):
+    """compute the sort_key of all rows of table from their code
+
+    or from the text returned by the `sort_text` function in the info
+    of table, given the row, for tables not sorted by code alone.
+    used when the keys can't be maintained by the mapper: rows imported
+    from csv, the column just added.
+    """
+    if bind is None:
+        bind = engine
+    sort_text = table.info.get('sort_text', lambda row: row['code'])
+    values = [{'_id': row['id'], '_key': utils.natsort_sql_key(sort_text(row))}
+              for row in bind.execute(sa.select([table]))]
+    if values:
+        bind.execute(table.update().where(
+            table.c.id == sa.bindparam('_id')).values(
+            sort_key=sa.bindparam('_key')), values)
+
+
+def ensure_sort_key(table, bind=None):
+    """add the sort_key column of table to databases created without it
+
+    return True if the column had to be added.
+    """
+    if bind is None:
+        bind = engine
+    columns = [c['name'] for c in sa.inspect(bind).get_columns(table.name)]
+    if 'sort_key' in columns:
+        return False
+    logger.info('adding %s.sort_key' % table.name)
+    bind.execute('ALTER TABLE %s ADD COLUMN sort_key VARCHAR(64)'
+                 % table.name)
+    bind.execute('CREATE INDEX ix_%s_sort_key ON %s (sort_key)'
+                 % (table.name, table.name))
+    fill_sort_keys(table, bind)
+    return True
+
+
+def aggregate_counts(session, cls, ids, counters, chunk_size=500):
+    """compute counters over the objects of cls having ids
+
+    counters is a list of (key, aggregate, path) triples.  path leads
+    from cls to a column, through relations, like `accession.species_id`.
+    aggregate is 'count' for the number of distinct values of the
+    column, 'sum' for their sum.  the relations are outer joined, each
+    only once, so paths can only sum the columns of the deepest
+    collection without counting rows more than once.
+
+    the ids are bound `chunk_size` at a time, to stay within the bind
+    parameters limit of SQLite.  one chunk computes all counters in one
+    statement; with more chunks the sums are added up, and the distinct
+    values of the counted columns are collected, one statement per
+    chunk and counter.
+
+    return a dict with the value of each counter, by key.
+    """
+    if not ids:
+        return dict((key, 0) for key, aggregate, path in counters)
+    entities = {'': cls}
+    joins = []
+
+    def entity(prefix):
+        # the aliased class reached from cls through the relations in prefix
+        if prefix not in entities:
+            parent, _, name = prefix.rpartition('.')
+            parent = entity(parent)
+            prop = sa.inspect(parent).mapper.get_property(name)
+            alias = orm.aliased(prop.mapper.class_)
+            joins.append((alias, getattr(parent, name)))
+            entities[prefix] = alias
+        return entities[prefix]
+
+    def query(chunk, *columns):
+        result = session.query(*columns).select_from(cls)
+        for alias, relation in joins:
+            result = result.outerjoin(alias, relation)
+        return result.filter(cls.id.in_(chunk))
+
+    def aggregated(aggregate, column):
+        if aggregate == 'sum':
+            return sa.func.coalesce(sa.func.sum(column), 0)
+        return sa.func.count(sa.distinct(column))
+
+    targets = []
+    for key, aggregate, path in counters:
+        prefix, _, name = path.rpartition('.')
+        targets.append((aggregate, getattr(entity(prefix), name)))
+    ids = sorted(set(ids))
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    if len(chunks) == 1:
+        values = query(chunks[0], *[aggregated(aggregate, column)
+                                    for aggregate, column in targets]).one()
+    else:
+        values = []
+        for aggregate, column in targets:
+            if aggregate == 'sum':
+                values.append(sum(
+                    query(chunk, aggregated(aggregate, column)).scalar()
+                    for chunk in chunks))
+                continue
+            distinct = set()
+            for chunk in chunks:
+                distinct.update(value for (value, ) in query(
+                    chunk, column).filter(column.isnot(None)).distinct())
+            values.append(len(distinct))
+    return dict((key, int(value))
+                for (key, aggregate, path), value in zip(counters, values))
+
+
 class HistoryExtension(orm.MapperExtension):
     """
     HistoryExtension is a
@@ -169,6 +298,11 @@ class MapperBase(DeclarativeMeta):
             cls.__mapper_args__ = {'extension': HistoryExtension()}
         if 'top_level_count' not in dict_:
             cls.top_level_count = lambda x: {classname: 1}
+            if 'top_level_counters' not in dict_:
+                cls.top_level_counters = [(classname, 'count', 'id')]
+        elif 'top_level_counters' not in dict_:
+            # only top_level_count() knows how to count these objects
+            cls.top_level_counters = None
         if 'search_view_markup_pair' not in dict_:
             cls.search_view_markup_pair = lambda x: (
                 utils.xml_safe(str(x)),
@@ -248,6 +382,35 @@ class History(history_base):
     user = sa.Column(sa.Text)
     timestamp = sa.Column(types.DateTime, nullable=False)
 
+    # the HistoryView pages through the most recent changes first, for
+    # all tables or for one table or user.
+    __table_args__ = (
+        sa.Index('ix_history_timestamp_id', 'timestamp', 'id'),
+        sa.Index('ix_history_table_timestamp',
+                 'table_name', 'timestamp', 'id'),
+        sa.Index('ix_history_user_timestamp', 'user', 'timestamp', 'id'))
+
+
+def ensure_history_indexes(bind=None):
+    """add the indexes of the history table to databases created without
+
+    create() makes them with the table, older databases get them from
+    the `:history index` command, as building them on a long history
+    takes a while.  return the names of the indexes added.
+    """
+    if bind is None:
+        bind = engine
+    table = History.__table__
+    existing = set(i['name'] for i in sa.inspect(bind).get_indexes(
+        table.name))
+    added = []
+    for index in table.indexes:
+        if index.name not in existing:
+            logger.info('adding index %s' % index.name)
+            index.create(bind)
+            added.append(index.name)
+    return added
+
 
 def open(uri, verify=True, show_error_dialogs=False):
     """
@@ -342,6 +505,11 @@ def create(import_defaults=True):
         # metadata whether they are in the registry or not, we should
         # really only be creating those tables from registered
         # plugins, maybe with an uninstall() method on Plugin
+        # the full-text and fuzzy indexes live outside of the metadata
+        import bauble.fulltext as fulltext
+        fulltext.drop_index(connection)
+        import bauble.fuzzy as fuzzy
+        fuzzy.drop_index(connection)
         metadata.drop_all(bind=connection, checkfirst=True)
         metadata.create_all(bind=connection)
 
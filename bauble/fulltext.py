@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Optional full-text index backing the MapperSearch value searches.
+
+For every class registered with MapperSearch.add_meta, the index is a
+side table named `fts_<table>`, holding the registered columns of each
+row, keyed on the row id:
+
+- on SQLite it is an FTS5 virtual table, the row id being its rowid;
+- on PostgreSQL it is a plain table holding a `tsvector`, with a GIN
+  index on it.
+
+The side tables are kept in sync by database triggers, so they also
+follow changes not made through the ORM.  The index is created and
+dropped by the user, with the `:fulltext=create` and `:fulltext=drop`
+commands.  While it exists, value searches and the `contains` family of
+domain operators use it instead of `LIKE '%value%'`.
+
+Note that a full-text index matches the beginning of words, not any
+substring: with the index in place, `Ixo` finds `Ixora`, but `xora`
+does not.
+"""
+
+import re
+import weakref
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import gtk
+
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+from bauble.error import BaubleError
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+INDEX_PREFIX = 'fts_'
+
+# values we are willing to translate into a full-text query, anything
+# else (wildcards, quotes, numbers) falls back to LIKE.
+_plain_value_rx = re.compile(r'^\w[\w .-]*$', re.UNICODE)
+
+# the names of the existing index tables, per engine
+_existing = weakref.WeakKeyDictionary()
+
+
+def index_name(cls):
+    """the name of the index table for the mapped class cls"""
+    return INDEX_PREFIX + class_mapper(cls).local_table.name
+
+
+def _indexed_classes():
+    from bauble.search import MapperSearch
+    return MapperSearch._properties.items()
+
+
+def _column_names(cls, properties):
+    mapper = class_mapper(cls)
+    return [mapper.c[p].name for p in properties]
+
+
+def _bind(bind):
+    if bind is None:
+        bind = db.engine
+    return bind
+
+
+def is_supported(bind=None):
+    """can a full-text index be created on this database?"""
+    bind = _bind(bind)
+    if bind.dialect.name == 'postgresql':
+        return True
+    if bind.dialect.name != 'sqlite':
+        return False
+    try:
+        bind.execute('CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x)')
+        bind.execute('DROP TABLE temp.fts_probe')
+        return True
+    except Exception, e:
+        logger.debug('fts5 not available: %s(%s)' % (type(e), e))
+        return False
+
+
+def existing_indexes(bind=None):
+    """the set of full-text index tables present in the database"""
+    bind = _bind(bind)
+    engine = bind.engine
+    if engine not in _existing:
+        names = set(sa.inspect(bind).get_table_names())
+        _existing[engine] = set(
+            n for n in names
+            if n.startswith(INDEX_PREFIX) and n[len(INDEX_PREFIX):] in names)
+    return _existing[engine]
+
+
+def has_index(cls, bind=None):
+    return index_name(cls) in existing_indexes(bind)
+
+
+def _sqlite_statements(table, index, columns):
+    values = ', '.join('new.%s' % c for c in columns)
+    insert = ('INSERT INTO %s(rowid, %s) VALUES (new.id, %s);'
+              % (index, ', '.join(columns), values))
+    delete = 'DELETE FROM %s WHERE rowid = old.id;' % index
+    return [
+        'CREATE VIRTUAL TABLE %s USING fts5(%s)' % (index, ', '.join(columns)),
+        'INSERT INTO %s(rowid, %s) SELECT id, %s FROM %s'
+        % (index, ', '.join(columns), ', '.join(columns), table),
+        'CREATE TRIGGER %s_ai AFTER INSERT ON %s BEGIN %s END'
+        % (index, table, insert),
+        'CREATE TRIGGER %s_ad AFTER DELETE ON %s BEGIN %s END'
+        % (index, table, delete),
+        'CREATE TRIGGER %s_au AFTER UPDATE ON %s BEGIN %s %s END'
+        % (index, table, delete, insert),
+        ]
+
+
+def _postgresql_statements(table, index, columns):
+    document = ("to_tsvector('simple', concat_ws(' ', %s))"
+                % ', '.join('%%(row)s.%s' % c for c in columns))
+    return [
+        'CREATE TABLE %s (id integer PRIMARY KEY, tsv tsvector NOT NULL)'
+        % index,
+        'CREATE INDEX %s_tsv ON %s USING gin(tsv)' % (index, index),
+        'INSERT INTO %s (id, tsv) SELECT id, %s FROM %s'
+        % (index, document % {'row': table}, table),
+        "CREATE OR REPLACE FUNCTION %(index)s_sync() RETURNS trigger AS $$ "
+        "BEGIN "
+        "  IF TG_OP <> 'INSERT' THEN "
+        "    DELETE FROM %(index)s WHERE id = OLD.id; "
+        "  END IF; "
+        "  IF TG_OP = 'DELETE' THEN RETURN OLD; END IF; "
+        "  INSERT INTO %(index)s (id, tsv) VALUES (NEW.id, %(document)s); "
+        "  RETURN NEW; "
+        "END; $$ LANGUAGE plpgsql"
+        % {'index': index, 'document': document % {'row': 'NEW'}},
+        'CREATE TRIGGER %s_sync AFTER INSERT OR UPDATE OR DELETE ON %s '
+        'FOR EACH ROW EXECUTE PROCEDURE %s_sync()' % (index, table, index),
+        ]
+
+
+def create_index(bind=None):
+    """create (or recreate) the full-text index
+
+    one index table per class registered with MapperSearch.add_meta,
+    populated from the current content of the database.  returns the
+    list of the created index tables.  raise BaubleError if the
+    database can't hold a full-text index.
+    """
+    bind = _bind(bind)
+    if not is_supported(bind):
+        raise BaubleError(
+            _('a full-text index needs PostgreSQL, or SQLite with FTS5, '
+              'and this database is %s') % bind.dialect.name)
+    drop_index(bind)
+    if bind.dialect.name == 'sqlite':
+        statements = _sqlite_statements
+    else:
+        statements = _postgresql_statements
+    created = []
+    for cls, properties in _indexed_classes():
+        table = class_mapper(cls).local_table.name
+        index = index_name(cls)
+        logger.debug('creating full-text index %s' % index)
+        for stmt in statements(table, index, _column_names(cls, properties)):
+            bind.execute(stmt)
+        created.append(index)
+    _existing.pop(bind.engine, None)
+    return created
+
+
+def drop_index(bind=None):
+    """drop all full-text index tables, and their triggers"""
+    bind = _bind(bind)
+    for index in existing_indexes(bind):
+        table = index[len(INDEX_PREFIX):]
+        logger.debug('dropping full-text index %s' % index)
+        if bind.dialect.name == 'postgresql':
+            bind.execute('DROP TRIGGER IF EXISTS %s_sync ON %s'
+                         % (index, table))
+            bind.execute('DROP FUNCTION IF EXISTS %s_sync()' % index)
+        else:
+            for suffix in ('ai', 'ad', 'au'):
+                bind.execute('DROP TRIGGER IF EXISTS %s_%s' % (index, suffix))
+        bind.execute('DROP TABLE IF EXISTS %s' % index)
+    _existing.pop(bind.engine, None)
+
+
+def match_clause(cls, values, bind=None):
+    """a clause selecting the objects of cls matching any of values
+
+    the clause is a condition on the id of cls, it goes through the
+    full-text index.  a value of more words matches the objects having
+    words starting with each of them, in any order, on all databases.
+    return None if there is no index for cls, or if
+    the values can't be expressed as a full-text query, in which case
+    the caller should fall back to LIKE.
+    """
+    bind = _bind(bind)
+    if not values or not has_index(cls, bind):
+        return None
+    for v in values:
+        if not isinstance(v, basestring) or not _plain_value_rx.match(v):
+            return None
+    index = index_name(cls)
+    if bind.dialect.name == 'sqlite':
+        query = u' OR '.join(
+            u'(%s)' % u' AND '.join(u'"%s"*' % w for w in v.split())
+            for v in values)
+        matching = sa.select([sa.literal_column('rowid')]).select_from(
+            sa.table(index)).where(sa.literal_column(index).match(query))
+    else:
+        query = u' | '.join(
+            u'(%s)' % u' & '.join(u"'%s':*" % w for w in v.split())
+            for v in values)
+        table = sa.table(index, sa.column('id'), sa.column('tsv'))
+        matching = sa.select([table.c.id]).where(
+            table.c.tsv.op('@@')(sa.func.to_tsquery('simple', query)))
+    return class_mapper(cls).c['id'].in_(matching)
+
+
+class FullTextCommandHandler(pluginmgr.CommandHandler):
+    """manage the full-text index
+
+    `:fulltext=create` creates or rebuilds it, `:fulltext=drop` removes
+    it, `:fulltext` tells which tables are indexed.
+    """
+
+    command = 'fulltext'
+
+    def get_view(self):
+        return None
+
+    def __call__(self, cmd, arg):
+        arg = (arg or '').strip()
+        if arg == 'create':
+            try:
+                created = create_index()
+            except BaubleError, e:
+                utils.message_dialog(utils.xml_safe(e.msg), gtk.MESSAGE_ERROR)
+                return
+            msg = _('full-text index created for: %s') % ', '.join(created)
+        elif arg == 'drop':
+            drop_index()
+            msg = _('full-text index dropped')
+        else:
+            existing = sorted(existing_indexes())
+            if existing:
+                msg = _('full-text index exists for: %s') % ', '.join(existing)
+            else:
+                msg = _('there is no full-text index')
+        utils.message_dialog(msg)
+
+
+pluginmgr.register_command(FullTextCommandHandler)
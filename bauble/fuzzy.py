@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fuzzy name matching, for the searches finding nothing.
+
+Plugins register the name columns of their classes with `register()`.
+The index is made of two side tables, outside of the metadata:
+
+- `fuzzy_name` holds one row per registered column of each object,
+  with its phonetic key (see `phonetic_key()`) and the number of its
+  character trigrams;
+- `fuzzy_gram` holds one (gram, name_id) row per trigram of each name,
+  and is indexed on the gram.
+
+A searched name is matched by the trigrams it shares with the indexed
+names, scored with the Dice coefficient, and by its phonetic key:
+names sounding the same rank before all others.  "Anthurium andreanum"
+and "Anthurium andraeanum" share most trigrams, and the same key.
+
+The index is kept in sync by mapper events, it is created and dropped
+by the user with `:fuzzy=create` and `:fuzzy=drop`.  While it exists,
+MapperSearch falls back on FuzzySearch when a value or binomial search
+finds nothing.
+"""
+
+import re
+import unicodedata
+import weakref
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, Unicode, event
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.search as search
+import bauble.utils as utils
+
+_metadata = sa.MetaData()
+
+name_table = sa.Table(
+    'fuzzy_name', _metadata,
+    Column('id', Integer, primary_key=True),
+    Column('tag', Unicode(64), nullable=False),
+    Column('obj_id', Integer, nullable=False),
+    Column('field', Unicode(64), nullable=False),
+    Column('name', Unicode(256), nullable=False),
+    Column('phonetic', Unicode(256), nullable=False, index=True),
+    Column('size', Integer, nullable=False),
+    sa.Index('ix_fuzzy_name_obj', 'tag', 'obj_id'))
+
+gram_table = sa.Table(
+    'fuzzy_gram', _metadata,
+    Column('gram', Unicode(3), nullable=False),
+    Column('name_id', Integer, nullable=False),
+    sa.Index('ix_fuzzy_gram_gram', 'gram', 'name_id'),
+    sa.Index('ix_fuzzy_gram_name', 'name_id'))
+
+# the registered name columns, per table name
+_registered = {}
+
+# whether the index exists, per engine
+_existing = weakref.WeakKeyDictionary()
+
+
+def _bind(bind):
+    if bind is None:
+        bind = db.engine
+    return bind
+
+
+## phonetic keys and trigrams
+
+# digraphs sounding as a single letter at the start of a word, and
+# spelling variants inside it, as in the near_match rules of TAXAMATCH.
+_initial_rules = [
+    ('ae', 'e'), ('cn', 'n'), ('ct', 't'), ('cz', 'c'), ('dj', 'j'),
+    ('ea', 'e'), ('eu', 'u'), ('gn', 'n'), ('kn', 'n'), ('mc', 'mac'),
+    ('mn', 'n'), ('oe', 'e'), ('ph', 'f'), ('qu', 'q'), ('ps', 's'),
+    ('pt', 't'), ('ts', 's'), ('wr', 'r'), ('x', 'z')]
+_inner_rules = [
+    ('ae', 'i'), ('ia', 'a'), ('oe', 'i'), ('oi', 'a'), ('sc', 's'),
+    ('ph', 'f'), ('h', ''), ('k', 'c'), ('q', 'c'), ('z', 's'), ('y', 'i'),
+    ('e', 'a'), ('o', 'a'), ('u', 'a')]
+_repeated_rx = re.compile(r'(.)\1+')
+# latin endings varying with the gender of the genus
+_ending_rx = re.compile(r'[ai][sm]?$')
+
+
+def _ascii_words(text):
+    text = unicodedata.normalize('NFKD', utils.to_unicode(text))
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r'[a-z]+', text.lower())
+
+
+def _word_key(word):
+    for old, new in _initial_rules:
+        if word.startswith(old):
+            word = new + word[len(old):]
+            break
+    head, tail = word[:1], word[1:]
+    for old, new in _inner_rules:
+        tail = tail.replace(old, new)
+    word = _repeated_rx.sub(r'\1', head + tail)
+    if len(word) > 4:
+        word = _ending_rx.sub('', word)
+    return word
+
+
+def phonetic_key(text):
+    """a key shared by names sounding alike
+
+    every word of text is reduced after simplified TAXAMATCH rules:
+    accents and case dropped, spelling variants unified, vowels but the
+    first reduced to `a` and `i`, double letters collapsed, and the latin
+    gender ending removed.
+    """
+    return u' '.join(_word_key(w) for w in _ascii_words(text))
+
+
+def ngrams(text, n=3):
+    """the set of the character n-grams of the words in text
+
+    words are padded as in PostgreSQL pg_trgm, with two spaces before
+    and one after, so that the start of a word weighs more than its end.
+    """
+    result = set()
+    for word in _ascii_words(text):
+        word = u'  %s ' % word
+        result.update(word[i:i + n] for i in range(len(word) - n + 1))
+    return result
+
+
+## the index
+
+def register(cls, columns):
+    """add the columns of cls to the names in the fuzzy index"""
+    table = class_mapper(cls).local_table
+    if table.name not in _registered:
+        event.listen(cls, 'after_insert', _after_change)
+        event.listen(cls, 'after_update', _after_change)
+        event.listen(cls, 'after_delete', _after_delete)
+    _registered[table.name] = cls, list(columns)
+
+
+def has_index(bind=None):
+    """does the fuzzy index exist in the database?"""
+    bind = _bind(bind)
+    engine = bind.engine
+    if engine not in _existing:
+        _existing[engine] = \
+            name_table.name in sa.inspect(bind).get_table_names()
+    return _existing[engine]
+
+
+def create_index(bind=None):
+    """create (or recreate) the fuzzy index, return how many names it has"""
+    bind = _bind(bind)
+    drop_index(bind)
+    _metadata.create_all(bind)
+    _existing[bind.engine] = True
+    total = 0
+    for cls, columns in _registered.values():
+        total += update_index(bind, cls)
+    return total
+
+
+def drop_index(bind=None):
+    bind = _bind(bind)
+    _metadata.drop_all(bind, checkfirst=True)
+    _existing[bind.engine] = False
+
+
+def _indexed(table, where):
+    # the fuzzy_name rows of the table rows selected by where
+    clause = name_table.c.tag == table.name
+    if where is not None:
+        clause = sa.and_(clause, name_table.c.obj_id.in_(
+            sa.select([table.c.id]).where(where)))
+    return clause
+
+
+def _remove(bind, clause):
+    names = sa.select([name_table.c.id]).where(clause)
+    bind.execute(gram_table.delete().where(gram_table.c.name_id.in_(names)))
+    bind.execute(name_table.delete().where(clause))
+
+
+def update_index(bind, cls, where=None):
+    """index again the names of the objects of cls selected by where
+
+    where is a clause on the table of cls, None meaning all objects.
+    return how many names were indexed.
+    """
+    table = class_mapper(cls).local_table
+    columns = _registered[table.name][1]
+    clause = _indexed(table, where)
+    _remove(bind, clause)
+
+    query = sa.select([table.c.id] + [table.c[c] for c in columns])
+    if where is not None:
+        query = query.where(where)
+    names = []
+    for row in bind.execute(query):
+        for column in columns:
+            name = row[column]
+            grams = ngrams(name or u'')
+            if not grams:
+                continue
+            names.append({'tag': table.name, 'obj_id': row['id'],
+                          'field': column, 'name': name,
+                          'phonetic': phonetic_key(name),
+                          'size': len(grams)})
+    if not names:
+        return 0
+    bind.execute(name_table.insert(), names)
+
+    grams = []
+    for name_id, name in bind.execute(
+            sa.select([name_table.c.id, name_table.c.name]).where(clause)):
+        grams.extend({'gram': g, 'name_id': name_id} for g in ngrams(name))
+    bind.execute(gram_table.insert(), grams)
+    return len(names)
+
+
+def remove_from_index(bind, cls, ids):
+    """remove the names of the objects of cls having these ids"""
+    table = class_mapper(cls).local_table
+    _remove(bind, sa.and_(name_table.c.tag == table.name,
+                          name_table.c.obj_id.in_(ids)))
+
+
+def _after_change(mapper, connection, target):
+    if has_index(connection):
+        update_index(connection, mapper.class_,
+                     mapper.local_table.c.id == target.id)
+
+
+def _after_delete(mapper, connection, target):
+    if has_index(connection):
+        remove_from_index(connection, mapper.class_, [target.id])
+
+
+def matches(session, text, limit=20, min_score=0.4):
+    """the indexed objects having a name near to text
+
+    return a list of (class, id, score) triples, best matches first.
+    score is the Dice coefficient of the trigrams of text and of the
+    name, plus one if they have the same phonetic key.
+    """
+    grams = ngrams(text)
+    if not grams or not has_index(session.get_bind()):
+        return []
+    scores = {}
+
+    common = sa.func.count(gram_table.c.gram)
+    dice = (2.0 * common) / (len(grams) + name_table.c.size)
+    query = sa.select(
+        [name_table.c.tag, name_table.c.obj_id, dice.label('score')]).\
+        select_from(name_table.join(
+            gram_table, gram_table.c.name_id == name_table.c.id)).\
+        where(gram_table.c.gram.in_(list(grams))).\
+        group_by(name_table.c.id, name_table.c.tag, name_table.c.obj_id,
+                 name_table.c.size).\
+        having(dice >= min_score).\
+        order_by(sa.desc('score')).limit(limit)
+    for tag, obj_id, score in session.execute(query):
+        key = (tag, obj_id)
+        scores[key] = max(scores.get(key, 0), score)
+
+    query = sa.select([name_table.c.tag, name_table.c.obj_id]).where(
+        name_table.c.phonetic == phonetic_key(text)).limit(limit)
+    for tag, obj_id in session.execute(query):
+        key = (tag, obj_id)
+        scores[key] = scores.get(key, 0) + 1
+
+    ranked = sorted(scores.items(), key=lambda i: -i[1])[:limit]
+    return [(_registered[tag][0], obj_id, score)
+            for (tag, obj_id), score in ranked if tag in _registered]
+
+
+class FuzzySearch(search.SearchStrategy):
+    """the objects having a name near to the searched text, best first
+
+    MapperSearch falls back on this strategy when a value or binomial
+    search finds nothing.
+    """
+
+    limit_pref = 'bauble.search.fuzzy_limit'
+
+    def identities(self, text, session):
+        from bauble import prefs
+        limit = prefs.prefs.get(self.limit_pref, 20)
+        return [(cls, id) for cls, id, score in matches(session, text, limit)]
+
+    def search(self, text, session=None):
+        super(FuzzySearch, self).search(text, session)
+        return list(self.results(text, session))
+
+    def results(self, text, session=None):
+        return search.SearchResults([
+            search.IdentityList(session, self.identities(text, session),
+                                ranked=True)])
+
+
+search.result_cache.add_key_pref(FuzzySearch.limit_pref)
+
+
+class FuzzyCommandHandler(pluginmgr.CommandHandler):
+    """manage the fuzzy name index
+
+    `:fuzzy=create` creates or rebuilds it, `:fuzzy=drop` removes it,
+    `:fuzzy` tells whether it exists.
+    """
+
+    command = 'fuzzy'
+
+    def get_view(self):
+        return None
+
+    def __call__(self, cmd, arg):
+        arg = (arg or '').strip()
+        if arg == 'create':
+            count = create_index()
+            msg = _('fuzzy name index created, %s names') % count
+        elif arg == 'drop':
+            drop_index()
+            msg = _('fuzzy name index dropped')
+        elif has_index():
+            msg = _('the fuzzy name index exists')
+        else:
+            msg = _('there is no fuzzy name index')
+        utils.message_dialog(msg)
+
+
+pluginmgr.register_command(FuzzyCommandHandler)
@@ -70,10 +70,16 @@ class GardenPlugin(pluginmgr.Plugin):
     @classmethod
     def init(cls):
         from bauble.plugins.plants import Species
+
+        # databases created before the sort_key columns existed
+        for klass in Accession, Location, Plant:
+            db.ensure_sort_key(klass.__table__)
+
         mapper_search = search.get_strategy('MapperSearch')
 
         from functools import partial
-        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'])
+        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'],
+                               eager=['species.genus', 'plants.location'])
         SearchView.row_meta[Accession].set(
             children=partial(db.natsort, "plants"),
             infobox=AccessionInfoBox,
@@ -85,7 +91,8 @@ class GardenPlugin(pluginmgr.Plugin):
             infobox=LocationInfoBox,
             context_menu=loc_context_menu)
 
-        mapper_search.add_meta(('plant', 'planting'), Plant, ['code'])
+        mapper_search.add_meta(('plant', 'planting'), Plant, ['code'],
+                               eager=['accession.species.genus', 'location'])
         search.add_strategy(PlantSearch)  # special search value strategy
         #search.add_strategy(SpeciesSearch)  # special search value strategy
         SearchView.row_meta[Plant].set(
@@ -544,12 +544,26 @@ class Accession(db.Base, db.Serializable, db.WithNotes):
     #: the accession code
     code = Column(Unicode(20), nullable=False, unique=True)
     code_format = u'%Y%PD####'
+    # the code, for sorting naturally in SQL, see utils.natsort_sql_key
+    sort_key = Column(Unicode(64), index=True)
 
     @validates('code')
     def validate_stripping(self, key, value):
         if value is None:
             return None
-        return value.strip()
+        value = value.strip()
+        self.sort_key = utils.natsort_sql_key(value)
+        return value
+
+    @classmethod
+    def natsort_columns(cls):
+        """the columns ordering accessions like utils.natsort_key"""
+        return [cls.sort_key, cls.code]
+
+    @classmethod
+    def natsort_order(cls, query):
+        """order query the way utils.natsort_key sorts accessions"""
+        return query.order_by(*cls.natsort_columns())
 
     prov_type = Column(types.Enum(values=[i[0] for i in prov_type_values],
                                   translations=dict(prov_type_values)),
@@ -800,6 +814,17 @@ class Accession(db.Base, db.Serializable, db.WithNotes):
         except:
             return None
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Accessions'), 'count', 'id'),
+        ((2, 'Species'), 'count', 'species_id'),
+        ((3, 'Genera'), 'count', 'species.genus_id'),
+        ((4, 'Families'), 'count', 'species.genus.family_id'),
+        ((5, 'Plantings'), 'count', 'plants.id'),
+        ((6, 'Living plants'), 'sum', 'plants.quantity'),
+        ((7, 'Locations'), 'count', 'plants.location_id'),
+        ((8, 'Sources'), 'count', 'source.source_detail_id')]
+
     def top_level_count(self):
         sd = self.source and self.source.source_detail
         return {(1, 'Accessions'): 1,
@@ -92,6 +92,13 @@ remove_action = Action('loc_remove', _('_Delete'), callback=remove_callback,
 loc_context_menu = [edit_action, add_plant_action, remove_action]
 
 
+def _sort_text(code, name):
+    # the string of a location, as Location.__str__ makes it
+    if name:
+        return u'(%s) %s' % (code, name)
+    return code
+
+
 class Location(db.Base, db.Serializable):
     """
     :Table name: location
@@ -111,6 +118,8 @@ class Location(db.Base, db.Serializable):
     # columns
     # refers to beds by unique codes
     code = Column(Unicode(12), unique=True, nullable=False)
+    # the string, for sorting naturally in SQL, see utils.natsort_sql_key
+    sort_key = Column(Unicode(64), index=True)
     name = Column(Unicode(64))
     description = Column(UnicodeText)
 
@@ -128,9 +137,24 @@ class Location(db.Base, db.Serializable):
 
     @validates('code', 'name')
     def validate_stripping(self, key, value):
-        if value is None:
-            return None
-        return value.strip()
+        if value is not None:
+            value = value.strip()
+        if key == 'code':
+            text = _sort_text(value, self.name)
+        else:
+            text = _sort_text(self.code, value)
+        self.sort_key = utils.natsort_sql_key(text)
+        return value
+
+    @classmethod
+    def natsort_columns(cls):
+        """the columns ordering locations like utils.natsort_key"""
+        return [cls.sort_key, cls.code, cls.name]
+
+    @classmethod
+    def natsort_order(cls, query):
+        """order query the way utils.natsort_key sorts locations"""
+        return query.order_by(*cls.natsort_columns())
 
     def __str__(self):
         if self.name:
@@ -152,6 +176,19 @@ class Location(db.Base, db.Serializable):
         except:
             return None
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Locations'), 'count', 'id'),
+        ((2, 'Plantings'), 'count', 'plants.id'),
+        ((3, 'Living plants'), 'sum', 'plants.quantity'),
+        ((4, 'Accessions'), 'count', 'plants.accession_id'),
+        ((5, 'Species'), 'count', 'plants.accession.species_id'),
+        ((6, 'Genera'), 'count', 'plants.accession.species.genus_id'),
+        ((7, 'Families'), 'count',
+         'plants.accession.species.genus.family_id'),
+        ((8, 'Sources'), 'count',
+         'plants.accession.source.source_detail_id')]
+
     def top_level_count(self):
         accessions = set(p.accession for p in self.plants)
         species = set(a.species for a in accessions)
@@ -167,6 +204,10 @@ class Location(db.Base, db.Serializable):
                                      for a in accessions
                                      if a.source and a.source.source_detail])}
 
+# for db.fill_sort_keys
+Location.__table__.info['sort_text'] = (
+    lambda row: _sort_text(row['code'], row['name']))
+
 
 def mergevalues(value1, value2, formatter):
     """return the common value
@@ -434,12 +434,30 @@ class Plant(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
 
     # columns
     code = Column(Unicode(6), nullable=False)
+    # the code, for sorting naturally in SQL, see utils.natsort_sql_key
+    sort_key = Column(Unicode(64), index=True)
 
     @validates('code')
     def validate_stripping(self, key, value):
         if value is None:
             return None
-        return value.strip()
+        value = value.strip()
+        self.sort_key = utils.natsort_sql_key(value)
+        return value
+
+    @classmethod
+    def natsort_columns(cls):
+        """the columns ordering plants like utils.natsort_key
+
+        those of their accession come first, see natsort_order.
+        """
+        from bauble.plugins.garden.accession import Accession
+        return (Accession.natsort_columns() + [cls.sort_key, cls.code])
+
+    @classmethod
+    def natsort_order(cls, query):
+        """order query the way utils.natsort_key sorts plants"""
+        return query.join(cls.accession).order_by(*cls.natsort_columns())
 
     acc_type = Column(types.Enum(values=acc_type_values.keys(),
                                  translations=acc_type_values),
@@ -570,6 +588,17 @@ class Plant(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
         except:
             return None
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Plantings'), 'count', 'id'),
+        ((2, 'Accessions'), 'count', 'accession_id'),
+        ((3, 'Species'), 'count', 'accession.species_id'),
+        ((4, 'Genera'), 'count', 'accession.species.genus_id'),
+        ((5, 'Families'), 'count', 'accession.species.genus.family_id'),
+        ((6, 'Living plants'), 'sum', 'quantity'),
+        ((7, 'Locations'), 'count', 'location_id'),
+        ((8, 'Sources'), 'count', 'accession.source.source_detail_id')]
+
     def top_level_count(self):
         sd = self.accession.source and self.accession.source.source_detail
         return {(1, 'Plantings'): 1,
@@ -29,7 +29,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from nose import SkipTest
-from sqlalchemy import and_
+from sqlalchemy import and_, select
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import object_session
 
@@ -2330,6 +2330,128 @@ class AccessionGetNextCode(GardenTestCase):
         self.assertEquals(Accession.get_next_code(u'%Y.####')[5:], '0988')
 
 
+class AggregateCountsTests(GardenTestCase):
+
+    def python_counts(self, cls):
+        # what CountResultsTask computes, one object at a time
+        d = {}
+        for item in self.session.query(cls):
+            for k, v in item.top_level_count().items():
+                if isinstance(v, set):
+                    d[k] = v.union(d.get(k, set()))
+                else:
+                    d[k] = v + d.get(k, 0)
+        return dict((k, isinstance(v, set) and len(v) or v)
+                    for k, v in d.items())
+
+    def test_same_as_top_level_count(self):
+        for cls in (Family, Genus, Species, Accession, Plant, Location):
+            ids = [i for (i, ) in self.session.query(cls.id)]
+            self.assertTrue(ids, cls)
+            self.assertEquals(
+                db.aggregate_counts(self.session, cls, ids,
+                                    cls.top_level_counters),
+                self.python_counts(cls), cls)
+
+    def test_chunked(self):
+        for cls in (Family, Genus, Species, Accession, Plant, Location):
+            ids = [i for (i, ) in self.session.query(cls.id)]
+            self.assertEquals(
+                db.aggregate_counts(self.session, cls, ids,
+                                    cls.top_level_counters, chunk_size=1),
+                self.python_counts(cls), cls)
+
+    def test_no_ids(self):
+        counts = db.aggregate_counts(self.session, Plant, [],
+                                     Plant.top_level_counters)
+        self.assertEquals(set(counts.values()), set([0]))
+
+
+class SortKeyTests(GardenTestCase):
+
+    def setUp(self):
+        super(SortKeyTests, self).setUp()
+        self.location = self.create(Location, name=u'site', code=u'STE')
+        self.accessions = [
+            self.create(Accession, species=self.species, code=code)
+            for code in (u'2017.10', u'2017.2', u'2016.30')]
+        for code in (u'10', u'9', u'1'):
+            self.create(Plant, accession=self.accessions[0],
+                        location=self.location, code=code, quantity=1)
+        self.create(Plant, accession=self.accessions[2],
+                    location=self.location, code=u'1', quantity=1)
+        self.session.commit()
+
+    def test_maintained(self):
+        accession = self.accessions[0]
+        self.assertEquals(accession.sort_key,
+                          utils.natsort_sql_key(u'2017.10'))
+        accession.code = u' 2017.11 '
+        self.assertEquals(accession.sort_key,
+                          utils.natsort_sql_key(u'2017.11'))
+
+    def test_order_as_natsort(self):
+        for cls, parent, relation in (
+                (Accession, self.species, 'accessions'),
+                (Plant, self.accessions[0], 'plants'),
+                (Plant, self.location, 'plants')):
+            query = self.session.query(cls).with_parent(parent, relation)
+            self.assertEquals(cls.natsort_order(query).all(),
+                              sorted(query, key=utils.natsort_key))
+
+    def test_locations_named_and_not(self):
+        for code, name in ((u'B1', None), (u'A10', u'zeta'), (u'A2', None),
+                           (u'A9', u'alpha'), (u'B10', None)):
+            self.create(Location, code=code, name=name)
+        self.session.commit()
+        query = self.session.query(Location)
+        self.assertEquals(Location.natsort_order(query).all(),
+                          sorted(query, key=utils.natsort_key))
+        location = query.filter_by(code=u'A2').one()
+        location.name = u'beta'
+        self.assertEquals(location.sort_key,
+                          utils.natsort_sql_key(u'(A2) beta'))
+        location.name = None
+        self.assertEquals(location.sort_key, utils.natsort_sql_key(u'A2'))
+
+    def test_fill_locations(self):
+        table = Location.__table__
+        self.create(Location, code=u'A9', name=u'alpha')
+        self.session.commit()
+        db.engine.execute(table.update().values(sort_key=None))
+        db.fill_sort_keys(table)
+        keys = db.engine.execute(select([table.c.sort_key]))
+        self.assertEquals(set(key for (key, ) in keys),
+                          set([utils.natsort_sql_key(u'(STE) site'),
+                               utils.natsort_sql_key(u'(A9) alpha')]))
+
+    def test_natsort_identities(self):
+        objects = (self.session.query(Plant).all() +
+                   self.session.query(Accession).all() +
+                   self.session.query(Species).all())
+        identities = [(type(i), i.id) for i in reversed(objects)]
+        expected = []
+        for cls in (Accession, Plant):
+            expected.extend((cls, i.id) for i in sorted(
+                self.session.query(cls), key=utils.natsort_key))
+        # no natsort_order, the order is kept
+        expected.extend(i for i in identities if i[0] is Species)
+        self.assertEquals(search.natsort_identities(
+            self.session, identities, chunk_size=1), expected)
+        self.assertRaises(search.SearchCancelled, search.natsort_identities,
+                          self.session, identities, lambda: True)
+
+    def test_fill(self):
+        table = Accession.__table__
+        db.engine.execute(table.update().values(sort_key=None))
+        db.fill_sort_keys(table)
+        keys = db.engine.execute(select([table.c.sort_key]))
+        self.assertEquals(set(key for (key, ) in keys),
+                          set(utils.natsort_sql_key(a.code)
+                              for a in self.accessions))
+        self.assertFalse(db.ensure_sort_key(table))
+
+
 class GlobalFunctionsTests(GardenTestCase):
 
     def test_mergevalues_equal(self):
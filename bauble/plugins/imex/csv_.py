@@ -543,6 +543,23 @@ class CSVImporter(Importer):
                                          traceback.format_exc(),
                                          type=gtk.MESSAGE_ERROR)
 
+        # the species binomial keys are maintained by the mapper, which
+        # the import bypasses
+        if any(t.name == 'species' for t, f in sorted_tables):
+            from bauble.plugins.plants.species_model import \
+                fill_binomial_keys
+            fill_binomial_keys()
+
+        # and the sort keys of the garden codes
+        for table, filename in sorted_tables:
+            if table.name in ('accession', 'location', 'plant'):
+                db.fill_sort_keys(table)
+
+        # so is the fuzzy name index
+        import bauble.fuzzy as fuzzy
+        if fuzzy.has_index():
+            fuzzy.create_index()
+
     def _get_filenames(self):
         def on_selection_changed(filechooser, data=None):
             """
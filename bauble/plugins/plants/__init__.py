@@ -326,6 +326,10 @@ class PlantsPlugin(pluginmgr.Plugin):
             species_context_menu.insert(1, add_accession_action)
             vernname_context_menu.insert(1, add_accession_action)
 
+        # databases created before species.binomial_key existed
+        from bauble.plugins.plants.species_model import ensure_binomial_key
+        ensure_binomial_key()
+
         mapper_search = search.get_strategy('MapperSearch')
 
         mapper_search.add_meta(('family', 'fam'), Family, ['family'])
@@ -333,7 +337,8 @@ class PlantsPlugin(pluginmgr.Plugin):
                                         infobox=FamilyInfoBox,
                                         context_menu=family_context_menu)
 
-        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'])
+        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'],
+                               eager=['family'])
         SearchView.row_meta[Genus].set(children="species",
                                        infobox=GenusInfoBox,
                                        context_menu=genus_context_menu)
@@ -342,20 +347,31 @@ class PlantsPlugin(pluginmgr.Plugin):
         search.add_strategy(SynonymSearch)
         mapper_search.add_meta(('species', 'sp'), Species,
                                ['sp', 'sp2', 'infrasp1', 'infrasp2',
-                                'infrasp3', 'infrasp4'])
+                                'infrasp3', 'infrasp4'],
+                               eager=['genus.family', 'vernacular_names',
+                                      '_syn.species.genus'])
         SearchView.row_meta[Species].set(
             children=partial(db.natsort, 'accessions'),
             infobox=SpeciesInfoBox,
             context_menu=species_context_menu)
 
         mapper_search.add_meta(('vernacular', 'vern', 'common'),
-                               VernacularName, ['name'])
+                               VernacularName, ['name'],
+                               eager=['species.genus'])
         SearchView.row_meta[VernacularName].set(
             children=partial(db.natsort, 'species.accessions'),
             infobox=VernacularNameInfoBox,
             context_menu=vernname_context_menu)
 
         mapper_search.add_meta(('geography', 'geo'), Geography, ['name'])
+
+        # near matches of misspelled names, see bauble.fuzzy
+        import bauble.fuzzy as fuzzy
+        fuzzy.register(Family, ['family'])
+        fuzzy.register(Genus, ['genus'])
+        fuzzy.register(Species, ['sp', 'binomial_key'])
+        fuzzy.register(VernacularName, ['name'])
+        mapper_search.add_fallback(fuzzy.FuzzySearch())
         SearchView.row_meta[Geography].set(children=get_species_in_geography)
 
         ## now it's the turn of the DefaultView
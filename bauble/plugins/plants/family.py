@@ -262,6 +262,20 @@ class Family(db.Base, db.Serializable, db.WithNotes):
                 keys[internal] = keys[exchange]
                 del keys[exchange]
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Families'), 'count', 'id'),
+        ((2, 'Genera'), 'count', 'genera.species.genus_id'),
+        ((3, 'Species'), 'count', 'genera.species.id'),
+        ((4, 'Accessions'), 'count', 'genera.species.accessions.id'),
+        ((5, 'Plantings'), 'count', 'genera.species.accessions.plants.id'),
+        ((6, 'Living plants'), 'sum',
+         'genera.species.accessions.plants.quantity'),
+        ((7, 'Locations'), 'count',
+         'genera.species.accessions.plants.location_id'),
+        ((8, 'Sources'), 'count',
+         'genera.species.accessions.source.source_detail_id')]
+
     def top_level_count(self):
         genera = set(g for g in self.genera if g.species)
         species = [s for g in genera for s in g.species]
@@ -753,55 +767,52 @@ class GeneralFamilyExpander(InfoExpander):
         self.current_obj = row
         self.widget_set_value('fam_name_data', '<big>%s</big>' % row,
                               markup=True)
-        session = object_session(row)
-        # get the number of genera
-        ngen = session.query(Genus).filter_by(family_id=row.id).count()
-        self.widget_set_value('fam_ngen_data', ngen)
-
-        # get the number of species
-        nsp = (session.query(Species).join('genus').
-               filter_by(family_id=row.id).count())
-        if nsp == 0:
+        for name in ('fam_ngen_data', 'fam_nsp_data', 'fam_nacc_data',
+                     'fam_nplants_data'):
+            self.widget_set_value(name, '…')
+        counters = self.counters
+        if 'GardenPlugin' in pluginmgr.plugins:
+            counters = counters + self.garden_counters
+        view.infobox_statistics.get(row, counters, self.show_counts)
+
+    # the counters for db.aggregate_counts, in one statement
+    counters = [
+        ('ngen', 'count', 'genera.id'),
+        ('nsp', 'count', 'genera.species.id'),
+        ('ngen_in_sp', 'count', 'genera.species.genus_id')]
+    garden_counters = [
+        ('nacc', 'count', 'genera.species.accessions.id'),
+        ('nsp_in_acc', 'count', 'genera.species.accessions.species_id'),
+        ('nplants', 'count', 'genera.species.accessions.plants.id'),
+        ('nacc_in_plants', 'count',
+         'genera.species.accessions.plants.accession_id')]
+
+    def show_counts(self, row, counts):
+        if row is not self.current_obj:
+            return
+        self.widget_set_value('fam_ngen_data', counts['ngen'])
+        if counts['nsp'] == 0:
             self.widget_set_value('fam_nsp_data', 0)
         else:
-            ngen_in_sp = (session.query(Species.genus_id).
-                          join('genus', 'family').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('fam_nsp_data', '%s in %s genera'
-                                  % (nsp, ngen_in_sp))
+                                  % (counts['nsp'], counts['ngen_in_sp']))
 
         # stop here if no GardenPlugin
-        if 'GardenPlugin' not in pluginmgr.plugins:
+        if 'nacc' not in counts:
             return
 
-        # get the number of accessions in the family
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
-        nacc = (session.query(Accession).
-                join('species', 'genus', 'family').
-                filter_by(id=row.id).count())
-        if nacc == 0:
-            self.widget_set_value('fam_nacc_data', nacc)
+        if counts['nacc'] == 0:
+            self.widget_set_value('fam_nacc_data', 0)
         else:
-            nsp_in_acc = (session.query(Accession.species_id).
-                          join('species', 'genus', 'family').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('fam_nacc_data', '%s in %s species'
-                                  % (nacc, nsp_in_acc))
-
-        # get the number of plants in the family
-        nplants = (session.query(Plant).
-                   join('accession', 'species', 'genus', 'family').
-                   filter_by(id=row.id).count())
-        if nplants == 0:
-            self.widget_set_value('fam_nplants_data', nplants)
+                                  % (counts['nacc'], counts['nsp_in_acc']))
+
+        if counts['nplants'] == 0:
+            self.widget_set_value('fam_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                join('accession', 'species', 'genus', 'family').\
-                filter_by(id=row.id).distinct().count()
             self.widget_set_value('fam_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
+                                  % (counts['nplants'],
+                                     counts['nacc_in_plants']))
 
 
 class SynonymsExpander(InfoExpander):
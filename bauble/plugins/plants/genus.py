@@ -34,7 +34,7 @@ logger = logging.getLogger(__name__)
 
 from sqlalchemy import (
     Column, Unicode, Integer, ForeignKey, UnicodeText, String,
-    UniqueConstraint, func, and_)
+    UniqueConstraint, func, and_, event)
 from sqlalchemy.orm import relation, backref, validates, synonym
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -336,6 +336,18 @@ class Genus(db.Base, db.Serializable, db.WithNotes):
             raise error.NoResultException()
         return result
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Genera'), 'count', 'id'),
+        ((2, 'Families'), 'count', 'family_id'),
+        ((3, 'Species'), 'count', 'species.id'),
+        ((4, 'Accessions'), 'count', 'species.accessions.id'),
+        ((5, 'Plantings'), 'count', 'species.accessions.plants.id'),
+        ((6, 'Living plants'), 'sum', 'species.accessions.plants.quantity'),
+        ((7, 'Locations'), 'count', 'species.accessions.plants.location_id'),
+        ((8, 'Sources'), 'count',
+         'species.accessions.source.source_detail_id')]
+
     def top_level_count(self):
         accessions = [a for s in self.species for a in s.accessions]
         plants = [p for a in accessions for p in a.plants]
@@ -402,6 +414,21 @@ Genus.species = relation('Species', cascade='all, delete-orphan',
                          backref=backref('genus', uselist=False))
 
 
+def _update_binomial_keys(mapper, connection, target):
+    # renaming a genus changes the binomial of all its species
+    from sqlalchemy import inspect
+    if inspect(target).attrs.genus.history.has_changes():
+        from bauble.plugins.plants.species_model import (
+            Species, fill_binomial_keys)
+        fill_binomial_keys(connection, genus_id=target.id)
+        import bauble.fuzzy as fuzzy
+        if fuzzy.has_index(connection):
+            fuzzy.update_index(connection, Species,
+                               Species.__table__.c.genus_id == target.id)
+
+event.listen(Genus, 'after_update', _update_binomial_keys)
+
+
 class GenusEditorView(editor.GenericEditorView):
 
     syn_expanded_pref = 'editor.genus.synonyms.expanded'
@@ -898,52 +925,49 @@ class GeneralGenusExpander(InfoExpander):
 
         :param row: the row to get the values from
         '''
-        session = object_session(row)
         self.current_obj = row
         self.widget_set_value('gen_name_data', '<big>%s</big> %s' %
                               (row, utils.xml_safe(unicode(row.author))),
                               markup=True)
         self.widget_set_value('gen_fam_data',
                               (utils.xml_safe(unicode(row.family))))
-
-        # get the number of species
-        nsp = (session.query(Species).
-               join('genus').
-               filter_by(id=row.id).count())
-        self.widget_set_value('gen_nsp_data', nsp)
+        for name in ('gen_nsp_data', 'gen_nacc_data', 'gen_nplants_data'):
+            self.widget_set_value(name, '…')
+        counters = self.counters
+        if 'GardenPlugin' in pluginmgr.plugins:
+            counters = counters + self.garden_counters
+        view.infobox_statistics.get(row, counters, self.show_counts)
+
+    # the counters for db.aggregate_counts, in one statement
+    counters = [
+        ('nsp', 'count', 'species.id')]
+    garden_counters = [
+        ('nacc', 'count', 'species.accessions.id'),
+        ('nsp_in_acc', 'count', 'species.accessions.species_id'),
+        ('nplants', 'count', 'species.accessions.plants.id'),
+        ('nacc_in_plants', 'count', 'species.accessions.plants.accession_id')]
+
+    def show_counts(self, row, counts):
+        if row is not self.current_obj:
+            return
+        self.widget_set_value('gen_nsp_data', counts['nsp'])
 
         # stop here if no GardenPlugin
-        if 'GardenPlugin' not in pluginmgr.plugins:
+        if 'nacc' not in counts:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
-        # get number of accessions
-        nacc = (session.query(Accession).
-                join('species', 'genus').
-                filter_by(id=row.id).count())
-        if nacc == 0:
-            self.widget_set_value('gen_nacc_data', nacc)
+        if counts['nacc'] == 0:
+            self.widget_set_value('gen_nacc_data', 0)
         else:
-            nsp_in_acc = (session.query(Accession.species_id).
-                          join('species', 'genus').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('gen_nacc_data', '%s in %s species'
-                                  % (nacc, nsp_in_acc))
-
-        # get the number of plants in the genus
-        nplants = (session.query(Plant).
-                   join('accession', 'species', 'genus').
-                   filter_by(id=row.id).count())
-        if nplants == 0:
-            self.widget_set_value('gen_nplants_data', nplants)
+                                  % (counts['nacc'], counts['nsp_in_acc']))
+
+        if counts['nplants'] == 0:
+            self.widget_set_value('gen_nplants_data', 0)
         else:
-            nacc_in_plants = (session.query(Plant.accession_id).
-                              join('accession', 'species', 'genus').
-                              filter_by(id=row.id).distinct().count())
             self.widget_set_value('gen_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
+                                  % (counts['nplants'],
+                                     counts['nacc_in_plants']))
 
 
 class SynonymsExpander(InfoExpander):
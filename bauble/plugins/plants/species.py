@@ -29,6 +29,7 @@ logger = logging.getLogger(__name__)
 import os
 import traceback
 
+from sqlalchemy import or_
 from sqlalchemy.orm.session import object_session
 
 import bauble
@@ -142,6 +143,7 @@ class SynonymSearch(search.SearchStrategy):
         if self.return_synonyms_pref not in prefs:
             prefs[self.return_synonyms_pref] = True
             prefs.save()
+        search.result_cache.add_key_pref(self.return_synonyms_pref)
 
     def search(self, text, session):
         from genus import Genus, GenusSynonym
@@ -171,6 +173,49 @@ class SynonymSearch(search.SearchStrategy):
                 results.extend([syn.species for syn in q])
         return results
 
+    def results(self, text, session=None):
+        """the accepted names of the matching species and genera, lazily
+
+        the synonym tables are queried on the ids found by MapperSearch,
+        as a subquery where possible, so that nothing is loaded before
+        the results are counted or iterated.
+        """
+        from genus import Genus, GenusSynonym
+        super(SynonymSearch, self).search(text, session)
+        results = search.SearchResults()
+        if not prefs[self.return_synonyms_pref]:
+            return results
+        mapper_search = search.get_strategy('MapperSearch')
+        found = mapper_search.search(text, session, lazy=True)
+
+        def conditions(cls, synonym_id):
+            # synonym_id among the ids of the found objects of class cls,
+            # through a subquery where the part is a query.
+            result = []
+            plain = []
+            for part in found.parts:
+                if isinstance(part, search.QueryPart):
+                    if part.cls is cls:
+                        result.append(synonym_id.in_(
+                            part.query.with_entities(cls.id).subquery()))
+                else:
+                    plain.extend(id for c, id in part.identities()
+                                 if c is cls)
+            if plain:
+                result.append(synonym_id.in_(plain))
+            return result
+
+        for cls, synonym, accepted in (
+                (Species, SpeciesSynonym, SpeciesSynonym.species_id),
+                (Genus, GenusSynonym, GenusSynonym.genus_id)):
+            clauses = conditions(cls, synonym.synonym_id)
+            if not clauses:
+                continue
+            accepted_ids = session.query(accepted).filter(or_(*clauses))
+            results.add(session.query(cls).filter(
+                cls.id.in_(accepted_ids.subquery())))
+        return results
+
 
 #
 # Species infobox for SearchView
@@ -316,7 +361,6 @@ class GeneralSpeciesExpander(InfoExpander):
         :param row: the row to get the values from
         '''
         self.current_obj = row
-        session = object_session(row)
         # link function
         on_label_clicked = lambda l, e, x: select_in_search_results(x)
         # Link to family
@@ -369,23 +413,27 @@ class GeneralSpeciesExpander(InfoExpander):
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
+        for name in ('sp_nacc_data', 'sp_nplants_data'):
+            self.widget_set_value(name, '…')
+        view.infobox_statistics.get(row, self.garden_counters,
+                                    self.show_counts)
 
-        nacc = session.query(Accession).join('species').\
-            filter_by(id=row.id).count()
-        self.widget_set_value('sp_nacc_data', nacc)
+    # the counters for db.aggregate_counts, in one statement
+    garden_counters = [
+        ('nacc', 'count', 'accessions.id'),
+        ('nplants', 'count', 'accessions.plants.id'),
+        ('nacc_in_plants', 'count', 'accessions.plants.accession_id')]
 
-        nplants = session.query(Plant).join('accession', 'species').\
-            filter_by(id=row.id).count()
-        if nplants == 0:
-            self.widget_set_value('sp_nplants_data', nplants)
+    def show_counts(self, row, counts):
+        if row is not self.current_obj:
+            return
+        self.widget_set_value('sp_nacc_data', counts['nacc'])
+        if counts['nplants'] == 0:
+            self.widget_set_value('sp_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                join('accession', 'species').\
-                filter_by(id=row.id).distinct().count()
             self.widget_set_value('sp_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
+                                  % (counts['nplants'],
+                                     counts['nacc_in_plants']))
 
 
 class SpeciesInfoBox(InfoBox):
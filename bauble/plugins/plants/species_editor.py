@@ -47,7 +47,7 @@ from bauble.plugins.plants.family import Family
 from bauble.plugins.plants.genus import Genus, GenusSynonym
 from bauble.plugins.plants.species_model import (
     Species, SpeciesDistribution, VernacularName, SpeciesSynonym, Habit,
-    infrasp_rank_values, compare_rank)
+    infrasp_rank_values, compare_rank, binomial_clause)
 
 
 class SpeciesEditorPresenter(editor.GenericEditorPresenter):
@@ -944,10 +944,11 @@ class SynonymsPresenter(editor.GenericEditorPresenter):
         self.init_treeview()
 
         def sp_get_completions(text):
-            query = self.session.query(Species).join('genus').\
-                filter(utils.ilike(Genus.genus, '%s%%' % text)).\
+            # the typed text is the beginning of the binomial
+            query = self.session.query(Species).\
+                filter(binomial_clause(utils.utf8(text))).\
                 filter(Species.id != self.model.id).\
-                order_by(Genus.genus, Species.sp)
+                order_by(Species.binomial_key)
             return query
 
         def on_select(value):
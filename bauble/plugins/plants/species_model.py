@@ -28,7 +28,8 @@ logger = logging.getLogger(__name__)
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from sqlalchemy import Column, Boolean, Unicode, Integer, ForeignKey, \
-    UnicodeText, func, UniqueConstraint
+    UnicodeText, func, UniqueConstraint, and_, or_, event, select, bindparam
+import sqlalchemy as sa
 from sqlalchemy.orm import relation, backref, synonym
 import bauble.db as db
 import bauble.error as error
@@ -44,6 +45,51 @@ def _remove_zws(s):
     return s
 
 
+def make_binomial_key(genus, sp, infrasp1=None):
+    """the normalized binomial, as stored in Species.binomial_key
+
+    lowercased genus and species epithets separated by a space, without
+    zero width spaces.  an unnamed species marked as `Genus sp` (sp in
+    infrasp1) gets `sp` as species epithet.
+    """
+    if not sp and infrasp1 == u'sp':
+        sp = u'sp'
+    key = _remove_zws(genus or u'').lower()
+    if sp:
+        key += u' ' + _remove_zws(sp).lower()
+    return key
+
+
+def _prefix_range(column, prefix):
+    # all values starting with prefix, as a B-tree range
+    if not prefix:
+        return column != None
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return and_(column >= prefix, column < upper)
+
+
+def binomial_clause(genus_epithet, species_epithet=None):
+    """select the species by the beginning of their binomial
+
+    with only genus_epithet, this is any text the binomial starts with.
+    with both, the binomial must have a genus starting with
+    genus_epithet and a species epithet starting with species_epithet.
+    a species epithet `sp` also selects the species of the genus marked
+    as `Genus sp` (sp in infrasp1), whatever their species epithet.
+    either way the index on binomial_key is used as a range scan.
+    """
+    genus_epithet = _remove_zws(genus_epithet).lower()
+    in_genus = _prefix_range(Species.binomial_key, genus_epithet)
+    if species_epithet is None:
+        return in_genus
+    species_epithet = _remove_zws(species_epithet).lower()
+    clause = and_(in_genus, Species.binomial_key.like(
+        u'%s%% %s%%' % (genus_epithet, species_epithet)))
+    if species_epithet == u'sp':
+        clause = or_(clause, and_(in_genus, Species.infrasp1 == u'sp'))
+    return clause
+
+
 class VNList(list):
     """
     A Collection class for Species.vernacular_names
@@ -135,6 +181,11 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
             This field is optional and can be used for the label in case
             str(self.distribution) is too long to fit on the label.
 
+        *binomial_key*:
+            the lowercased "genus species", without zero width spaces,
+            maintained automatically and indexed for binomial searches.
+            see make_binomial_key() and binomial_clause().
+
     :Properties:
         *accessions*:
 
@@ -303,6 +354,8 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
                                       translations=infrasp_rank_values))
     infrasp4_author = Column(Unicode(64))
 
+    binomial_key = Column(Unicode(160), index=True)
+
     genus_id = Column(Integer, ForeignKey('genus.id'), nullable=False)
     ## the Species.genus property is defined as backref in Genus.species
 
@@ -512,8 +565,12 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
         if not session:
             logger.warn('species:accepted - object not in session')
             return None
-        syn = session.query(SpeciesSynonym).filter(
-            SpeciesSynonym.synonym_id == self.id).first()
+        if '_syn' in self.__dict__:
+            # already loaded, as by the search eager loading plan
+            syn = self._syn and self._syn[0]
+        else:
+            syn = session.query(SpeciesSynonym).filter(
+                SpeciesSynonym.synonym_id == self.id).first()
         accepted = syn and syn.species
         return accepted
 
@@ -539,6 +596,8 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
         if value != self:
             value.synonyms.append(self)
         session.flush()
+        # the link is not a backref of _syn, which may be loaded
+        session.expire(self, ['_syn'])
 
     def has_accessions(self):
         '''true if species is linked to at least one accession
@@ -623,6 +682,17 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
             raise error.NoResultException()
         return result
 
+    # the same counters as top_level_count(), for db.aggregate_counts
+    top_level_counters = [
+        ((1, 'Species'), 'count', 'id'),
+        ((2, 'Genera'), 'count', 'genus_id'),
+        ((3, 'Families'), 'count', 'genus.family_id'),
+        ((4, 'Accessions'), 'count', 'accessions.id'),
+        ((5, 'Plantings'), 'count', 'accessions.plants.id'),
+        ((6, 'Living plants'), 'sum', 'accessions.plants.quantity'),
+        ((7, 'Locations'), 'count', 'accessions.plants.location_id'),
+        ((8, 'Sources'), 'count', 'accessions.source.source_detail_id')]
+
     def top_level_count(self):
         plants = [p for a in self.accessions for p in a.plants]
         return {(1, 'Species'): 1,
@@ -666,6 +736,63 @@ def retrieve(cls, session, keys):
 SpeciesNote = db.make_note_class('Species', compute_serializable_fields, as_dict, retrieve)
 
 
+def _set_binomial_key(mapper, connection, target):
+    if target.genus is not None:
+        genus = target.genus.genus
+    else:
+        from genus import Genus
+        genus = connection.execute(
+            select([Genus.__table__.c.genus]).where(
+                Genus.__table__.c.id == target.genus_id)).scalar()
+    target.binomial_key = make_binomial_key(genus, target.sp,
+                                             target.infrasp1)
+
+event.listen(Species, 'before_insert', _set_binomial_key)
+event.listen(Species, 'before_update', _set_binomial_key)
+
+
+def fill_binomial_keys(bind=None, genus_id=None):
+    """compute binomial_key for all species, or those of a genus
+
+    used when the keys can't be maintained by the mapper events: a genus
+    being renamed, species imported from csv, the column just added.
+    """
+    from genus import Genus
+    if bind is None:
+        bind = db.engine
+    species = Species.__table__
+    genus = Genus.__table__
+    query = select([species.c.id, genus.c.genus, species.c.sp,
+                    species.c.infrasp1]).where(
+        species.c.genus_id == genus.c.id)
+    if genus_id is not None:
+        query = query.where(species.c.genus_id == genus_id)
+    values = [{'_id': id, '_key': make_binomial_key(g, sp, infrasp1)}
+              for id, g, sp, infrasp1 in bind.execute(query)]
+    if values:
+        bind.execute(species.update().where(
+            species.c.id == bindparam('_id')).values(
+            binomial_key=bindparam('_key')), values)
+
+
+def ensure_binomial_key(bind=None):
+    """add the binomial_key column to databases created without it
+
+    return True if the column had to be added.
+    """
+    if bind is None:
+        bind = db.engine
+    columns = [c['name'] for c in sa.inspect(bind).get_columns('species')]
+    if 'binomial_key' in columns:
+        return False
+    logger.info('adding species.binomial_key')
+    bind.execute('ALTER TABLE species ADD COLUMN binomial_key VARCHAR(160)')
+    bind.execute('CREATE INDEX ix_species_binomial_key '
+                 'ON species (binomial_key)')
+    fill_binomial_keys(bind)
+    return True
+
+
 class SpeciesSynonym(db.Base):
     """
     :Table name: species_synonym
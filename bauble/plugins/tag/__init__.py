@@ -35,7 +35,7 @@ from sqlalchemy import (
     Column, Unicode, UnicodeText, Integer, String, ForeignKey)
 from sqlalchemy.orm import relation
 from sqlalchemy.orm.exc import DetachedInstanceError
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import DBAPIError, InvalidRequestError
 from sqlalchemy.orm.session import object_session
 
@@ -465,13 +465,34 @@ class Tag(db.Base):
         session = object_session(obj)
         if not session:
             return []
-        modname = type(obj).__module__
-        clsname = type(obj).__name__
-        full_cls_name = '%s.%s' % (modname, clsname)
-        qto = session.query(TaggedObj).filter(
-            TaggedObj.obj_class == full_cls_name,
-            TaggedObj.obj_id == obj.id)
-        return [i.tag for i in qto.all()]
+        key = (type(obj), obj.id)
+        return cls.attached_to_many(session, [key]).get(key, [])
+
+    @classmethod
+    def attached_to_many(cls, session, identities):
+        """return the tags attached to many objects, in one query
+
+        identities is a list of (class, id) pairs, the result is a dict
+        with the list of tags of each pair having any.
+        """
+        ids_by_name = {}
+        classes = {}
+        for klass, obj_id in identities:
+            name = _class_name(klass)
+            classes[name] = klass
+            ids_by_name.setdefault(name, []).append(obj_id)
+        if not ids_by_name:
+            return {}
+        query = session.query(
+            TaggedObj.obj_class, TaggedObj.obj_id, Tag).join(
+            Tag, TaggedObj.tag_id == Tag.id).filter(or_(*[
+                and_(TaggedObj.obj_class == name, TaggedObj.obj_id.in_(ids))
+                for name, ids in ids_by_name.iteritems()])).order_by(
+            TaggedObj.id)
+        result = {}
+        for name, obj_id, tag in query:
+            result.setdefault((classes[name], obj_id), []).append(tag)
+        return result
 
     def search_view_markup_pair(self):
         '''provide the two lines describing object for SearchView row.
@@ -602,9 +623,21 @@ def untag_objects(name, objs):
     session.commit()
 
 
+# the classnames stored in the tagged_obj table, by class
+_class_names = {}
+
+
+def _class_name(cls):
+    try:
+        return _class_names[cls]
+    except KeyError:
+        result = _class_names[cls] = unicode('%s.%s', 'utf-8') % (
+            cls.__module__, cls.__name__)
+        return result
+
+
 # create the classname stored in the tagged_obj table
-_classname = lambda x: unicode('%s.%s', 'utf-8') % (
-    type(x).__module__, type(x).__name__)
+_classname = lambda x: _class_name(type(x))
 
 
 def tag_objects(name, objects):
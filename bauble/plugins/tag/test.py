@@ -475,6 +475,19 @@ class AttachedToTests(BaubleTestCase):
             tag_plugin.tag_objects(t, [fam])
         self.assertEquals(Tag.attached_to(fam), tags)
 
+    def test_attached_to_many(self):
+        fam = self.session.query(Family).one()
+        other = Family(family=u'Rubiaceae')
+        self.session.add(other)
+        self.session.commit()
+        obj2 = self.session.query(Tag).filter(Tag.tag == u'maderable').one()
+        tag_plugin.tag_objects(obj2, [fam, other])
+        attached = Tag.attached_to_many(
+            self.session, [(Family, fam.id), (Family, other.id), (Tag, 0)])
+        self.assertEquals(attached, {(Family, fam.id): [obj2],
+                                     (Family, other.id): [obj2]})
+        self.assertEquals(Tag.attached_to_many(self.session, []), {})
+
 
 class TagInfoBoxTest(BaubleTestCase):
     def test_can_create_infobox(self):
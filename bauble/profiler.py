@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Opt-in profiler for searches.
+
+While enabled, every search opens a SearchProfile, recording:
+
+- the time spent parsing the search string;
+- the time each search strategy took, when they run concurrently;
+- every SQL statement the search executes on db.engine, with its wall
+  time, the number of rows the driver reports, if it does (SQLite
+  doesn't for SELECT), and the number of objects loaded from them;
+- the time spent populating the search results view;
+- the objects fetched from the database, and those actually shown.
+
+The profiler is switched on and off with `:profile=on` and
+`:profile=off`.  `:profile` shows the recent profiles, and
+`:profile=dump` writes them as JSON in the user directory.
+"""
+
+import collections
+import datetime
+import json
+import os
+import thread
+import time
+from contextlib import contextmanager
+
+import gtk
+import pango
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+
+import bauble.db as db
+import bauble.paths as paths
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+
+class SearchProfile(object):
+    """what happened during one search"""
+
+    def __init__(self, text):
+        self.text = text
+        self.started = datetime.datetime.now()
+        self.times = collections.defaultdict(float)
+        self.statements = []
+        self.fetched = set()
+        self.shown = set()
+        # the threads working for the search, with the count of how
+        # many times each is attached, and their last statement
+        self.threads = collections.Counter([thread.get_ident()])
+        self._last = {}
+
+    def add_statement(self, statement, elapsed, rows):
+        self._last[thread.get_ident()] = item = {
+            'statement': statement, 'time': elapsed, 'rows': rows,
+            'objects': 0}
+        self.statements.append(item)
+
+    def add_object(self, obj):
+        self.fetched.add((type(obj).__name__, getattr(obj, 'id', None)))
+        last = self._last.get(thread.get_ident())
+        if last is not None:
+            last['objects'] += 1
+
+    def as_dict(self):
+        return {'text': self.text,
+                'started': self.started.isoformat(),
+                'parse_time': self.times['parse'],
+                'populate_time': self.times['populate'],
+                'strategy_times': dict(
+                    (k[len('strategy:'):], v)
+                    for k, v in self.times.items()
+                    if k.startswith('strategy:')),
+                'statement_count': len(self.statements),
+                'statement_time': sum(s['time'] for s in self.statements),
+                'statements': self.statements,
+                'fetched': len(self.fetched),
+                'shown': len(self.shown),
+                'fetched_not_shown': len(self.fetched - self.shown)}
+
+    def report(self):
+        d = self.as_dict()
+        lines = [_('search: %(text)s (%(started)s)') % d,
+                 _('parse: %(parse_time).3fs, populate: %(populate_time).3fs, '
+                   '%(statement_count)d statements in %(statement_time).3fs')
+                 % d,
+                 _('objects fetched: %(fetched)d, shown: %(shown)d, '
+                   'never shown: %(fetched_not_shown)d') % d]
+        if d['strategy_times']:
+            lines.append(_('strategies: %s') % ', '.join(
+                '%s %.3fs' % i for i in sorted(d['strategy_times'].items())))
+        for s in self.statements:
+            lines.append(u'  %.3fs %s rows %d objects  %s' % (
+                s['time'], 'n/a' if s['rows'] is None else s['rows'],
+                s['objects'], ' '.join(s['statement'].split())))
+        return u'\n'.join(lines)
+
+
+class Profiler(object):
+    """collects a SearchProfile per search, while enabled"""
+
+    size = 20
+
+    def __init__(self):
+        self.enabled = False
+        self.engine = None
+        self.current = None
+        self.profiles = collections.deque(maxlen=self.size)
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+        event.listen(Mapper, 'load', self._load)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
+        event.remove(Mapper, 'load', self._load)
+        self.engine = None
+        self.current = None
+        self.enabled = False
+
+    def begin(self, text):
+        """start the profile of a new search"""
+        if not self.enabled:
+            return
+        self.current = SearchProfile(text)
+        self.profiles.append(self.current)
+
+    @contextmanager
+    def attached(self):
+        """
+        Count the statements of the current thread in the current
+        profile, while in the block.  the thread beginning the profile
+        is attached already.
+        """
+        current = self.current
+        if current is None:
+            yield
+            return
+        ident = thread.get_ident()
+        current.threads[ident] += 1
+        try:
+            yield
+        finally:
+            current.threads[ident] -= 1
+
+    def detach(self):
+        """stop counting the statements of the current thread"""
+        current = self.current
+        if current is not None:
+            current.threads.pop(thread.get_ident(), None)
+
+    def _following(self):
+        # the current profile, if the current thread works for it
+        current = self.current
+        if current is not None and current.threads[thread.get_ident()] > 0:
+            return current
+        return None
+
+    def add_time(self, name, elapsed):
+        if self.current is not None:
+            self.current.times[name] += elapsed
+
+    def shown(self, obj):
+        if self.current is not None:
+            self.current.shown.add((type(obj).__name__,
+                                    getattr(obj, 'id', None)))
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('profiler_start', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed = time.time() - conn.info['profiler_start'].pop()
+        current = self._following()
+        if current is None:
+            return
+        # -1 when the driver doesn't know, as SQLite for SELECT
+        rows = cursor.rowcount
+        if rows is None or rows < 0:
+            rows = None
+        current.add_statement(statement, elapsed, rows)
+
+    def _load(self, target, context):
+        current = self._following()
+        if current is not None:
+            current.add_object(target)
+
+    def as_json(self):
+        return json.dumps([p.as_dict() for p in self.profiles], indent=2)
+
+    def dump(self, filename=None):
+        """write the recent profiles as JSON, return the file name"""
+        if filename is None:
+            filename = os.path.join(
+                paths.user_dir(), 'search-profile-%s.json'
+                % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        with open(filename, 'w') as f:
+            f.write(self.as_json())
+        return filename
+
+    def report(self):
+        if not self.profiles:
+            if self.enabled:
+                return _('no searches profiled yet')
+            return _('the search profiler is off, enable it with '
+                     ':profile=on')
+        return u'\n\n'.join(p.report() for p in reversed(self.profiles))
+
+
+profiler = Profiler()
+
+
+class ProfileView(pluginmgr.View):
+    """show the recent search profiles"""
+
+    def __init__(self):
+        super(ProfileView, self).__init__()
+        self.textview = gtk.TextView()
+        self.textview.set_editable(False)
+        self.textview.modify_font(pango.FontDescription('monospace'))
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.add(self.textview)
+        self.pack_start(scrolled)
+        self.show_all()
+        self.update()
+
+    def update(self):
+        self.textview.get_buffer().set_text(profiler.report())
+
+
+class ProfileCommandHandler(pluginmgr.CommandHandler):
+    """`:profile=on|off` switches the search profiler, `:profile=dump`
+    writes the recent profiles as JSON, `:profile` shows them.
+    """
+
+    command = 'profile'
+    view = None
+
+    def get_view(self):
+        if self.view is None:
+            self.__class__.view = ProfileView()
+        return self.view
+
+    def __call__(self, cmd, arg):
+        arg = (arg or '').strip()
+        if arg == 'on':
+            profiler.enable()
+        elif arg == 'off':
+            profiler.disable()
+        elif arg == 'dump':
+            filename = profiler.dump()
+            utils.message_dialog(_('search profiles written to %s')
+                                 % utils.xml_safe(filename))
+        self.view.update()
+
+
+pluginmgr.register_command(ProfileCommandHandler)
@@ -20,6 +20,8 @@
 # along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
 
 
+import threading
+import time
 import weakref
 
 import gtk
@@ -28,24 +30,617 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, not_, false
+from sqlalchemy import select, func, literal_column, union_all
+from sqlalchemy import Integer
+from sqlalchemy import event
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
-from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import class_mapper, aliased
 from sqlalchemy.orm.properties import (
     ColumnProperty, RelationshipProperty)
 RelationProperty = RelationshipProperty
 
 import bauble
-from bauble.error import check
+import bauble.db as db
+from bauble.error import check, BaubleError
+import bauble.pluginmgr as pluginmgr
 import bauble.utils as utils
+import bauble.fulltext as fulltext
+from bauble.profiler import profiler
+import bauble.trigram as trigram
 
 from bauble.editor import (
     GenericEditorView, GenericEditorPresenter)
 from querybuilderparser import BuiltQuery
 
 
-def search(text, session=None):
+def load_identities(session, identities, chunk_size=500):
+    """return the objects corresponding to the (class, id) pairs
+
+    objects are loaded in `session` with one `IN` query per class (per
+    chunk of `chunk_size` ids, to stay within the bind parameters limit
+    of SQLite), together with their eager_options().  the order of the
+    returned list is not specified.
+    """
+    by_class = {}
+    for cls, id in identities:
+        by_class.setdefault(cls, set()).add(id)
+    result = []
+    for cls, ids in by_class.iteritems():
+        ids = sorted(ids)
+        for i in range(0, len(ids), chunk_size):
+            result.extend(session.query(cls).options(
+                *eager_options(cls)).filter(
+                cls.id.in_(ids[i:i + chunk_size])).all())
+    return result
+
+
+def natsort_identities(session, identities, cancelled=None,
+                       chunk_size=500):
+    """the (class, id) pairs grouped by class name, naturally sorted
+
+    the order SearchView gives to the objects it loads, for the classes
+    having a natsort_order: their natsort_columns are selected for the
+    ids, `chunk_size` at a time, and compared without loading any
+    object.  the pairs of the other classes keep their order.  the
+    callable `cancelled` is asked between chunks, SearchCancelled is
+    raised if it returns True.
+    """
+    by_class = {}
+    for cls, id in identities:
+        by_class.setdefault(cls, []).append(id)
+    result = []
+    for cls in sorted(by_class, key=lambda c: c.__name__):
+        ids = by_class[cls]
+        if not hasattr(cls, 'natsort_order'):
+            result.extend((cls, id) for id in ids)
+            continue
+        query = cls.natsort_order(
+            session.query(cls.id, *cls.natsort_columns()))
+        rows = []
+        for i in range(0, len(ids), chunk_size):
+            if cancelled is not None and cancelled():
+                raise SearchCancelled()
+            rows.extend(query.filter(cls.id.in_(ids[i:i + chunk_size])))
+        rows.sort(key=lambda row: (tuple(row[1:]), row[0]))
+        result.extend((cls, row[0]) for row in rows)
+    return result
+
+
+def fulltext_clause(cls, values):
+    """the full-text match clause for values on cls, or None
+
+    None means that the caller should use LIKE, either because there is
+    no full-text index, or because trigram indexes serve LIKE on all the
+    search columns of cls, which keeps the substring semantics.
+    """
+    if trigram.has_index(cls):
+        return None
+    return fulltext.match_clause(cls, values)
+
+
+def eager_options(cls):
+    """the loader options for the objects of cls in search results
+
+    built from the relation paths registered with MapperSearch.add_meta:
+    each step of a path is loaded with a joined load if it refers to a
+    single object, with a subquery load if it refers to a collection,
+    so that the rows are never multiplied.
+    """
+    from sqlalchemy.orm import joinedload, subqueryload
+    result = []
+    for path in MapperSearch._eager.get(cls, []):
+        option = None
+        mapper = class_mapper(cls)
+        for step in path.split('.'):
+            prop = mapper.get_property(step)
+            if prop.uselist:
+                loader = subqueryload
+            else:
+                loader = joinedload
+            if option is None:
+                option = loader(step)
+            else:
+                option = getattr(option, loader.__name__)(step)
+            mapper = prop.mapper
+        result.append(option)
+    return result
+
+
+def explain(query):
+    """the plan the database chooses for query, as a list of lines
+
+    EXPLAIN QUERY PLAN on SQLite, EXPLAIN elsewhere.
+    """
+    session = query.session
+    bind = session.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    if bind.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+        params = tuple(compiled.params[k] for k in compiled.positiontup)
+    else:
+        prefix = 'EXPLAIN '
+        params = compiled.params
+    rows = session.connection().execute(prefix + unicode(compiled), params)
+    return [u' '.join(unicode(c) for c in row) for row in rows]
+
+
+class IdentityList(object):
+    """the objects corresponding to a list of (class, id) pairs
+
+    a part of SearchResults: objects are only loaded one page at a time,
+    in the order of the list.  `ranked` tells that the order matters,
+    like the best first order of a fuzzy search, and should be kept
+    when the results are shown.
+    """
+
+    def __init__(self, session, identities, ranked=False):
+        self.session = session
+        self._identities = list(identities)
+        self.ranked = ranked
+
+    def count(self):
+        return len(self._identities)
+
+    def identities(self):
+        return list(self._identities)
+
+    def pages(self, page_size):
+        for i in range(0, len(self._identities), page_size):
+            page = self._identities[i:i + page_size]
+            loaded = dict(((type(obj), obj.id), obj) for obj in
+                          load_identities(self.session, page))
+            yield [loaded[j] for j in page if j in loaded]
+
+
+class StatementPart(IdentityList):
+    """the objects selected by a (tag, id) statement, as ValueListAction
+
+    a part of SearchResults: `count()` runs the statement wrapped in a
+    `SELECT count(*)`, the identities are only fetched when needed.
+    objects standing for other objects (having a `replacement` method,
+    like vernacular names for their species) are replaced by these.
+    """
+
+    def __init__(self, session, statement, classes):
+        self.session = session
+        self.statement = statement
+        self.classes = classes
+        self._identities_cache = None
+
+    def count(self):
+        if self.statement is None:
+            return 0
+        if self._identities_cache is not None:
+            return len(self._identities_cache)
+        return self.session.execute(
+            select([func.count()]).select_from(
+                self.statement.alias())).scalar()
+
+    @property
+    def _identities(self):
+        if self._identities_cache is None:
+            self._identities_cache = self._fetch()
+        return self._identities_cache
+
+    def _fetch(self):
+        if self.statement is None:
+            return []
+        identities = [(self.classes[tag], id)
+                      for tag, id in self.session.execute(self.statement)]
+
+        # some objects stand for some other object, e.g. a vernacular
+        # name stands for its species, replace them right away.
+        replaceable = [(cls, id) for cls, id in identities
+                       if hasattr(cls, 'replacement')]
+        if replaceable:
+            identities = [(cls, id) for cls, id in identities
+                          if not hasattr(cls, 'replacement')]
+            for i in load_identities(self.session, replaceable):
+                try:
+                    replacement = i.replacement()
+                    logger.debug('replacing %s by %s in result set' %
+                                 (i, replacement))
+                    i = replacement
+                except:
+                    pass
+                if i is not None:
+                    identities.append((type(i), i.id))
+
+        seen = set()
+        result = []
+        for i in identities:
+            if i not in seen:
+                seen.add(i)
+                result.append(i)
+        return result
+
+
+class QueryPart(object):
+    """the objects selected by a query on a single mapped class
+
+    a part of SearchResults: the query is paged on the id of the class,
+    using keyset pagination (WHERE id > last ORDER BY id LIMIT n), so
+    that no page costs more than the first one.
+    """
+
+    def __init__(self, query, distinct=True):
+        self.cls = query.column_descriptions[0]['type']
+        # filters added from now on refer to the queried class, not to
+        # the last joined one.
+        self.query = query.reset_joinpoint().order_by(None)
+        # a query may produce the same object more than once, unless
+        # it is known not to, like the compiled QueryAction.
+        if distinct:
+            self.query = self.query.distinct()
+
+    def count(self):
+        return self.query.count()
+
+    def identities(self):
+        return [(self.cls, id) for (id, ) in
+                self.query.with_entities(self.cls.id).order_by(self.cls.id)]
+
+    def pages(self, page_size):
+        last = None
+        while True:
+            query = self.query
+            if last is not None:
+                query = query.filter(self.cls.id > last)
+            page = query.options(*eager_options(self.cls)).order_by(
+                self.cls.id).limit(page_size).all()
+            page = [i for i in page if i is not None]
+            if page:
+                yield page
+                last = page[-1].id
+            if len(page) < page_size:
+                break
+
+
+class ObjectList(object):
+    """objects already loaded, as returned by SearchStrategy.search"""
+
+    def __init__(self, objects):
+        self.objects = [i for i in objects if i is not None]
+
+    def count(self):
+        return len(self.objects)
+
+    def identities(self):
+        return [(type(i), i.id) for i in self.objects]
+
+    def pages(self, page_size):
+        for i in range(0, len(self.objects), page_size):
+            yield self.objects[i:i + page_size]
+
+
+class SearchResults(object):
+    """the lazy result of a search
+
+    `count()` tells how many objects the search found without loading
+    them, iterating yields the objects, `pages()` yields them in lists
+    of at most `page_size` objects, loading one page at a time.
+
+    the results are made of parts, each holding the result of one
+    search strategy: a query, a list of (class, id) pairs, or a list of
+    objects.  objects found by more parts are only returned once, for
+    this reason `count()` is an upper bound of the number of objects
+    actually produced.
+    """
+
+    page_size = 200
+
+    def __init__(self, parts=None):
+        self.parts = []
+        self._count = None
+        for part in parts or []:
+            self.add(part)
+
+    def add(self, part):
+        from sqlalchemy.orm import Query
+        if isinstance(part, SearchResults):
+            self.parts.extend(part.parts)
+        elif isinstance(part, Query):
+            self.parts.append(QueryPart(part))
+        elif isinstance(part, (IdentityList, QueryPart, ObjectList)):
+            self.parts.append(part)
+        else:
+            self.parts.append(ObjectList(part))
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(part.count() for part in self.parts)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    @property
+    def ranked(self):
+        """whether the order of the results should be kept when shown
+
+        that is, when all the parts producing objects are ranked.
+        """
+        ranked = [getattr(part, 'ranked', False) for part in self.parts]
+        return any(ranked) and all(r or not part.count()
+                                   for r, part in zip(ranked, self.parts))
+
+    def identities(self):
+        """the list of (class, id) pairs of the results, without duplicates"""
+        seen = set()
+        result = []
+        for part in self.parts:
+            for i in part.identities():
+                if i not in seen:
+                    seen.add(i)
+                    result.append(i)
+        return result
+
+    def pages(self, page_size=None):
+        page_size = page_size or self.page_size
+        seen = set()
+        for part in self.parts:
+            for page in part.pages(page_size):
+                page = [i for i in page if i not in seen]
+                seen.update(page)
+                if page:
+                    yield page
+
+    def __iter__(self):
+        for page in self.pages():
+            for i in page:
+                yield i
+
+
+class ResultCache(object):
+    """the results of recent searches, as lists of (class, id) pairs
+
+    entries are keyed on the search text, on the values of the prefs
+    registered with add_key_pref, which change what a search finds, and
+    on a watermark of the database: the highest id in the history table,
+    which moves at every change made through the ORM.  a repeated search on unchanged data
+    costs the watermark query and the loading of the objects, nothing
+    else.  changes not recorded in the history table (raw SQL, external
+    tools) are not noticed: `:search_cache=clear` clears the cache.
+
+    only results up to `max_results` objects are kept, larger results
+    are cheap to count again and expensive to hold.
+    """
+
+    size = 32
+    max_results = 5000
+    enabled_pref = 'bauble.search.cache_results'
+
+    def __init__(self):
+        # one cache per engine, so that no results cross databases
+        self._caches = weakref.WeakKeyDictionary()
+        self._key_prefs = set()
+        self.hits = 0
+        self.misses = 0
+
+    def add_key_pref(self, name):
+        """results depend on the value of the pref called name"""
+        self._key_prefs.add(name)
+
+    def key(self, text, session):
+        from bauble import prefs
+        return (text.strip(),
+                tuple((name, prefs.prefs.get(name, None))
+                      for name in sorted(self._key_prefs)),
+                self.watermark(session))
+
+    def enabled(self):
+        from bauble import prefs
+        return prefs.prefs.get(self.enabled_pref, True)
+
+    def watermark(self, session):
+        import datetime
+        last = session.query(func.max(db.History.id)).scalar()
+        # relative dates, as |datetime|-1|, change meaning every day
+        return last, datetime.date.today()
+
+    def _cache(self, session):
+        engine = session.get_bind().engine
+        if engine not in self._caches:
+            self._caches[engine] = utils.Cache(self.size)
+        return self._caches[engine]
+
+    def results(self, text, session, compute):
+        """the SearchResults for text, from the cache or from compute
+
+        :param compute: called on a miss, returns a SearchResults
+        """
+        cache = self._cache(session)
+        key = self.key(text, session)
+        if key in cache.storage:
+            self.hits += 1
+            identities, ranked = cache.get(key, None)
+            return SearchResults([IdentityList(session, identities, ranked)])
+        self.misses += 1
+        results = compute()
+        if results.count() > self.max_results:
+            return results
+        entry = (results.identities(), results.ranked)
+        cache.get(key, lambda: entry)
+        # the identities are fetched already, not to run the search again
+        return SearchResults([IdentityList(session, *entry)])
+
+    def clear(self):
+        self._caches.clear()
+
+
+result_cache = ResultCache()
+
+
+def _on_history_created(target, connection, **kw):
+    # a new history table restarts the watermarks
+    result_cache.clear()
+
+event.listen(db.History.__table__, 'after_create', _on_history_created)
+
+
+class SearchCancelled(BaubleError):
+    pass
+
+
+class Interrupter(object):
+    """interrupts the database statements of a search, on all connections
+
+    the sessions a search runs statements in are registered with
+    add_session, from whatever thread; cancel() interrupts the
+    statement each of their connections is running, if the database
+    driver allows it, and add_session refuses new sessions afterwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}  # id(session): DBAPI connection
+        self.cancelled = False
+
+    def add_session(self, session):
+        """register session, raise SearchCancelled if too late"""
+        connection = session.connection().connection.connection
+        with self._lock:
+            if self.cancelled:
+                raise SearchCancelled()
+            self._connections[id(session)] = connection
+
+    def remove_session(self, session):
+        """forget session, before it gives its connection back"""
+        with self._lock:
+            self._connections.pop(id(session), None)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            connections = self._connections.values()
+        for connection in connections:
+            # psycopg2 connections have cancel(), sqlite3 ones interrupt()
+            for name in ('cancel', 'interrupt'):
+                method = getattr(connection, name, None)
+                if method is not None:
+                    try:
+                        method()
+                    except Exception, e:
+                        logger.debug('cannot interrupt search: %s(%s)'
+                                     % (type(e), e))
+                    break
+
+
+class StrategyRunner(object):
+    """run the search strategies concurrently, each with its own session
+
+    every strategy produces the (class, id) pairs of its results on a
+    thread of a pool, the pairs are merged without duplicates, in the
+    order of the strategies, and the objects are loaded in the session
+    of the caller, one page at a time.  the time each strategy took is
+    kept in `timings` and added to the search profile.
+
+    in-memory databases are invisible to other connections, there the
+    strategies run one after the other, in the session of the caller.
+
+    the sessions of the strategies are registered with the Interrupter
+    of the search, if any, so that cancelling the search interrupts
+    them all.
+
+    the runner is off unless the `enabled_pref` is set: the pairs are
+    fetched by each strategy right away, so the results it produces
+    have no count(*) preflight and no lazy parts.
+    """
+
+    enabled_pref = 'bauble.search.concurrent_strategies'
+    pool_size = 4
+
+    def __init__(self):
+        self._pool = None
+        self.timings = {}
+
+    def enabled(self, session):
+        from bauble import prefs
+        if not prefs.prefs.get(self.enabled_pref, False):
+            return False
+        if len(_search_strategies) < 2:
+            return False
+        url = session.get_bind().url
+        return url.database not in (None, '', ':memory:')
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.pool_size)
+        return self._pool
+
+    @staticmethod
+    def _run(item):
+        # the identities found by one strategy, in a session of its own
+        text, name, strategy, interrupter = item
+        start = time.time()
+        session = db.Session()
+        try:
+            if interrupter is not None:
+                interrupter.add_session(session)
+            with profiler.attached():
+                identities = strategy.results(text, session).identities()
+        finally:
+            if interrupter is not None:
+                interrupter.remove_session(session)
+            session.close()
+        return name, identities, time.time() - start
+
+    def run(self, text, session, interrupter=None):
+        """the SearchResults of all strategies, for text"""
+        items = [(text, name, strategy, interrupter)
+                 for name, strategy in _search_strategies.items()]
+        seen = set()
+        identities = []
+        self.timings = {}
+        for name, found, elapsed in self.pool.map(self._run, items):
+            logger.debug('search strategy %s took %.3fs, %d results'
+                         % (name, elapsed, len(found)))
+            self.timings[name] = elapsed
+            profiler.add_time('strategy:%s' % name, elapsed)
+            for i in found:
+                if i not in seen:
+                    seen.add(i)
+                    identities.append(i)
+        return SearchResults([IdentityList(session, identities)])
+
+
+strategy_runner = StrategyRunner()
+
+
+def _search(text, session, interrupter=None):
+    if session is not None and strategy_runner.enabled(session):
+        return strategy_runner.run(text, session, interrupter)
+    results = SearchResults()
+    for strategy in _search_strategies.values():
+        logger.debug("applying search strategy %s from module %s" %
+                     (type(strategy).__name__, type(strategy).__module__))
+        results.add(strategy.results(text, session))
+    return results
+
+
+def search(text, session=None, lazy=False, interrupter=None):
+    """search text with all registered search strategies
+
+    return the list of the objects found, or, with `lazy`, a
+    SearchResults object.  results are taken from the result_cache if
+    the database did not change since the same search was last run.
+    the sessions of strategies running concurrently are registered with
+    interrupter, an Interrupter.
+    """
+    profiler.begin(text)
+    if session is not None and result_cache.enabled():
+        results = result_cache.results(
+            text, session, lambda: _search(text, session, interrupter))
+        if lazy:
+            return results
+        return list(results)
+    if lazy:
+        return _search(text, session, interrupter)
     results = set()
     for strategy in _search_strategies.values():
         logger.debug("applying search strategy %s from module %s" %
@@ -54,6 +649,29 @@ def search(text, session=None):
     return list(results)
 
 
+class ResultCacheCommandHandler(pluginmgr.CommandHandler):
+    """`:search_cache=clear` clears the search result cache
+
+    `:search_cache` tells how the cache performed.
+    """
+
+    command = 'search_cache'
+
+    def get_view(self):
+        return None
+
+    def __call__(self, cmd, arg):
+        if (arg or '').strip() == 'clear':
+            result_cache.clear()
+        utils.message_dialog(_('search result cache: %(hits)s hits, '
+                               '%(misses)s misses') %
+                             {'hits': result_cache.hits,
+                              'misses': result_cache.misses})
+
+
+pluginmgr.register_command(ResultCacheCommandHandler)
+
+
 class NoneToken(object):
     def __init__(self, t=None):
         pass
@@ -156,12 +774,21 @@ class TypedValueToken(ValueABC):
 
     def __init__(self, t):
         logger.debug('constructing typedvaluetoken %s' % str(t))
+        self._constructor = None
         try:
             constructor, converter = self.constructor[t[1]]
         except KeyError:
             return
-        params = tuple(converter(i) for i in t[3].express())
-        self.value = constructor(*params)
+        self._constructor = constructor
+        self._params = tuple(converter(i) for i in t[3].express())
+
+    @property
+    def value(self):
+        # computed on access: parsed statements are cached, and a value
+        # like |datetime|-1| must still refer to the day it is evaluated.
+        if self._constructor is None:
+            raise AttributeError('value')
+        return self._constructor(*self._params)
 
     def __repr__(self):
         return "%s" % (self.value)
@@ -196,8 +823,10 @@ class IdentifierAction(object):
                      % (cls, self.leaf, attr))
         return (query, attr)
 
-    def needs_join(self, env):
-        return self.steps
+    def clause(self, env, predicate):
+        """the predicate on the attribute, as a clause on the domain"""
+        return env.clause(self.steps,
+                          lambda cls: predicate(getattr(cls, self.leaf)))
 
 
 class FilteredIdentifierAction(object):
@@ -250,8 +879,15 @@ class FilteredIdentifierAction(object):
                      % (cls, self.leaf, attr))
         return (query, attr)
 
-    def needs_join(self, env):
-        return self.steps
+    def clause(self, env, predicate):
+        """the predicate on the attribute, as a clause on the domain
+
+        the filter and the predicate apply to the same related object.
+        """
+        value = self.filter_value.express()
+        return env.clause(self.steps, lambda cls: and_(
+            self.operation(getattr(cls, self.filter_attr), value),
+            predicate(getattr(cls, self.leaf))))
 
 
 class IdentExpression(object):
@@ -284,28 +920,24 @@ class IdentExpression(object):
     def __repr__(self):
         return "(%s %s %s)" % (self.operands[0], self.op, self.operands[1])
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        if self.operands[1].express() == set():
+    def compile(self, env):
+        value = self.operands[1].express()
+        predicate = lambda a: self.operation(a, value)
+        if value == set():
             # check against the empty set
             if self.op in ('is', '=', '=='):
-                return q.filter(~a.any())
+                predicate = lambda a: ~a.any()
             elif self.op in ('not', '<>', '!='):
-                return q.filter(a.any())
-        clause = lambda x: self.operation(a, x)
-        logger.debug('filtering on %s(%s)' % (type(a), a))
-        return q.filter(clause(self.operands[1].express()))
-
-    def needs_join(self, env):
-        return [self.operands[0].needs_join(env)]
+                predicate = lambda a: a.any()
+        return self.operands[0].clause(env, predicate)
 
 
 class ElementSetExpression(IdentExpression):
     # currently only implements `in`
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        return q.filter(a.in_(self.operands[1].express()))
+    def compile(self, env):
+        values = self.operands[1].express()
+        return self.operands[0].clause(env, lambda a: a.in_(values))
 
 
 class AggregatedExpression(IdentExpression):
@@ -320,21 +952,22 @@ class AggregatedExpression(IdentExpression):
         super(AggregatedExpression, self).__init__(t)
         logger.debug('AggregatedExpression::__init__(%s)' % t)
 
-    def evaluate(self, env):
+    def compile(self, env):
         # operands[0] is the function/identifier pair
         # operands[1] is the value against which to test
         # operation implements the clause
-        q, a = self.operands[0].identifier.evaluate(env)
-        from sqlalchemy.sql import func
+        # the ids of the domain objects satisfying the having clause,
+        # from an alias of the domain, not to be correlated to it.
+        sub = QueryEnvironment(aliased(env.domain), env.session,
+                               env.search_strategy)
+        q, a = self.operands[0].identifier.evaluate(sub)
         f = getattr(func, self.operands[0].function)
         clause = lambda x: self.operation(f(a), x)
-        # group by main ID
-        # apply having
-        main_table = q.column_descriptions[0]['type']
-        mta = getattr(main_table, 'id')
+        mta = sub.domain.id
         logger.debug('filtering on %s(%s)' % (type(mta), mta))
-        result = q.group_by(mta).having(clause(self.operands[1].express()))
-        return result
+        ids = q.with_entities(mta).group_by(mta).having(
+            clause(self.operands[1].express()))
+        return env.domain.id.in_(ids.subquery())
 
 
 class BetweenExpressionAction(object):
@@ -344,15 +977,11 @@ class BetweenExpressionAction(object):
     def __repr__(self):
         return "(BETWEEN %s %s %s)" % tuple(self.operands)
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        clause_low = lambda low: low <= a
-        clause_high = lambda high: a <= high
-        return q.filter(and_(clause_low(self.operands[1].express()),
-                             clause_high(self.operands[2].express())))
-
-    def needs_join(self, env):
-        return [self.operands[0].needs_join(env)]
+    def compile(self, env):
+        low = self.operands[1].express()
+        high = self.operands[2].express()
+        return self.operands[0].clause(
+            env, lambda a: and_(low <= a, a <= high))
 
 
 class UnaryLogical(object):
@@ -363,9 +992,6 @@ class UnaryLogical(object):
     def __repr__(self):
         return "%s %s" % (self.name, str(self.operand))
 
-    def needs_join(self, env):
-        return self.operand.needs_join(env)
-
 
 class BinaryLogical(object):
     ## abstract base class. `name` is defined in derived classes
@@ -376,39 +1002,28 @@ class BinaryLogical(object):
     def __repr__(self):
         return "(%s %s %s)" % (self.operands[0], self.name, self.operands[1])
 
-    def needs_join(self, env):
-        return self.operands[0].needs_join(env) + \
-            self.operands[1].needs_join(env)
-
 
 class SearchAndAction(BinaryLogical):
     name = 'AND'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.intersect(i.evaluate(env))
-        return result
+    def compile(self, env):
+        return and_(*[i.compile(env) for i in self.operands])
 
 
 class SearchOrAction(BinaryLogical):
     name = 'OR'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.union(i.evaluate(env))
-        return result
+    def compile(self, env):
+        return or_(*[i.compile(env) for i in self.operands])
 
 
 class SearchNotAction(UnaryLogical):
     name = 'NOT'
 
-    def evaluate(self, env):
-        q = env.session.query(env.domain)
-        for i in env.domains:
-            q.join(*i)
-        return q.except_(self.operand.evaluate(env))
+    def compile(self, env):
+        # a clause on a missing related object or a NULL column is
+        # NULL, which NOT leaves NULL: the object must still be found.
+        return not_(func.coalesce(self.operand.compile(env), false()))
 
 
 class ParenthesisedQuery(object):
@@ -418,11 +1033,73 @@ class ParenthesisedQuery(object):
     def __repr__(self):
         return "(%s)" % self.content.__repr__()
 
-    def evaluate(self, env):
-        return self.content.evaluate(env)
+    def compile(self, env):
+        return self.content.compile(env)
+
+
+class QueryEnvironment(object):
+    """the evaluation environment of a QueryAction
+
+    holds what the filter tree needs while being compiled, so that the
+    parsed statement itself is never altered and can be safely reused.
+
+    the filter tree compiles to a single clause on the domain.  paths of
+    many-to-one relationships are joined once, as LEFT OUTER JOINs on
+    an alias planned per path and shared by all the clauses following
+    it: these joins never multiply the rows of the domain.  from the
+    first to-many relationship on, a path becomes nested EXISTS
+    subqueries, so that the statement needs no DISTINCT.
+    """
 
-    def needs_join(self, env):
-        return self.content.needs_join(env)
+    def __init__(self, domain, session, search_strategy):
+        self.domain = domain
+        self.session = session
+        self.search_strategy = search_strategy
+        self.aliases = {}  # path: aliased class
+        self.joins = []  # (alias, relationship), in join order
+
+    def resolve(self, steps):
+        """the entity reached by the many-to-one steps, and the others
+
+        return the pair (entity, rest): entity is the domain or a planned
+        alias, rest the steps from the first to-many relationship on.
+        """
+        entity = self.domain
+        path = ()
+        for i, step in enumerate(steps):
+            attr = getattr(entity, step)
+            if attr.property.uselist:
+                return entity, steps[i:]
+            path += (step, )
+            if path not in self.aliases:
+                self.aliases[path] = aliased(attr.property.mapper.class_)
+                self.joins.append((self.aliases[path], attr))
+            entity = self.aliases[path]
+        return entity, []
+
+    def clause(self, steps, predicate):
+        """predicate(entity), entity being reached from the domain by steps"""
+        entity, rest = self.resolve(steps)
+        return self._exists(entity, rest, predicate)
+
+    def _exists(self, entity, steps, predicate):
+        if not steps:
+            return predicate(entity)
+        attr = getattr(entity, steps[0])
+        # a fresh alias per subquery, it can't be mistaken for a table
+        # of the enclosing query.
+        target = aliased(attr.property.mapper.class_)
+        inner = self._exists(target, steps[1:], predicate)
+        if attr.property.uselist:
+            return attr.of_type(target).any(inner)
+        return attr.of_type(target).has(inner)
+
+    def query(self, clause):
+        """the query of the domain objects satisfying clause"""
+        query = self.session.query(self.domain)
+        for alias, attr in self.joins:
+            query = query.outerjoin(alias, attr)
+        return query.filter(clause)
 
 
 class QueryAction(object):
@@ -446,31 +1123,42 @@ class QueryAction(object):
         logger.debug('QueryAction:invoke - %s(%s) %s(%s)' %
                      (type(self.domain), self.domain,
                       type(self.filter), self.filter))
-        domain = self.domain
-        check(domain in search_strategy._domains or
-              domain in search_strategy._shorthand,
-              'Unknown search domain: %s' % domain)
-        self.domain = search_strategy._shorthand.get(domain, domain)
-        self.domain = search_strategy._domains[domain][0]
-        self.search_strategy = search_strategy
+        env = self.environment(search_strategy)
 
         result = set()
-        if search_strategy._session is not None:
-            self.domains = self.filter.needs_join(self)
-            self.session = search_strategy._session
-            records = self.filter.evaluate(self).all()
-            result.update(records)
+        if env.session is not None:
+            result.update(self.query(env).options(
+                *eager_options(env.domain)).all())
 
         if None in result:
             logger.warn('removing None from result set')
             result = set(i for i in result if i is not None)
         return result
 
+    def environment(self, search_strategy):
+        domain = self.domain
+        check(domain in search_strategy._domains or
+              domain in search_strategy._shorthand,
+              'Unknown search domain: %s' % domain)
+        domain = search_strategy._shorthand.get(domain, domain)
+        return QueryEnvironment(search_strategy._domains[domain][0],
+                                search_strategy._session, search_strategy)
+
+    def query(self, env):
+        return env.query(self.filter.compile(env))
+
+    def results(self, search_strategy):
+        env = self.environment(search_strategy)
+        if env.session is None:
+            return SearchResults()
+        return SearchResults([QueryPart(self.query(env), distinct=False)])
+
 
 class StatementAction(object):
     def __init__(self, t):
         self.content = t[0]
         self.invoke = lambda x: self.content.invoke(x)
+        self.results = lambda x: self.content.results(x)
 
     def __repr__(self):
         return repr(self.content)
@@ -489,20 +1177,27 @@ class BinomialNameAction(object):
     def __repr__(self):
         return "%s %s" % (self.genus_epithet, self.species_epithet)
 
+    def query(self, search_strategy):
+        # a range scan on the indexed, normalized species.binomial_key,
+        # which also covers the `Genus sp` case (sp in infrasp1).
+        from bauble.plugins.plants.species import Species
+        from bauble.plugins.plants.species_model import binomial_clause
+        return search_strategy._session.query(Species).filter(
+            binomial_clause(self.genus_epithet, self.species_epithet))
+
     def invoke(self, search_strategy):
         logger.debug('BinomialNameAction:invoke')
-        from bauble.plugins.plants.genus import Genus
         from bauble.plugins.plants.species import Species
-        result = search_strategy._session.query(Species).filter(
-            or_(Species.sp.startswith(self.species_epithet),
-                and_(self.species_epithet == u'sp', Species.infrasp1 == u'sp'))).join(Genus).filter(
-            Genus.genus.startswith(self.genus_epithet)).all()
-        result = set(result)
+        result = set(self.query(search_strategy).options(
+            *eager_options(Species)).all())
         if None in result:
             logger.warn('removing None from result set')
             result = set(i for i in result if i is not None)
         return result
 
+    def results(self, search_strategy):
+        return SearchResults([self.query(search_strategy)])
+
 
 class DomainExpressionAction(object):
     """created when the parser hits a domain_expression token.
@@ -511,7 +1206,7 @@ class DomainExpressionAction(object):
     explicit query. you give a domain, a binary_operator and a value,
     the domain expression will return all object with at least one
     property (as passed to add_meta) matching (according to the binop)
-    the value.
+    the value.  the matching objects are returned as a list, ordered by id.
     """
 
     def __init__(self, t):
@@ -522,14 +1217,12 @@ class DomainExpressionAction(object):
     def __repr__(self):
         return "%s %s %s" % (self.domain, self.cond, self.values)
 
-    def invoke(self, search_strategy):
-        logger.debug('DomainExpressionAction:invoke')
+    def query(self, search_strategy):
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
         try:
-            if self.domain in search_strategy._shorthand:
-                self.domain = search_strategy._shorthand[self.domain]
-            cls, properties = search_strategy._domains[self.domain]
+            cls, properties = search_strategy._domains[domain]
         except KeyError:
-            raise KeyError(_('Unknown search domain: %s') % self.domain)
+            raise KeyError(_('Unknown search domain: %s') % domain)
 
         query = search_strategy._session.query(cls)
 
@@ -537,12 +1230,9 @@ class DomainExpressionAction(object):
         ## domain values. each domain class should define its own 'I have
         ## accessions' filter. see issue #42
 
-        result = set()
-
         # select all objects from the domain
         if self.values == '*':
-            result.update(query.all())
-            return result
+            return query
 
         mapper = class_mapper(cls)
 
@@ -550,6 +1240,9 @@ class DomainExpressionAction(object):
             condition = lambda col: \
                 lambda val: utils.ilike(mapper.c[col], '%s' % val)
         elif self.cond in ('contains', 'icontains', 'has', 'ihas'):
+            indexed = fulltext_clause(cls, self.values.express())
+            if indexed is not None:
+                return query.filter(indexed)
             condition = lambda col: \
                 lambda val: utils.ilike(mapper.c[col], '%%%s%%' % val)
         elif self.cond == '=':
@@ -559,15 +1252,27 @@ class DomainExpressionAction(object):
             condition = lambda col: \
                 lambda val: mapper.c[col].op(self.cond)(val)
 
-        for col in properties:
-            ors = or_(*map(condition(col), self.values.express()))
-            result.update(query.filter(ors).all())
+        # a single statement, OR-ing all columns against all values, so
+        # that each matching row is fetched and hydrated only once.
+        values = self.values.express()
+        ors = or_(*[condition(col)(val)
+                    for col in properties for val in values])
+        return query.filter(ors)
+
+    def invoke(self, search_strategy):
+        logger.debug('DomainExpressionAction:invoke')
+        query = self.query(search_strategy)
+        cls = query.column_descriptions[0]['type']
+        result = query.options(*eager_options(cls)).order_by(cls.id).all()
 
         if None in result:
             logger.warn('removing None from result set')
-            result = set(i for i in result if i is not None)
+            result = [i for i in result if i is not None]
         return result
 
+    def results(self, search_strategy):
+        return SearchResults([self.query(search_strategy)])
+
 
 class AggregatingAction(object):
 
@@ -579,9 +1284,6 @@ class AggregatingAction(object):
     def __repr__(self):
         return "(%s %s)" % (self.function, self.identifier)
 
-    def needs_join(self, env):
-        return [self.identifier.needs_join(env)]
-
     def evaluate(self, env):
         """return pair (query, attribute)
 
@@ -607,22 +1309,24 @@ class ValueListAction(object):
     def express(self):
         return [i.express() for i in self.values]
 
-    def invoke(self, search_strategy):
-        """
-        Called when the whole search string is a value list.
+    def statement(self, search_strategy):
+        """the statement selecting the objects matching the values
 
-        Search with a list of values is the broadest search and
-        searches all the mapper and the properties configured with
-        add_meta()
+        return the pair (statement, classes): the statement produces
+        (tag, id) pairs, tag being the index in classes of the class of
+        the matching object.  statement is None if there is nothing to
+        search.
         """
 
-        logger.debug('ValueListAction:invoke')
         # make searches case-insensitive, in postgres use ilike,
         # in other use upper()
         like = lambda table, col, val: \
             utils.ilike(table.c[col], ('%%%s%%' % val))
 
-        result = set()
+        # one SELECT per domain class, each producing (class_tag, id)
+        # pairs, all glued in a single UNION ALL statement.
+        classes = []
+        selects = []
         for cls, columns in search_strategy._properties.iteritems():
             column_cross_value = [(c, v) for c in columns
                                   for v in self.express()]
@@ -638,26 +1342,51 @@ class ValueListAction(object):
                     return v
 
             table = class_mapper(cls)
-            q = search_strategy._session.query(cls)  # prepares SELECT
-            q = q.filter(or_(*[like(table, c, unicol(c, v))
-                               for c, v in column_cross_value]))
-            result.update(q.all())
-
-        def replace(i):
-            try:
-                replacement = i.replacement()
-                logger.debug('replacing %s by %s in result set' %
-                             (i, replacement))
-                return replacement
-            except:
-                return i
-        result = set([replace(i) for i in result])
+            clause = fulltext_clause(cls, self.express())
+            if clause is None:
+                clause = or_(*[like(table, c, unicol(c, v))
+                               for c, v in column_cross_value])
+            tag = literal_column('%d' % len(classes), Integer)
+            selects.append(
+                select([tag.label('tag'), table.c['id'].label('id')]).where(
+                    clause))
+            classes.append(cls)
+
+        if not selects:
+            return None, classes
+        if len(selects) == 1:
+            return selects[0], classes
+        return union_all(*selects), classes
+
+    def identities(self, search_strategy):
+        """the (class, id) pairs of the objects matching the values"""
+        statement, classes = self.statement(search_strategy)
+        return StatementPart(search_strategy._session,
+                             statement, classes).identities()
+
+    def invoke(self, search_strategy):
+        """
+        Called when the whole search string is a value list.
+
+        Search with a list of values is the broadest search and
+        searches all the mapper and the properties configured with
+        add_meta(), through the full-text index where this exists.
+        """
+
+        logger.debug('ValueListAction:invoke')
+        result = set(load_identities(search_strategy._session,
+                                     self.identities(search_strategy)))
         logger.debug("result is now %s" % result)
         if None in result:
             logger.warn('removing None from result set')
             result = set(i for i in result if i is not None)
         return result
 
+    def results(self, search_strategy):
+        statement, classes = self.statement(search_strategy)
+        return SearchResults([StatementPart(search_strategy._session,
+                                            statement, classes)])
+
 
 from pyparsing import (
     Word, alphas8bit, removeQuotes, delimitedList, Regex,
@@ -671,8 +1400,16 @@ wordStart, wordEnd = WordStart(), WordEnd()
 
 class SearchParser(object):
     """The parser for bauble.search.MapperSearch
+
+    parsed statements are kept in a bounded LRU cache, keyed on the
+    stripped text, so that repeating a search does not parse it again.
+    the statement actions never alter themselves while being invoked,
+    which is what makes sharing them safe.
     """
 
+    cache_size = 64
+    _lock = threading.Lock()
+
     numeric_value = Regex(
         r'[-]?\d+(\.\d*)?([eE]\d+)?'
         ).setParseAction(NumericToken)('number')
@@ -762,15 +1499,58 @@ class SearchParser(object):
                  | value_list('value_list')
                  ).setParseAction(StatementAction)('statement')
 
+    def __init__(self):
+        self.cache = utils.Cache(self.cache_size)
+        self.hits = 0
+        self.misses = 0
+
     def parse_string(self, text):
         '''request pyparsing object to parse text
 
         `text` can be either a query, or a domain expression, or a list of
         values. the `self.statement` pyparsing object parses the input text
         and return a pyparsing.ParseResults object that represents the input
+
+        the result comes from the parse cache if the same text was
+        recently parsed. it must be treated as read-only.
         '''
 
-        return self.statement.parseString(text)
+        text = text.strip()
+
+        def on_hit(value):
+            self.hits += 1
+
+        def parse():
+            self.misses += 1
+            return self.statement.parseString(text)
+
+        # strategies may be running concurrently, and the pyparsing
+        # packrat cache is global.
+        with self._lock:
+            return self.cache.get(text, parse, on_hit)
+
+    def cache_info(self):
+        """return the parse cache counters, as a dictionary"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache.storage),
+                'maxsize': self.cache.size}
+
+    def clear_cache(self):
+        """empty the parse cache and reset its counters"""
+        self.cache.storage.clear()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def enable_packrat():
+        """switch on pyparsing packrat mode
+
+        packrat memoizes intermediate parse results, which speeds up the
+        infixNotation part of the grammar considerably.  it is a global
+        pyparsing setting, so it affects all parsers in the process.
+        """
+        from pyparsing import ParserElement
+        ParserElement.enablePackrat()
 
 
 class SearchStrategy(object):
@@ -789,6 +1569,17 @@ class SearchStrategy(object):
         logger.debug('SearchStrategy "%s"(%s)' % (text, self.__class__.__name__))
         pass
 
+    def results(self, text, session=None):
+        '''
+        :param text: the search string
+        :param session: the session to use for the search
+
+        Return a SearchResults object.  Strategies that can avoid
+        loading all objects up front should override this, the default
+        wraps the objects returned by search().
+        '''
+        return SearchResults([self.search(text, session)])
+
 
 class MapperSearch(SearchStrategy):
 
@@ -805,13 +1596,27 @@ class MapperSearch(SearchStrategy):
     _domains = {}
     _shorthand = {}
     _properties = {}
+    _eager = {}
+    _fallbacks = {}
+
+    packrat_pref = 'bauble.search.packrat'
 
     def __init__(self):
         super(MapperSearch, self).__init__()
-        self._results = set()
+        self._local = threading.local()
         self.parser = SearchParser()
 
-    def add_meta(self, domain, cls, properties):
+    @property
+    def _session(self):
+        # the session of the search running in this thread, the one the
+        # statement actions query.
+        return getattr(self._local, 'session', None)
+
+    @_session.setter
+    def _session(self, session):
+        self._local.session = session
+
+    def add_meta(self, domain, cls, properties, eager=None):
         """Add a domain to the search space
 
         an example of domain is a database table, where the properties would
@@ -825,6 +1630,9 @@ class MapperSearch(SearchStrategy):
         :param cls: the class the domain will resolve to
         :param properties: a list of string names of the properties to
                            search by default
+        :param eager: a list of dotted relation paths, like 'genus.family',
+                      to be loaded together with the search results, as
+                      needed to show them.  see eager_options().
         """
 
         logger.debug('%s.add_meta(%s, %s, %s)' %
@@ -843,6 +1651,32 @@ class MapperSearch(SearchStrategy):
         else:
             self._domains[domain] = cls, properties
         self._properties[cls] = properties
+        if eager:
+            self._eager[cls] = eager
+
+    def add_fallback(self, strategy):
+        """search with strategy when a value search finds nothing
+
+        value and binomial searches are the ones users type names in, a
+        fallback strategy can propose what they may have meant.
+        """
+        self._fallbacks[type(strategy).__name__] = strategy
+
+    def _fall_back(self, statement, found, text, session, lazy):
+        # the results of the fallback strategies, or found
+        if not self._fallbacks or not isinstance(
+                statement, (ValueListAction, BinomialNameAction)):
+            return found
+        if (found.count() if lazy else found):
+            return found
+        results = SearchResults() if lazy else set()
+        for strategy in self._fallbacks.values():
+            logger.debug('falling back on %s' % type(strategy).__name__)
+            if lazy:
+                results.add(strategy.results(text, session))
+            else:
+                results.update(strategy.search(text, session))
+        return results
 
     @classmethod
     def get_domain_classes(cls):
@@ -851,9 +1685,14 @@ class MapperSearch(SearchStrategy):
             d.setdefault(domain, item[0])
         return d
 
-    def search(self, text, session=None):
+    def search(self, text, session=None, lazy=False):
         """
         Returns a set() of database hits for the text search string.
+        The set does not keep the order of the statement.
+
+        With `lazy`, returns a SearchResults object instead: nothing is
+        loaded until the results are counted or iterated, and they come
+        in the order of the statement, by id.
 
         If session=None then the session should be closed after the results
         have been processed or it is possible that some database backends
@@ -861,16 +1700,25 @@ class MapperSearch(SearchStrategy):
         """
         super(MapperSearch, self).search(text, session)
         self._session = session
+        from bauble import prefs
+        if prefs.prefs.get(self.packrat_pref, False):
+            SearchParser.enable_packrat()
 
-        self._results.clear()
+        start = time.time()
         statement = self.parser.parse_string(text.decode()).statement
+        profiler.add_time('parse', time.time() - start)
         logger.debug("statement : %s(%s)" % (type(statement), statement))
-        self._results.update(statement.invoke(self))
-        logger.debug('search returns %s(%s)'
-                     % (type(self._results), self._results))
+        if lazy:
+            return self._fall_back(statement, statement.results(self),
+                                   text, session, lazy)
+
+        results = set(self._fall_back(
+            statement, statement.invoke(self), text, session, lazy))
+        logger.debug('search returns %s(%s)' % (type(results), results))
+        return results
 
-        # these _results get filled in when the parse actions are called
-        return self._results
+    def results(self, text, session=None):
+        return self.search(text, session, lazy=True)
 
 
 ## list of search strategies to be tried on each search string
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Search-as-you-type suggestions for the main search entry.
+
+The PrefixIndex holds the values of all columns registered with
+MapperSearch.add_meta, lowercased and sorted: the flattened form of a
+prefix trie, where the completions of a prefix are the consecutive keys
+found by bisection.  This keeps lookups well below a millisecond, with
+a fraction of the memory a trie of dictionaries would take.
+
+The index is built on a worker thread the first time suggestions are
+asked for, and refreshed from the rows of the history table added since
+the last refresh, rather than rebuilt.  Its estimated size is kept
+within the budget set by the `bauble.search.suggestions_budget` pref, in
+kilobytes, counting the values and the rows remembered with them: rows
+not fitting are left out, and the build reads the rows a page at a time
+until the budget is spent.
+"""
+
+import bisect
+import sys
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+from bauble import prefs
+
+# the estimated cost of a dictionary entry, and of a list slot with one
+_entry_overhead = 3 * 8 * 2
+_overhead = 8 + _entry_overhead
+
+
+class PrefixIndex(object):
+    """the searched values, by prefix
+
+    the values are stored lowercased, in a sorted list, and counted by
+    the rows having them.  every row is remembered with its values, so
+    that a change can be applied by only looking at the new row; the
+    rows count in the size of the index as the values do.
+    """
+
+    budget_pref = 'bauble.search.suggestions_budget'
+    refresh_interval = 5
+    chunk_size = 500
+    page_size = 1000
+
+    def __init__(self, budget=None):
+        self._budget = budget
+        self._lock = threading.Lock()
+        self._clear()
+        self.engine = None
+        self.worker = None
+        self.last_refresh = 0
+
+    def _clear(self):
+        self._keys = []
+        self._values = {}  # key: [value, count]
+        self._rows = {}  # (table name, id): values
+        self.size = 0
+        self._limit = 0
+        self.truncated = False
+        self.watermark = None
+
+    @property
+    def budget(self):
+        """the memory budget, in bytes"""
+        budget = self._budget
+        if budget is None:
+            budget = prefs.prefs.get(self.budget_pref, 8192)
+        return budget * 1024
+
+    def __len__(self):
+        return len(self._keys)
+
+    ## the index proper, called holding the lock
+
+    def _add(self, value, bulk=False):
+        # the value as stored, shared by the rows having it, or None
+        key = value.lower()
+        entry = self._values.get(key)
+        if entry is not None:
+            entry[1] += 1
+            return entry[0]
+        cost = sys.getsizeof(key) + sys.getsizeof(value) + _overhead
+        if self.size + cost > self._limit:
+            self.truncated = True
+            return None
+        self._values[key] = [value, 1]
+        if bulk:
+            # the caller sorts the keys when done
+            self._keys.append(key)
+        else:
+            bisect.insort(self._keys, key)
+        self.size += cost
+        return value
+
+    def _discard(self, value):
+        key = value.lower()
+        entry = self._values.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del self._values[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self.size -= sys.getsizeof(key) + sys.getsizeof(value) + _overhead
+
+    @staticmethod
+    def _row_cost(row_key, values):
+        return (sys.getsizeof(row_key) + sys.getsizeof(row_key[1]) +
+                sys.getsizeof(values) + _entry_overhead)
+
+    def _set_row(self, table_name, id, values, bulk=False):
+        row_key = (table_name, id)
+        old = self._rows.pop(row_key, None)
+        if old is not None:
+            self.size -= self._row_cost(row_key, old)
+            for value in old:
+                self._discard(value)
+        if not values:
+            return
+        # the row is paid for before its values, its tuple can only
+        # get shorter.
+        reserved = self._row_cost(row_key, tuple(values))
+        if self.size + reserved > self._limit:
+            self.truncated = True
+            return
+        self.size += reserved
+        values = tuple(v for v in (self._add(v, bulk) for v in values)
+                       if v is not None)
+        self.size -= reserved
+        if values:
+            self._rows[row_key] = values
+            self.size += self._row_cost(row_key, values)
+
+    def complete(self, prefix, limit=10):
+        """the indexed values starting with prefix, in alphabetic order"""
+        prefix = prefix.lower()
+        result = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, prefix)
+            while len(result) < limit and i < len(self._keys):
+                key = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                result.append(self._values[key][0])
+                i += 1
+        return result
+
+    ## reading the database
+
+    @staticmethod
+    def _tables():
+        from bauble.search import MapperSearch
+        for cls, properties in MapperSearch._properties.items():
+            table = class_mapper(cls).local_table
+            yield table, [table.c[p] for p in properties]
+
+    @staticmethod
+    def _values_of(row):
+        # the non empty text values of a row, but its id
+        for value in list(row)[1:]:
+            if value is None:
+                continue
+            value = unicode(value).strip()
+            if value:
+                yield value
+
+    @staticmethod
+    def _watermark(connection):
+        history = db.History.__table__
+        return connection.execute(
+            sa.select([sa.func.max(history.c.id)])).scalar() or 0
+
+    def _pages(self, connection, table, columns):
+        # the rows of table, page_size at a time, in the order of their id
+        last = None
+        while True:
+            query = sa.select([table.c.id] + columns).order_by(
+                table.c.id).limit(self.page_size)
+            if last is not None:
+                query = query.where(table.c.id > last)
+            rows = connection.execute(query).fetchall()
+            if rows:
+                yield rows
+                last = rows[-1][0]
+            if len(rows) < self.page_size:
+                break
+
+    def build(self, connection):
+        """index all searched values, from scratch
+
+        the rows are read one page at a time, and no more once the
+        budget is exhausted.  the index is built apart and replaces the
+        current one when complete.
+        """
+        watermark = self._watermark(connection)
+        index = type(self)(self._budget)
+        index._limit = self.budget
+        for table, columns in self._tables():
+            for rows in self._pages(connection, table, columns):
+                for row in rows:
+                    index._set_row(table.name, row[0],
+                                   list(self._values_of(row)), bulk=True)
+                if index.truncated:
+                    break
+            if index.truncated:
+                break
+        index._keys.sort()
+        with self._lock:
+            self._keys = index._keys
+            self._values = index._values
+            self._rows = index._rows
+            self.size = index.size
+            self._limit = index._limit
+            self.truncated = index.truncated
+            self.watermark = watermark
+        if self.truncated:
+            logger.info('suggestions index over budget, %d rows indexed'
+                        % len(self._rows))
+
+    def refresh(self, connection):
+        """apply the changes recorded in the history since the last time"""
+        if self.watermark is None:
+            return self.build(connection)
+        history = db.History.__table__
+        watermark = self._watermark(connection)
+        if watermark < self.watermark:
+            # the history was cleared, we don't know what changed
+            return self.build(connection)
+        changed = {}
+        for table_name, id in connection.execute(
+                sa.select([history.c.table_name, history.c.table_id]).where(
+                    history.c.id > self.watermark)):
+            changed.setdefault(table_name, set()).add(id)
+        rows = []
+        for table, columns in self._tables():
+            ids = list(changed.get(table.name, ()))
+            for i in range(0, len(ids), self.chunk_size):
+                chunk = ids[i:i + self.chunk_size]
+                found = dict(
+                    (row[0], list(self._values_of(row)))
+                    for row in connection.execute(
+                        sa.select([table.c.id] + columns).where(
+                            table.c.id.in_(chunk))))
+                # rows not found have been deleted
+                rows.extend((table.name, id, found.get(id, []))
+                            for id in chunk)
+        with self._lock:
+            self._limit = self.budget
+            for table_name, id, values in rows:
+                self._set_row(table_name, id, values)
+            self.watermark = watermark
+        logger.debug('suggestions refreshed, %d rows changed' % len(rows))
+
+    ## keeping up with the database
+
+    def _run(self, engine):
+        try:
+            with engine.connect() as connection:
+                if engine is self.engine:
+                    self.refresh(connection)
+                else:
+                    self.engine = engine
+                    self.build(connection)
+        except Exception, e:
+            logger.warning('cannot update the suggestions: %s(%s)'
+                           % (type(e), e))
+
+    def update(self):
+        """build or refresh the index, on a worker thread
+
+        nothing happens if the index was refreshed a short while ago, or
+        is still being updated.  in-memory databases are invisible to
+        other connections, their index is updated right away.
+        """
+        engine = db.engine
+        if engine is None:
+            return
+        if self.worker is not None and self.worker.is_alive():
+            return
+        now = time.time()
+        if (engine is self.engine and
+                now - self.last_refresh < self.refresh_interval):
+            return
+        self.last_refresh = now
+        if engine.url.database in (None, '', ':memory:'):
+            self._run(engine)
+            return
+        self.worker = threading.Thread(target=self._run, args=(engine, ))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def suggest(self, prefix, limit=10):
+        """the completions of prefix, updating the index for the next time
+
+        the suggestions come from the index as it is, possibly empty
+        while it is first built.
+        """
+        self.update()
+        return self.complete(prefix, limit)
+
+
+suggestions = PrefixIndex()
@@ -24,6 +24,7 @@ import bauble.plugins.garden.accession
 
 from bauble import db
 from bauble import prefs
+from bauble import utils
 prefs.testing = True
 
 db.sqlalchemy_debug(True)
@@ -36,3 +37,34 @@ class GlobalFunctionsTests(BaubleTestCase):
         self.assertEquals(db.class_of_object("accession_note"),
                           bauble.plugins.garden.accession.AccessionNote)
         self.assertEquals(db.class_of_object("not_existing"), None)
+
+
+class HistoryIndexesTests(BaubleTestCase):
+
+    def test_ensure_history_indexes(self):
+        self.assertEquals(db.ensure_history_indexes(), [])
+        db.engine.execute('DROP INDEX ix_history_user_timestamp')
+        self.assertEquals(db.ensure_history_indexes(),
+                          ['ix_history_user_timestamp'])
+        self.assertEquals(db.ensure_history_indexes(), [])
+
+
+class NatsortKeysTests(BaubleTestCase):
+
+    def test_edit_not_flushed(self):
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        from bauble.plugins.plants.species import Species
+        genus = Genus(family=Family(family=u'Araceae'), genus=u'Anthurium')
+        species = Species(genus=genus, sp=u'andraeanum')
+        self.session.add(species)
+        self.session.commit()
+        key = utils.natsort_key(species)
+        genus_key = utils.natsort_key(genus)
+        self.assertEquals(utils.natsort_key(species), key)
+        species.sp = u'scherzerianum'
+        self.assertTrue(self.session.dirty)
+        self.assertNotEquals(utils.natsort_key(species), key)
+        # only the edited object is forgotten
+        self.assertTrue(genus in utils._natsort_keys)
+        self.assertEquals(utils.natsort_key(genus), genus_key)
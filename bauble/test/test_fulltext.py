@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_fulltext.py
+#
+from nose import SkipTest
+
+import bauble.search as search
+import bauble.fulltext as fulltext
+from bauble.test import BaubleTestCase
+
+
+class FullTextIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(FullTextIndexTests, self).setUp()
+        if not fulltext.is_supported():
+            raise SkipTest('no full-text support in this database')
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family, self.Genus = Family, Genus
+        self.family = Family(family=u'Rubiaceae')
+        self.genus = Genus(family=self.family, genus=u'Ixora')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        fulltext.create_index()
+
+    def tearDown(self):
+        fulltext.drop_index()
+        super(FullTextIndexTests, self).tearDown()
+
+    def test_index_created_for_registered_classes(self):
+        self.assertTrue(fulltext.has_index(self.Family))
+        self.assertTrue(fulltext.has_index(self.Genus))
+        self.assertTrue('fts_genus' in fulltext.existing_indexes())
+
+    def test_value_search_uses_index(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('ixo', self.session)
+        self.assertEquals(results, set([self.genus]))
+        # the index matches the start of words
+        results = mapper_search.search('xora', self.session)
+        self.assertEquals(results, set())
+
+    def test_contains_uses_index(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('genus contains Ixo', self.session)
+        self.assertEquals(results, set([self.genus]))
+        results = mapper_search.search('family contains Rubi, Ixo',
+                                       self.session)
+        self.assertEquals(results, set([self.family]))
+
+    def test_index_follows_changes(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        genus = self.Genus(family=self.family, genus=u'Coffea')
+        self.session.add(genus)
+        self.session.commit()
+        self.assertEquals(mapper_search.search('coff', self.session),
+                          set([genus]))
+        genus.genus = u'Pentas'
+        self.session.commit()
+        self.assertEquals(mapper_search.search('coff', self.session), set())
+        self.assertEquals(mapper_search.search('pent', self.session),
+                          set([genus]))
+        self.session.delete(genus)
+        self.session.commit()
+        self.assertEquals(mapper_search.search('pent', self.session), set())
+
+    def test_words_in_any_order(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        genus = self.Genus(family=self.family, genus=u'Ixora coccinea')
+        self.session.add(genus)
+        self.session.commit()
+        for text in ('genus contains "ixora coc"',
+                     'genus contains "coc ixo"'):
+            self.assertEquals(mapper_search.search(text, self.session),
+                              set([genus]))
+        self.assertEquals(
+            mapper_search.search('genus contains "ixora pen"', self.session),
+            set())
+
+    def test_wildcards_fall_back_to_like(self):
+        self.assertTrue(fulltext.match_clause(self.Genus, [u'Ix%']) is None)
+        self.assertTrue(fulltext.match_clause(self.Genus, [1.0]) is None)
+        self.assertTrue(
+            fulltext.match_clause(self.Genus, [u'Ix']) is not None)
+
+    def test_drop_index(self):
+        fulltext.drop_index()
+        self.assertFalse(fulltext.has_index(self.Genus))
+        self.assertTrue(fulltext.match_clause(self.Genus, [u'Ix']) is None)
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('xora', self.session)
+        self.assertEquals(results, set([self.genus]))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_fuzzy.py
+#
+from unittest import TestCase
+
+import bauble.search as search
+import bauble.fuzzy as fuzzy
+from bauble.test import BaubleTestCase
+
+
+class PhoneticKeyTests(TestCase):
+
+    def test_spelling_variants(self):
+        self.assertEquals(fuzzy.phonetic_key(u'andreanum'),
+                          fuzzy.phonetic_key(u'andraeanum'))
+        self.assertEquals(fuzzy.phonetic_key(u'Anthurium andreanum'),
+                          fuzzy.phonetic_key(u'anthurium Andraeanum'))
+        self.assertEquals(fuzzy.phonetic_key(u'Philodendron'),
+                          fuzzy.phonetic_key(u'Filodendron'))
+
+    def test_gender_endings(self):
+        self.assertEquals(fuzzy.phonetic_key(u'coccineus'),
+                          fuzzy.phonetic_key(u'coccinea'))
+
+    def test_accents_dropped(self):
+        self.assertEquals(fuzzy.phonetic_key(u'Rubiacées'),
+                          fuzzy.phonetic_key(u'Rubiacees'))
+
+    def test_different_names(self):
+        self.assertNotEquals(fuzzy.phonetic_key(u'Ixora'),
+                             fuzzy.phonetic_key(u'Pentas'))
+
+    def test_ngrams(self):
+        self.assertEquals(fuzzy.ngrams(u'Ixo'),
+                          set([u'  i', u' ix', u'ixo', u'xo ']))
+        self.assertEquals(fuzzy.ngrams(u''), set())
+
+
+class FuzzySearchTests(BaubleTestCase):
+
+    def setUp(self):
+        super(FuzzySearchTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        from bauble.plugins.plants.species import Species
+        self.Genus, self.Species = Genus, Species
+        self.family = Family(family=u'Araceae')
+        self.genus = Genus(family=self.family, genus=u'Anthurium')
+        self.species = Species(genus=self.genus, sp=u'andraeanum')
+        self.session.add_all([self.family, self.genus, self.species])
+        self.session.commit()
+        fuzzy.create_index()
+
+    def tearDown(self):
+        fuzzy.drop_index()
+        super(FuzzySearchTests, self).tearDown()
+
+    def test_index_created(self):
+        self.assertTrue(fuzzy.has_index())
+        # family, genus, species epithet and binomial
+        self.assertEquals(fuzzy.create_index(), 4)
+
+    def test_matches_ranked(self):
+        matches = fuzzy.matches(self.session, u'Anthurium andreanum')
+        self.assertEquals(matches[0][:2], (self.Species, self.species.id))
+        matches = fuzzy.matches(self.session, u'Antherium')
+        self.assertEquals(matches[0][:2], (self.Genus, self.genus.id))
+
+    def test_fallback_on_misspelled_names(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('Anthurium andreanum', self.session)
+        self.assertTrue(self.species in results)
+        results = mapper_search.search('andreanum', self.session)
+        self.assertTrue(self.species in results)
+        results = mapper_search.search('andreanum', self.session, lazy=True)
+        self.assertTrue(self.species in list(results))
+
+    def test_fallback_keeps_rank_order(self):
+        fuzzy_search = fuzzy.FuzzySearch()
+        ranked = [(cls, id) for cls, id, score in
+                  fuzzy.matches(self.session, u'Antherium')]
+        self.assertEquals([(type(i), i.id) for i in
+                           fuzzy_search.search(u'Antherium', self.session)],
+                          ranked)
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('Antherium', self.session, lazy=True)
+        self.assertTrue(results.ranked)
+        self.assertEquals(results.identities(), ranked)
+        search.result_cache.clear()
+        for i in range(2):
+            # computed, then taken from the result cache
+            results = search.search('Antherium', self.session, lazy=True)
+            self.assertTrue(results.ranked)
+            self.assertEquals(results.identities(), ranked)
+
+    def test_no_fallback_when_found(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('andraeanum', self.session)
+        self.assertEquals(results, set([self.species]))
+
+    def test_no_fallback_for_domain_searches(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('genus=Antherium', self.session)
+        self.assertEquals(results, set())
+
+    def test_index_follows_changes(self):
+        genus = self.Genus(family=self.family, genus=u'Philodendron')
+        self.session.add(genus)
+        self.session.commit()
+        ids = [i[1] for i in fuzzy.matches(self.session, u'Filodendron')]
+        self.assertTrue(genus.id in ids)
+        genus.genus = u'Monstera'
+        self.session.commit()
+        ids = [i[1] for i in fuzzy.matches(self.session, u'Filodendron')]
+        self.assertFalse(genus.id in ids)
+        self.session.delete(genus)
+        self.session.commit()
+        self.assertEquals(fuzzy.matches(self.session, u'Monstera'), [])
+
+    def test_genus_rename_reaches_binomial(self):
+        self.genus.genus = u'Philodendron'
+        self.session.commit()
+        matches = fuzzy.matches(self.session, u'Filodendron andreanum')
+        self.assertEquals(matches[0][:2], (self.Species, self.species.id))
+
+    def test_no_index_no_matches(self):
+        fuzzy.drop_index()
+        self.assertEquals(fuzzy.matches(self.session, u'Antherium'), [])
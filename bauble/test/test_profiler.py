@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_profiler.py
+#
+import json
+
+import bauble.search as search
+from bauble.profiler import profiler
+from bauble.test import BaubleTestCase
+
+
+class SearchProfilerTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SearchProfilerTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.family = Family(family=u'family1')
+        self.genus = Genus(family=self.family, genus=u'genus1')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        self.session.expunge_all()
+        search.result_cache.clear()
+        profiler.profiles.clear()
+
+    def tearDown(self):
+        profiler.disable()
+        super(SearchProfilerTests, self).tearDown()
+
+    def test_disabled_records_nothing(self):
+        search.search('genus1', self.session)
+        self.assertEquals(len(profiler.profiles), 0)
+
+    def test_search_is_profiled(self):
+        profiler.enable()
+        results = search.search('genus1', self.session)
+        self.assertEquals(len(profiler.profiles), 1)
+        profile = profiler.profiles[-1]
+        self.assertEquals(profile.text, 'genus1')
+        self.assertTrue(profile.times['parse'] > 0)
+        self.assertTrue(len(profile.statements) > 0)
+        self.assertEquals(
+            sum(s['objects'] for s in profile.statements),
+            len(profile.fetched))
+        profiler.shown(results[0])
+        d = profile.as_dict()
+        self.assertEquals(d['shown'], 1)
+        self.assertEquals(d['fetched_not_shown'], d['fetched'] - 1)
+
+    def test_json_dump(self):
+        profiler.enable()
+        search.search('genus1', self.session)
+        search.search('family1', self.session)
+        dumped = json.loads(profiler.as_json())
+        self.assertEquals([d['text'] for d in dumped], ['genus1', 'family1'])
+        self.assertEquals(dumped[0]['statement_count'],
+                          len(dumped[0]['statements']))
+
+    def test_other_threads_not_profiled(self):
+        import threading
+        import bauble.db as db
+        profiler.enable()
+        search.search('genus1', self.session)
+        profile = profiler.profiles[-1]
+        count = len(profile.statements)
+
+        def unrelated():
+            db.engine.execute('SELECT 1')
+
+        def attached():
+            with profiler.attached():
+                db.engine.execute('SELECT 2')
+        for target in (unrelated, attached):
+            thread = threading.Thread(target=target)
+            thread.start()
+            thread.join()
+        self.assertEquals([s['statement'] for s in profile.statements[count:]],
+                          ['SELECT 2'])
+
+    def test_rows_unknown(self):
+        profiler.enable()
+        search.search('genus1', self.session)
+        profile = profiler.profiles[-1]
+        if [s for s in profile.statements if s['rows'] is None]:
+            self.assertTrue(' n/a rows ' in profile.report())
@@ -41,6 +41,46 @@ prefs.testing = True
 parser = search.SearchParser()
 
 
+class StatementCounter(object):
+    """count the SQL statements executed on db.engine while active"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+        return self
+
+    def __exit__(self, *args):
+        from sqlalchemy import event
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+
+def collection_loads(cls):
+    """the statements eager_options(cls) adds to loading objects of cls
+
+    one per collection in the eager paths registered for cls, each is
+    loaded with a subquery load.
+    """
+    from sqlalchemy.orm import class_mapper
+    result = 0
+    for path in search.MapperSearch._eager.get(cls, []):
+        mapper = class_mapper(cls)
+        for step in path.split('.'):
+            prop = mapper.get_property(step)
+            if prop.uselist:
+                result += 1
+            mapper = prop.mapper
+    return result
+
+
 class SearchParserTests(unittest.TestCase):
     error_msg = lambda me, s, v, e:  '%s: %s == %s' % (s, v, e)
 
@@ -201,22 +241,6 @@ class SearchParserTests(unittest.TestCase):
         for s in strings:
             self.assertRaises(ParseException, parser.value.parseString, s, parseAll=True)
 
-    def test_needs_join(self):
-        "check the join steps"
-
-        env = None
-        results = parser.statement.parseString("plant where accession.species."
-                                               "id=44")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession', 'species']])
-        results = parser.statement.parseString("plant where accession.id=44")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession']])
-        results = parser.statement.parseString("plant where accession.id=4 OR "
-                                               "accession.species.id=3")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession'], ['accession', 'species']])
-
     def test_value_list_token(self):
         """value_list: should return all values
         """
@@ -255,6 +279,40 @@ class SearchParserTests(unittest.TestCase):
             self.assertRaises(ParseException, parser.value_list.parseString, s, parseAll=True)
 
 
+class ParseCacheTests(unittest.TestCase):
+
+    def test_parse_cache_hit_returns_same_statement(self):
+        "parsing the same text twice hits the cache"
+
+        p = search.SearchParser()
+        first = p.parse_string('genus where genus=Ixora')
+        second = p.parse_string('  genus where genus=Ixora ')
+        self.assertTrue(first is second)
+        self.assertEquals(p.cache_info()['hits'], 1)
+        self.assertEquals(p.cache_info()['misses'], 1)
+
+    def test_parse_cache_is_bounded(self):
+        p = search.SearchParser()
+        p.cache.size = 2
+        for text in ['a', 'b', 'c']:
+            p.parse_string(text)
+        self.assertEquals(p.cache_info()['size'], 2)
+        self.assertEquals(p.cache_info()['misses'], 3)
+
+    def test_parse_error_is_not_cached(self):
+        p = search.SearchParser()
+        self.assertRaises(ParseException, p.parse_string, '"test')
+        self.assertEquals(p.cache_info()['size'], 0)
+
+    def test_clear_cache(self):
+        p = search.SearchParser()
+        p.parse_string('genus=Ixora')
+        p.parse_string('genus=Ixora')
+        p.clear_cache()
+        self.assertEquals(p.cache_info(),
+                          {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 64})
+
+
 class SearchTests(BaubleTestCase):
     def __init__(self, *args):
         super(SearchTests, self).__init__(*args)
@@ -312,6 +370,19 @@ class SearchTests(BaubleTestCase):
         g = list(results)[0]
         self.assertEqual(g.id, self.genus.id)
 
+    def test_search_by_values_single_union(self):
+        "value search: one UNION ALL, then one IN query per class hit"
+        mapper_search = search.get_strategy('MapperSearch')
+        expected = set([(self.Family, self.family.id),
+                        (self.Genus, self.genus.id)])
+        self.session.expunge_all()
+
+        with StatementCounter() as counter:
+            results = mapper_search.search('family1, genus1', self.session)
+        self.assertEquals(set((type(i), i.id) for i in results), expected)
+        self.assertEquals(len(counter), 3)
+        self.assertTrue('UNION ALL' in counter.statements[0])
+
     def test_search_by_expression_family_eq(self):
         mapper_search = search.get_strategy('MapperSearch')
         self.assertTrue(isinstance(mapper_search, search.MapperSearch))
@@ -394,6 +465,150 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search('family contains FAM', self.session)
         self.assertEquals(len(results), 4)  # they case insensitively do
 
+    def test_search_twice_does_not_alter_statement(self):
+        "invoking a cached statement leaves it unchanged"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        s = 'gen where genus=genus1'
+        statement = mapper_search.parser.parse_string(s).statement
+        before = str(statement)
+        results = mapper_search.search(s, self.session)
+        self.assertEquals(len(results), 1)
+        self.assertEquals(str(statement), before)
+        results = mapper_search.search(s, self.session)
+        self.assertEquals(len(results), 1)
+
+        s = 'fam=family1'
+        statement = mapper_search.parser.parse_string(s).statement
+        before = str(statement)
+        mapper_search.search(s, self.session)
+        self.assertEquals(str(statement), before)
+
+    def test_search_by_expression_one_statement_per_domain(self):
+        "domain expression: all columns and values in one statement"
+        mapper_search = search.get_strategy('MapperSearch')
+        from bauble.plugins.plants.species import Species
+        sp1 = Species(genus=self.genus, sp=u'alpha')
+        sp2 = Species(genus=self.genus, sp=u'beta', infrasp1=u'alpha')
+        sp3 = Species(genus=self.genus, sp=u'gamma')
+        self.session.add_all([sp1, sp2, sp3])
+        self.session.commit()
+        ids = [sp1.id, sp2.id]
+
+        # the main statement, and those loading the related collections
+        expected = 1 + collection_loads(Species)
+        with StatementCounter() as counter:
+            results = mapper_search.search('species contains alpha, gamma',
+                                           self.session)
+        self.assertEquals(len(counter), expected)
+        self.assertEquals(len(results), 3)
+
+        statement = parser.parse_string('species = alpha').statement
+        mapper_search._session = self.session
+        with StatementCounter() as counter:
+            results = statement.invoke(mapper_search)
+        self.assertEquals(len(counter), expected)
+        self.assertEquals([i.id for i in results], ids[:1])
+
+        statement = parser.parse_string('species contains alpha').statement
+        results = statement.invoke(mapper_search)
+        self.assertEquals([i.id for i in results], ids)
+
+    def test_search_results_eager_loading(self):
+        "search results come with the relations they are shown with"
+        mapper_search = search.get_strategy('MapperSearch')
+        from bauble.plugins.plants.species import Species
+        accepted = Species(genus=self.genus, sp=u'alpha')
+        synonym = Species(genus=self.genus, sp=u'beta')
+        self.session.add_all([accepted, synonym])
+        self.session.commit()
+        accepted.synonyms.append(synonym)
+        self.session.commit()
+        self.session.expunge_all()
+
+        for text in ['species=beta', 'beta',
+                     'species where sp=beta']:
+            results = mapper_search.search(text, self.session)
+            self.assertEquals(len(results), 1)
+            sp = results.pop()
+            with StatementCounter() as counter:
+                self.assertEquals(sp.genus.family.family, u'family1')
+                self.assertEquals(list(sp.vernacular_names), [])
+                self.assertEquals(sp.accepted.sp, u'alpha')
+            self.assertEquals(len(counter), 0)
+            self.session.expunge_all()
+
+    def test_lazy_search_counts_without_loading(self):
+        "lazy search: count() is one statement, and loads nothing"
+        mapper_search = search.get_strategy('MapperSearch')
+        genera = [self.Genus(family=self.family, genus=u'genus%02d' % i)
+                  for i in range(10)]
+        self.session.add_all(genera)
+        self.session.commit()
+        self.session.expunge_all()
+
+        results = mapper_search.search('genus=*', self.session, lazy=True)
+        self.assertTrue(isinstance(results, search.SearchResults))
+        with StatementCounter() as counter:
+            self.assertEquals(results.count(), 11)
+        self.assertEquals(len(counter), 1)
+        self.assertEquals(len(self.session.identity_map), 0)
+
+    def test_lazy_value_search_counts_first(self):
+        "lazy value search: count() is a count(*) preflight, no rows"
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('family1, genus1', self.session,
+                                       lazy=True)
+        with StatementCounter() as counter:
+            self.assertEquals(results.count(), 2)
+        self.assertEquals(len(counter), 1)
+        self.assertTrue('count(*)' in counter.statements[0].lower())
+        self.assertEquals(set(results), set([self.family, self.genus]))
+        self.assertEquals(results.count(), 2)
+
+    def test_lazy_search_pages(self):
+        "lazy search: keyset pages cover all results exactly once"
+        mapper_search = search.get_strategy('MapperSearch')
+        genera = [self.Genus(family=self.family, genus=u'genus%02d' % i)
+                  for i in range(10)]
+        self.session.add_all(genera)
+        self.session.commit()
+
+        results = mapper_search.search('genus like genus%', self.session,
+                                       lazy=True)
+        with StatementCounter() as counter:
+            pages = list(results.pages(page_size=4))
+        self.assertEquals([len(p) for p in pages], [4, 4, 3])
+        self.assertEquals(len(counter), 3)
+        ids = [i.id for p in pages for i in p]
+        self.assertEquals(ids, sorted(ids))
+        self.assertEquals(set(i for p in pages for i in p),
+                          mapper_search.search('genus like genus%',
+                                               self.session))
+
+    def test_lazy_search_same_as_eager(self):
+        "lazy search: the same objects as the eager search"
+        mapper_search = search.get_strategy('MapperSearch')
+        for text in ['family1, genus1', 'genus=genus1', 'gen1',
+                     'genus where family.family=family1',
+                     'genus where genus=genus1 or genus=genus2']:
+            eager = mapper_search.search(text, self.session)
+            lazy = mapper_search.search(text, self.session, lazy=True)
+            self.assertEquals(set(lazy), eager)
+            self.assertEquals(lazy.count(), len(eager))
+            self.assertEquals(set(lazy.identities()),
+                              set((type(i), i.id) for i in eager))
+
+    def test_search_results_merge_parts(self):
+        "SearchResults: objects found by more parts are returned once"
+        query = self.session.query(self.Genus)
+        results = search.SearchResults([query, [self.genus, self.family]])
+        self.assertEquals(results.count(), 3)
+        self.assertEquals(list(results), [self.genus, self.family])
+        self.assertEquals(results.identities(),
+                          [(self.Genus, self.genus.id),
+                           (self.Family, self.family.id)])
+
     def test_search_by_query11(self):
         "query with MapperSearch, single table, single test"
 
@@ -929,6 +1144,37 @@ class BinomialSearchTests(BaubleTestCase):
         results = mapper_search.search(s, self.session)
         self.assertEqual(results, set([self.ic, sp5]))
 
+    def test_binomial_key_maintained(self):
+        from bauble.plugins.plants.species import Species
+        self.assertEqual(self.ic.binomial_key, u'ixora coccinea')
+        sp = Species(sp=u'', infrasp1=u'sp', genus=self.ixora)
+        self.session.add(sp)
+        self.session.commit()
+        self.assertEqual(sp.binomial_key, u'ixora sp')
+        self.ic.sp = u'Cocc\u200binea'
+        self.session.commit()
+        self.assertEqual(self.ic.binomial_key, u'ixora coccinea')
+
+    def test_binomial_key_follows_genus(self):
+        self.ixora.genus = u'Pavetta'
+        self.session.commit()
+        self.session.expire_all()
+        self.assertEqual(self.ic.binomial_key, u'pavetta coccinea')
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('Pav cocc', self.session)
+        self.assertEqual(results, set([self.ic]))
+
+    def test_binomial_genus_sp(self):
+        from bauble.plugins.plants.species import Species
+        sp = Species(sp=u'', infrasp1=u'sp', genus=self.ixora)
+        # marked sp, with an epithet anyway
+        named = Species(sp=u'nova', infrasp1=u'sp', genus=self.ixora)
+        self.session.add_all([sp, named])
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('Ixora sp', self.session)
+        self.assertEqual(results, set([sp, named]))
+
 
 class QueryBuilderTests(BaubleTestCase):
 
@@ -1182,6 +1428,85 @@ class FilterThenMatchTests(BaubleTestCase):
         self.assertEqual(results, set())
 
 
+class QueryCompilerTests(BaubleTestCase):
+
+    def setUp(self):
+        super(QueryCompilerTests, self).setUp()
+        from bauble.plugins.plants import Family, Genus, Species
+        from bauble.plugins.garden.accession import Accession
+        from bauble.plugins.garden.location import Location
+        from bauble.plugins.garden.plant import Plant
+        family = Family(family=u'family1')
+        genus = Genus(family=family, genus=u'genus1')
+        self.sp1 = Species(genus=genus, sp=u'alpha')
+        self.sp2 = Species(genus=genus, sp=u'beta')
+        acc1 = Accession(species=self.sp1, code=u'2001.0001')
+        acc2 = Accession(species=self.sp1, code=u'2001.0002')
+        location = Location(name=u'loc1', code=u'loc1')
+        self.plant1 = Plant(accession=acc1, code=u'1', location=location,
+                            quantity=1)
+        self.plant2 = Plant(accession=acc2, code=u'1', location=location,
+                            quantity=1)
+        self.session.add_all([family, genus, self.sp1, self.sp2, acc1, acc2,
+                              location, self.plant1, self.plant2])
+        self.session.commit()
+        self.mapper_search = search.get_strategy('MapperSearch')
+        self.mapper_search._session = self.session
+
+    def compile(self, text):
+        action = self.mapper_search.parser.parse_string(text).statement.content
+        return action.query(action.environment(self.mapper_search))
+
+    def test_to_many_paths_are_exists(self):
+        s = ("species where accessions.code = '2001.0001' "
+             "or accessions.plants.code = '1'")
+        sql = str(self.compile(s).statement)
+        self.assertTrue('EXISTS' in sql)
+        self.assertFalse('JOIN' in sql)
+        self.assertFalse('DISTINCT' in sql)
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.sp1]))
+
+    def test_many_to_one_paths_joined_once(self):
+        s = ("plant where accession.species.sp = 'alpha' "
+             "or accession.code = '2001.0002'")
+        sql = str(self.compile(s).statement)
+        self.assertEquals(sql.count('LEFT OUTER JOIN'), 2)
+        self.assertFalse('DISTINCT' in sql)
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.plant1, self.plant2]))
+
+    def test_lazy_results_not_distinct(self):
+        s = "species where accessions.code like '2001%'"
+        results = self.mapper_search.search(s, self.session, lazy=True)
+        self.assertFalse('DISTINCT' in str(results.parts[0].query.statement))
+        self.assertEquals(results.count(), 1)
+        self.assertEquals(list(results), [self.sp1])
+
+    def test_not_keeps_missing_and_null(self):
+        s = "species where not accessions.code = '2001.0001'"
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.sp2]))
+        s = "species where not sp2 = 'x'"
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.sp1, self.sp2]))
+        s = "plant where not accession.species.sp = 'beta'"
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.plant1, self.plant2]))
+
+    def test_and_across_to_many(self):
+        # each condition may be met by a different accession
+        s = ("species where accessions.code = '2001.0001' "
+             "and accessions.code = '2001.0002'")
+        self.assertEquals(self.mapper_search.search(s, self.session),
+                          set([self.sp1]))
+
+    def test_explain(self):
+        plan = search.explain(self.compile(
+            "species where accessions.plants.code = '1'"))
+        self.assertTrue(len(plan) > 0)
+
+
 class ParseTypedValue(BaubleTestCase):
     def test_parse_typed_value_floats(self):
         result = search.parse_typed_value('0.0')
@@ -1313,3 +1638,186 @@ class BaubleSearchSearchTest(BaubleTestCase):
         search.search("So ha", self.session)
         self.assertTrue('SearchStrategy "So ha"(MapperSearch)' in 
                    self.handler.messages['bauble.search']['debug'])
+
+
+class ResultCacheTests(BaubleTestCase):
+
+    def setUp(self):
+        super(ResultCacheTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Genus = Genus
+        self.family = Family(family=u'family1')
+        self.genus = Genus(family=self.family, genus=u'genus1')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        search.result_cache.clear()
+
+    def test_repeated_search_costs_watermark_check(self):
+        "repeated search: only the watermark is queried"
+        first = search.search('genus like genus%', self.session, lazy=True)
+        self.assertEquals(first.count(), 1)
+        with StatementCounter() as counter:
+            again = search.search('genus like genus%', self.session,
+                                  lazy=True)
+            self.assertEquals(again.count(), 1)
+        self.assertEquals(len(counter), 1)
+        self.assertTrue('history' in counter.statements[0])
+        self.assertEquals(list(again), [self.genus])
+
+    def test_miss_fetches_once(self):
+        "a miss: the identities are fetched once, for the cache and caller"
+        results = search.search('genus like genus%', self.session, lazy=True)
+        with StatementCounter() as counter:
+            self.assertEquals(results.count(), 1)
+            self.assertEquals(results.identities(),
+                              [(self.Genus, self.genus.id)])
+        self.assertEquals(len(counter), 0)
+
+    def test_key_prefs(self):
+        "a pref changing the results is part of the key"
+        name = 'bauble.test.result_cache_key'
+        search.result_cache.add_key_pref(name)
+        try:
+            search.search('genus like genus%', self.session)
+            misses = search.result_cache.misses
+            prefs.prefs[name] = True
+            search.search('genus like genus%', self.session)
+            self.assertEquals(search.result_cache.misses, misses + 1)
+            search.search('genus like genus%', self.session)
+            self.assertEquals(search.result_cache.misses, misses + 1)
+        finally:
+            search.result_cache._key_prefs.discard(name)
+
+    def test_change_moves_watermark(self):
+        "repeated search after a change: the search runs again"
+        self.assertEquals(search.search('genus like genus%', self.session),
+                          [self.genus])
+        genus2 = self.Genus(family=self.family, genus=u'genus2')
+        self.session.add(genus2)
+        self.session.commit()
+        self.assertEquals(
+            set(search.search('genus like genus%', self.session)),
+            set([self.genus, genus2]))
+
+    def test_disabled_cache(self):
+        "disabled cache: every search runs"
+        prefs.prefs[search.ResultCache.enabled_pref] = False
+        try:
+            misses = search.result_cache.misses
+            search.search('genus like genus%', self.session)
+            search.search('genus like genus%', self.session)
+            self.assertEquals(search.result_cache.misses, misses)
+        finally:
+            prefs.prefs[search.ResultCache.enabled_pref] = True
+
+
+class StrategyRunnerTests(BaubleTestCase):
+
+    class SerialPool(object):
+        # runs the strategies in this thread, which sees the in-memory
+        # database of the test.
+        map = staticmethod(map)
+
+    def setUp(self):
+        super(StrategyRunnerTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.family = Family(family=u'family1')
+        self.genus = Genus(family=self.family, genus=u'genus1')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+
+    def test_not_enabled_in_memory(self):
+        self.assertFalse(search.strategy_runner.enabled(self.session))
+
+    def test_opt_in(self):
+        # the lazy results of the strategies come first
+        self.assertFalse(prefs.prefs.get(search.StrategyRunner.enabled_pref,
+                                         False))
+        self.assertFalse(search.strategy_runner.enabled(None))
+
+    def test_merged_and_timed(self):
+        runner = search.StrategyRunner()
+        runner._pool = self.SerialPool()
+        results = runner.run('genus1', self.session)
+        self.assertEquals(results.count(), 1)
+        self.assertEquals(list(results), [self.genus])
+        self.assertEquals(set(runner.timings),
+                          set(search._search_strategies))
+
+    def test_session_per_thread(self):
+        import threading
+        mapper_search = search.get_strategy('MapperSearch')
+        mapper_search._session = self.session
+        seen = []
+
+        def other():
+            seen.append(mapper_search._session)
+            mapper_search._session = None
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        self.assertEquals(seen, [None])
+        self.assertTrue(mapper_search._session is self.session)
+
+    def test_cancel_while_running(self):
+        import threading
+        import time
+        runner = search.StrategyRunner()
+        strategies = dict(search._search_strategies)
+        search._search_strategies.clear()
+        for name in ('endless1', 'endless2'):
+            search._search_strategies[name] = EndlessStrategy()
+        EndlessStrategy.started, EndlessStrategy.ended = [], []
+        interrupter = search.Interrupter()
+        outcome = []
+
+        def run():
+            try:
+                runner.run('anything', self.session, interrupter)
+                outcome.append('finished')
+            except Exception, e:
+                outcome.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        try:
+            thread.start()
+            # on the threads of the pool, both statements are running
+            deadline = time.time() + 10
+            while (len(EndlessStrategy.started) < 2 and
+                   time.time() < deadline):
+                time.sleep(0.01)
+            self.assertEquals(len(EndlessStrategy.started), 2)
+            # an interrupt only reaches a statement already started
+            while ((thread.is_alive() or len(EndlessStrategy.ended) < 2)
+                   and time.time() < deadline):
+                interrupter.cancel()
+                thread.join(0.1)
+            self.assertFalse(thread.is_alive())
+            self.assertEquals(len(EndlessStrategy.ended), 2)
+            self.assertNotEquals(outcome, ['finished'])
+            self.assertRaises(search.SearchCancelled,
+                              interrupter.add_session, self.session)
+        finally:
+            search._search_strategies.clear()
+            search._search_strategies.update(strategies)
+            runner.pool.close()
+
+
+class EndlessStrategy(search.SearchStrategy):
+    """a strategy running a statement until it is interrupted"""
+
+    started = []
+    ended = []
+
+    def results(self, text, session=None):
+        EndlessStrategy.started.append(self)
+        try:
+            session.execute('WITH RECURSIVE c(x) AS '
+                            '(SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                            'SELECT count(*) FROM c')
+        finally:
+            EndlessStrategy.ended.append(self)
+        return search.SearchResults()
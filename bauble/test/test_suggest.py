@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_suggest.py
+#
+import sys
+
+import bauble.db as db
+from bauble.suggest import PrefixIndex, _overhead
+from bauble.test import BaubleTestCase
+
+
+class PrefixIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(PrefixIndexTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Genus = Genus
+        self.family = Family(family=u'Rubiaceae')
+        self.ixora = Genus(family=self.family, genus=u'Ixora')
+        self.session.add_all([self.family, self.ixora,
+                              Genus(family=self.family, genus=u'Ixia')])
+        self.session.commit()
+        self.index = PrefixIndex()
+        self.index.update()
+
+    def test_complete(self):
+        self.assertEquals(self.index.complete(u'ix'), [u'Ixia', u'Ixora'])
+        self.assertEquals(self.index.complete(u'IXO'), [u'Ixora'])
+        self.assertEquals(self.index.complete(u'rub'), [u'Rubiaceae'])
+        self.assertEquals(self.index.complete(u'ix', limit=1), [u'Ixia'])
+        self.assertEquals(self.index.complete(u'xyz'), [])
+
+    def test_refresh_from_history(self):
+        genus = self.Genus(family=self.family, genus=u'Ixodes')
+        self.session.add(genus)
+        self.ixora.genus = u'Pentas'
+        self.session.commit()
+        self.index.refresh(db.engine)
+        self.assertEquals(self.index.complete(u'ix'), [u'Ixia', u'Ixodes'])
+        self.assertEquals(self.index.complete(u'pen'), [u'Pentas'])
+        self.session.delete(genus)
+        self.session.commit()
+        self.index.refresh(db.engine)
+        self.assertEquals(self.index.complete(u'ix'), [u'Ixia'])
+
+    def test_shared_values_counted(self):
+        from bauble.plugins.plants.family import Family
+        family = Family(family=u'Ixora')
+        self.session.add(family)
+        self.session.commit()
+        self.index.refresh(db.engine)
+        self.assertEquals(self.index.complete(u'ixo'), [u'Ixora'])
+        self.session.delete(family)
+        self.session.commit()
+        self.index.refresh(db.engine)
+        # the genus is still there
+        self.assertEquals(self.index.complete(u'ixo'), [u'Ixora'])
+
+    def test_budget(self):
+        index = PrefixIndex(budget=0)
+        index.build(db.engine)
+        self.assertTrue(index.truncated)
+        self.assertEquals(len(index), 0)
+        self.assertEquals(index.complete(u'ix'), [])
+
+    def test_rows_in_size(self):
+        values = sum(sys.getsizeof(key) + sys.getsizeof(value) + _overhead
+                     for key, (value, count) in self.index._values.items())
+        self.assertTrue(self.index.size > values)
+
+        class Tight(PrefixIndex):
+            # the budget of the values alone, in bytes
+            budget = values
+
+        index = Tight()
+        index.build(db.engine)
+        self.assertTrue(index.truncated)
+        self.assertTrue(index.size <= values)
+
+    def test_build_pages(self):
+        index = PrefixIndex()
+        index.page_size = 1
+        index.build(db.engine)
+        self.assertEquals(index.complete(u'ix'), [u'Ixia', u'Ixora'])
+        self.assertEquals(len(index), len(self.index))
+
+    def test_build_stops_over_budget(self):
+        pages = []
+
+        class Tight(PrefixIndex):
+            budget = 0
+            page_size = 1
+
+            def _pages(self, connection, table, columns):
+                for rows in super(Tight, self)._pages(connection, table,
+                                                      columns):
+                    pages.append(rows)
+                    yield rows
+
+        Tight().build(db.engine)
+        # the first row did not fit, nothing more was read
+        self.assertEquals(len(pages), 1)
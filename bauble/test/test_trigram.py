@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_trigram.py
+#
+from nose import SkipTest
+
+import bauble.db as db
+from bauble.error import BaubleError
+import bauble.search as search
+import bauble.trigram as trigram
+from bauble.test import BaubleTestCase
+
+
+class TrigramIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(TrigramIndexTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Genus = Genus
+        self.family = Family(family=u'Rubiaceae')
+        self.genus = Genus(family=self.family, genus=u'Ixora')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+
+    def test_search_columns_from_add_meta(self):
+        columns = trigram._indexed_columns()
+        self.assertTrue(('genus', 'genus', 'genus') in columns)
+        self.assertTrue(('species', 'species', 'infrasp1') in columns)
+
+    def test_fall_back_without_extension(self):
+        if db.engine.name == 'postgresql':
+            raise SkipTest('only meaningful without pg_trgm')
+        self.assertFalse(trigram.is_available())
+        self.assertFalse(trigram.has_index(self.Genus))
+        self.assertRaises(BaubleError, trigram.create_index)
+        self.assertTrue('not available' in trigram.describe())
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('genus contains xor', self.session)
+        self.assertEquals(results, set([self.genus]))
+
+    def test_create_and_report(self):
+        if not trigram.is_available():
+            raise SkipTest('pg_trgm not installed')
+        trigram.create_index()
+        try:
+            self.assertTrue(trigram.has_index(self.Genus))
+            self.assertTrue('genus.genus: indexed' in trigram.describe())
+            mapper_search = search.get_strategy('MapperSearch')
+            results = mapper_search.search('genus contains xor', self.session)
+            self.assertEquals(results, set([self.genus]))
+        finally:
+            trigram.drop_index()
+        self.assertFalse(trigram.has_index(self.Genus))
@@ -123,3 +123,24 @@ class GlobalFuncs(TestCase):
 
     def test_safe_numeric_valid_not(self):
         self.assertEquals(utils.safe_numeric('123a.2'), 0)
+
+    def test_natsort_key_remembered(self):
+        class Named(object):
+            calls = 0
+
+            def __str__(self):
+                Named.calls += 1
+                return 'A10'
+        item = Named()
+        key = utils.natsort_key(item)
+        self.assertEquals(utils.natsort_key(item), key)
+        self.assertEquals(Named.calls, 1)
+        utils.clear_natsort_keys()
+        utils.natsort_key(item)
+        self.assertEquals(Named.calls, 2)
+        self.assertEquals(utils.natsort_key('A10'), key)
+
+    def test_natsort_sql_key(self):
+        values = ['A10', 'A2', 'B1', '2017.0010', '2017.002', '1']
+        self.assertEquals(sorted(values, key=utils.natsort_sql_key),
+                          sorted(values, key=utils.natsort_key))
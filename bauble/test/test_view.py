@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_view.py
+#
+from unittest import TestCase
+
+import sqlalchemy as sa
+
+import bauble.db as db
+from bauble.view import SearchView, SearchResultsModel, MarkupCache
+from bauble.test import BaubleTestCase
+
+
+class SearchResultsModelTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SearchResultsModelTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family, self.Genus = Family, Genus
+        self.families = [Family(family=u'Family%03d' % i) for i in range(30)]
+        self.session.add_all(self.families)
+        self.session.commit()
+        self.identities = [(Family, f.id) for f in self.families]
+
+    def model(self, **kwargs):
+        model = SearchResultsModel(self.session, self.identities)
+        for k, v in kwargs.items():
+            setattr(model, k, v)
+        return model
+
+    def test_objects_loaded_on_demand(self):
+        model = self.model(page_size=10)
+        self.assertEquals(len(model), 30)
+        self.assertEquals(model.loaded(), [])
+        self.assertEquals(model[(12, )][0], self.families[12])
+        # one page, from the row asked for
+        self.assertEquals(sorted(f.id for f in model.loaded()),
+                          [f.id for f in self.families[12:22]])
+
+    def test_cache_bounded(self):
+        model = self.model(page_size=5, cache_size=10)
+        values = [row[0] for row in model]
+        self.assertEquals(values, self.families)
+        self.assertEquals(len(model.loaded()), 10)
+
+    def test_deleted_object(self):
+        model = self.model()
+        self.session.delete(self.families[3])
+        self.session.commit()
+        self.assertEquals(model[(3, )][0], None)
+        self.assertEquals(model[(4, )][0], self.families[4])
+
+    def test_children(self):
+        model = self.model()
+        family = self.families[0]
+        genus = self.Genus(family=family, genus=u'Genus')
+        self.session.add(genus)
+        self.session.commit()
+        treeiter = model.get_iter((0, ))
+        self.assertTrue(model.iter_has_child(treeiter))
+        self.assertEquals(model.iter_n_children(treeiter), 0)
+        model.set_children(treeiter, [genus])
+        self.assertEquals(model[(0, 0)][0], genus)
+        self.assertTrue(genus in model.loaded())
+        model.set_children(model.get_iter((1, )), [])
+        self.assertFalse(model.iter_has_child(model.get_iter((1, ))))
+        self.assertTrue((self.Family, self.families[1].id) in model.childless)
+
+    def test_find_remove_append(self):
+        model = self.model()
+        family = self.families[5]
+        found = model.find(family)
+        self.assertEquals([model.get_path(i) for i in found], [(5, )])
+        # finding doesn't load objects
+        self.assertEquals(model.loaded(), [])
+        model.remove_object(family)
+        self.assertEquals(len(model), 29)
+        self.assertEquals(model.find(family), [])
+        self.assertEquals(model[(5, )][0], self.families[6])
+        treeiter = model.append(family)
+        self.assertEquals(model.get_path(treeiter), (29, ))
+        self.assertEquals(model[treeiter][0], family)
+
+
+class MarkupCacheTests(BaubleTestCase):
+
+    def setUp(self):
+        super(MarkupCacheTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        import bauble.view as view
+        self.family = Family(family=u'Araceae')
+        self.genus = Genus(family=self.family, genus=u'Anthurium')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        self.cache = view.markup_cache
+        self.cache.clear()
+
+    def test_pair_cached(self):
+        calls = []
+        original = self.genus.search_view_markup_pair
+
+        def counted():
+            calls.append(1)
+            return original()
+        self.genus.search_view_markup_pair = counted
+        self.assertEquals(self.cache.get(self.genus),
+                          ('Anthurium', 'Araceae'))
+        self.cache.get(self.genus)
+        self.assertEquals(len(calls), 1)
+
+    def test_update_invalidates(self):
+        self.cache.get(self.genus)
+        self.genus.genus = u'Philodendron'
+        self.session.commit()
+        self.assertEquals(self.cache.get(self.genus),
+                          ('Philodendron', 'Araceae'))
+
+    def test_child_invalidates_parent(self):
+        from bauble.plugins.plants.species import Species
+        self.cache.get(self.genus)
+        key = (type(self.genus), self.genus.id)
+        self.assertTrue(key in self.cache._pairs)
+        self.session.add(Species(genus=self.genus, sp=u'andraeanum'))
+        self.session.commit()
+        self.assertFalse(key in self.cache._pairs)
+
+    def test_parent_invalidates_unloaded_children(self):
+        from bauble.plugins.plants.species import Species
+        species = Species(genus=self.genus, sp=u'andraeanum')
+        self.session.add(species)
+        self.session.commit()
+        self.cache.get(species)
+        key = (type(species), species.id)
+        self.assertTrue(key in self.cache._pairs)
+        # the species of the genus are not loaded
+        self.assertFalse('species' in sa.inspect(self.genus).dict)
+        self.genus.genus = u'Philodendron'
+        self.session.commit()
+        self.assertFalse(key in self.cache._pairs)
+        self.assertTrue('Philodendron' in self.cache.get(species)[0])
+
+    def test_size(self):
+        cache = MarkupCache()
+        cache.size = 1
+        cache._engine = db.engine
+        cache._pairs[(None, 0)] = (('a', 'b'), set())
+        cache.get(self.genus)
+        self.assertEquals(cache._pairs.keys(),
+                          [(type(self.genus), self.genus.id)])
+
+
+class ViewMetaRelationTests(TestCase):
+
+    def test_relation(self):
+        from functools import partial
+        meta = SearchView.ViewMeta.Meta()
+        self.assertEquals(meta.relation, None)
+        meta.set(children='genera')
+        self.assertEquals(meta.relation, 'genera')
+        meta.set(children=partial(db.natsort, 'accessions'))
+        self.assertEquals(meta.relation, 'accessions')
+        # through more relations, or computed
+        meta.set(children=partial(db.natsort, 'species.accessions'))
+        self.assertEquals(meta.relation, None)
+        meta.set(children=lambda obj: [])
+        self.assertEquals(meta.relation, None)
+
+
+class HistoryPagesTests(BaubleTestCase):
+
+    def setUp(self):
+        super(HistoryPagesTests, self).setUp()
+        import datetime
+        self.session.query(db.History).delete()
+        day = datetime.datetime(2017, 1, 1)
+        # two rows per timestamp, so pages break between equal ones
+        for i in range(10):
+            self.session.add(db.History(
+                table_name=i % 2 and u'genus' or u'family', table_id=i,
+                values=u'{}', operation=u'insert', user=u'tester',
+                timestamp=day + datetime.timedelta(days=i // 2)))
+        self.session.commit()
+
+    def test_keyset_pages(self):
+        from bauble.view import history_query, history_page
+        query = history_query(self.session)
+        seen = []
+        after = None
+        while True:
+            page = history_page(query, after, limit=3)
+            seen.extend(page)
+            if len(page) < 3:
+                break
+            after = page[-1].timestamp, page[-1].id
+        self.assertEquals(seen, query.all())
+        self.assertEquals(len(seen), 10)
+
+    def test_filters(self):
+        import datetime
+        from bauble.view import history_query
+        query = history_query(self.session, table_name=u'genus')
+        self.assertEquals(set(i.table_name for i in query), set([u'genus']))
+        query = history_query(self.session,
+                              since=datetime.datetime(2017, 1, 2),
+                              until=datetime.datetime(2017, 1, 3))
+        self.assertEquals(sorted(i.table_id for i in query), [2, 3, 4, 5])
+        self.assertEquals(history_query(self.session, user=u'other').all(),
+                          [])
+
+    def test_parse_filters(self):
+        import datetime
+        from bauble.error import BaubleError
+        from bauble.view import HistoryCommandHandler
+        self.assertEquals(
+            HistoryCommandHandler.parse_filters(
+                'table=plant since=2017-01-31'),
+            {'table_name': 'plant',
+             'since': datetime.datetime(2017, 1, 31)})
+        self.assertEquals(HistoryCommandHandler.parse_filters(''), {})
+        self.assertRaises(BaubleError, HistoryCommandHandler.parse_filters,
+                          'colour=red')
+        self.assertRaises(BaubleError, HistoryCommandHandler.parse_filters,
+                          'since=yesterday')
+
+
+class InfoboxStatisticsTests(BaubleTestCase):
+
+    def setUp(self):
+        super(InfoboxStatisticsTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        from bauble.view import InfoboxStatistics
+        self.Genus = Genus
+        self.family = Family(family=u'Araceae')
+        self.session.add_all([self.family,
+                              Genus(family=self.family, genus=u'Anthurium')])
+        self.session.commit()
+        self.statistics = InfoboxStatistics()
+        self.counters = [('ngen', 'count', 'genera.id')]
+        self.shown = []
+
+    def show(self, obj, counts):
+        self.shown.append(counts)
+
+    def test_counts_remembered(self):
+        # in-memory databases are counted right away
+        self.statistics.get(self.family, self.counters, self.show)
+        self.assertEquals(self.shown, [{'ngen': 1}])
+        # nothing changed, the remembered counts are shown once
+        self.statistics.get(self.family, self.counters, self.show)
+        self.assertEquals(self.shown, [{'ngen': 1}, {'ngen': 1}])
+
+    def test_history_invalidates(self):
+        self.statistics.get(self.family, self.counters, self.show)
+        self.session.add(self.Genus(family=self.family, genus=u'Arum'))
+        self.session.commit()
+        self.statistics.get(self.family, self.counters, self.show)
+        self.assertEquals(self.shown, [{'ngen': 1}, {'ngen': 1},
+                                       {'ngen': 2}])
+
+
+class AttachmentsCacheTests(BaubleTestCase):
+
+    def setUp(self):
+        super(AttachmentsCacheTests, self).setUp()
+        from bauble.plugins.plants.family import Family, FamilyNote
+        self.families = [Family(family=u'Family%s' % i) for i in range(3)]
+        self.session.add_all(self.families)
+        self.session.add(FamilyNote(family=self.families[1], note=u'note'))
+        self.session.commit()
+        self.identities = [(Family, f.id) for f in self.families]
+
+    def test_note_attached_to_many(self):
+        from bauble.view import Note
+        attached = Note.attached_to_many(self.session, self.identities)
+        self.assertEquals(attached.keys(), [self.identities[1]])
+        self.assertEquals(attached[self.identities[1]],
+                          self.families[1].notes)
+
+    def test_prefetched(self):
+        from bauble.view import AttachmentsCache, Note
+        cache = AttachmentsCache()
+        calls = []
+        descriptor = Note.__dict__['attached_to_many']
+        original = Note.attached_to_many
+
+        def counted(session, identities):
+            calls.append(identities)
+            return original(session, identities)
+        Note.attached_to_many = staticmethod(counted)
+        try:
+            self.assertEquals(cache.get(Note, self.families[0],
+                                        self.identities), [])
+            self.assertEquals(cache.get(Note, self.families[1]),
+                              self.families[1].notes)
+            self.assertEquals(len(calls), 1)
+            # written, forgotten
+            cache.on_change(None, None, self.families[1])
+            cache.get(Note, self.families[1])
+            self.assertEquals(len(calls), 2)
+        finally:
+            Note.attached_to_many = descriptor
+
+
+class RecycleSessionTests(BaubleTestCase):
+
+    def setUp(self):
+        super(RecycleSessionTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family, self.Genus = Family, Genus
+        family = Family(family=u'Rubiaceae')
+        self.session.add_all([Genus(family=family, genus=u'Ixora'),
+                              Family(family=u'Araceae')])
+        self.session.commit()
+
+    def test_reachable_objects(self):
+        from bauble.view import reachable_objects
+        genus = self.session.query(self.Genus).one()
+        self.assertEquals(reachable_objects([genus]), [genus])
+        family = genus.family
+        self.assertEquals(set(reachable_objects([genus])),
+                          set([genus, family]))
+        self.assertEquals(reachable_objects([u'string']), [])
+
+    def test_recycle_session(self):
+        from bauble.view import recycle_session
+        genus = self.session.query(self.Genus).one()
+        other = self.session.query(self.Family).filter_by(
+            family=u'Araceae').one()
+        session = recycle_session(self.session, [genus])
+        self.assertTrue(genus in session)
+        self.assertFalse(other in session)
+        self.assertEquals(len(session.identity_map), 1)
+        # still usable, relations load in the new session
+        self.assertEquals(genus.family.family, u'Rubiaceae')
+        session.close()
+
+
+class SearchTaskCancelTests(BaubleTestCase):
+
+    class EndlessCount(object):
+        # a part of the results whose count runs until interrupted
+        started = []
+        ended = []
+
+        def __init__(self, session):
+            self.session = session
+
+        def count(self):
+            self.started.append(self)
+            try:
+                return self.session.execute(
+                    'WITH RECURSIVE c(x) AS '
+                    '(SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                    'SELECT count(*) FROM c').scalar()
+            finally:
+                self.ended.append(self)
+
+        def identities(self):
+            return []
+
+    def test_cancel_running_search(self):
+        import time
+        from bauble import prefs
+        import bauble.search as search
+        from bauble.view import SearchTask
+        EndlessCount = self.EndlessCount
+
+        class EndlessStrategy(search.SearchStrategy):
+            def results(self, text, session=None):
+                results = search.SearchResults()
+                results.parts.append(EndlessCount(session))
+                return results
+
+        strategies = dict(search._search_strategies)
+        search._search_strategies.clear()
+        search._search_strategies['endless'] = EndlessStrategy()
+        # the task thread has an in-memory database of its own, empty
+        cache_pref = search.result_cache.enabled_pref
+        cache_enabled = prefs.prefs.get(cache_pref, True)
+        prefs.prefs[cache_pref] = False
+        delivered = []
+        task = SearchTask('anything',
+                          lambda *args: delivered.append('counted'),
+                          lambda *args: delivered.append('done'))
+        task.defer = lambda callback, *args: callback(*args)
+        task.daemon = True
+        try:
+            task.start()
+            deadline = time.time() + 10
+            while not EndlessCount.started and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(EndlessCount.started)
+            # an interrupt only reaches a statement already started
+            while task.is_alive() and time.time() < deadline:
+                task.cancel()
+                task.join(0.1)
+            self.assertFalse(task.is_alive())
+            self.assertTrue(EndlessCount.ended)
+            self.assertEquals(delivered, [])
+        finally:
+            search._search_strategies.clear()
+            search._search_strategies.update(strategies)
+            prefs.prefs[cache_pref] = cache_enabled
+
+    def test_confirm_before_fetching(self):
+        from bauble import prefs
+        import bauble.search as search
+        from bauble.view import SearchTask
+
+        class CountedPart(object):
+            # a part of the results telling whether it was fetched
+            fetched = []
+
+            def count(self):
+                return 2
+
+            def identities(self):
+                self.fetched.append(self)
+                return []
+
+        class CountedStrategy(search.SearchStrategy):
+            def results(self, text, session=None):
+                results = search.SearchResults()
+                results.parts.append(CountedPart())
+                return results
+
+        strategies = dict(search._search_strategies)
+        search._search_strategies.clear()
+        search._search_strategies['counted'] = CountedStrategy()
+        cache_pref = search.result_cache.enabled_pref
+        cache_enabled = prefs.prefs.get(cache_pref, True)
+        prefs.prefs[cache_pref] = False
+        try:
+            for accepted in (False, True):
+                delivered = []
+                task = SearchTask(
+                    'anything',
+                    lambda task, n: task.confirm(accepted),
+                    lambda *args: delivered.append('done'),
+                    confirm_over=1)
+                task.defer = lambda callback, *args: callback(*args)
+                task.run()
+                self.assertEquals(bool(CountedPart.fetched), accepted)
+                self.assertEquals(bool(delivered), accepted)
+        finally:
+            search._search_strategies.clear()
+            search._search_strategies.update(strategies)
+            prefs.prefs[cache_pref] = cache_enabled
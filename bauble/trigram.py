@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jardín Botánico de Quito
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Trigram indexes for the `like` and `contains` family of search operators.
+
+All searches on the columns registered with MapperSearch.add_meta end up
+in `utils.ilike`, which on PostgreSQL produces `column ILIKE pattern`,
+mostly with a leading wildcard.  A B-tree can't serve those, but a GIN
+index using the `gin_trgm_ops` operator class from the `pg_trgm`
+extension can, and the planner picks it without any change to the
+queries.
+
+The indexes are created and dropped by the user with `:trigram=create`
+and `:trigram=drop`; `:trigram` reports which searches use them.  On
+databases other than PostgreSQL, or without the extension, nothing is
+created and searches keep working as before.
+"""
+
+import weakref
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import gtk
+
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+from bauble.error import BaubleError
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+INDEX_PREFIX = 'trgm_'
+
+# the (table, column) pairs having a trigram index, per engine
+_existing = weakref.WeakKeyDictionary()
+
+
+def _bind(bind):
+    if bind is None:
+        bind = db.engine
+    return bind
+
+
+def _indexed_columns():
+    """list of (domain, table, column) for all registered search columns"""
+    from bauble.search import MapperSearch
+    result = []
+    for domain, (cls, properties) in sorted(MapperSearch._domains.items()):
+        mapper = class_mapper(cls)
+        for p in properties:
+            result.append((domain, mapper.local_table.name, mapper.c[p].name))
+    return result
+
+
+def index_name(table, column):
+    return '%s%s_%s' % (INDEX_PREFIX, table, column)
+
+
+def is_available(bind=None):
+    """is the pg_trgm extension installed in the database?"""
+    bind = _bind(bind)
+    if bind.dialect.name != 'postgresql':
+        return False
+    try:
+        return bind.execute("SELECT count(*) FROM pg_extension "
+                            "WHERE extname = 'pg_trgm'").scalar() > 0
+    except Exception, e:
+        logger.debug('cannot check pg_trgm: %s(%s)' % (type(e), e))
+        return False
+
+
+def existing_indexes(bind=None):
+    """the set of (table, column) pairs having a trigram index"""
+    bind = _bind(bind)
+    engine = bind.engine
+    if engine not in _existing:
+        result = set()
+        if bind.dialect.name == 'postgresql':
+            names = set(row[0] for row in bind.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE indexname LIKE 'trgm\\_%%'"))
+            for domain, table, column in _indexed_columns():
+                if index_name(table, column) in names:
+                    result.add((table, column))
+        _existing[engine] = result
+    return _existing[engine]
+
+
+def has_index(cls, bind=None):
+    """are all search columns of cls covered by a trigram index?"""
+    from bauble.search import MapperSearch
+    properties = MapperSearch._properties.get(cls)
+    if not properties:
+        return False
+    mapper = class_mapper(cls)
+    existing = existing_indexes(bind)
+    return all((mapper.local_table.name, mapper.c[p].name) in existing
+               for p in properties)
+
+
+def create_index(bind=None):
+    """create the trigram indexes missing on the search columns
+
+    installs the pg_trgm extension if needed, which requires the proper
+    database privileges.  returns the list of the created indexes, raise
+    BaubleError if the database can't hold them.
+    """
+    bind = _bind(bind)
+    if bind.dialect.name != 'postgresql':
+        raise BaubleError(
+            _('trigram indexes need PostgreSQL, and this database is %s')
+            % bind.dialect.name)
+    if not is_available(bind):
+        try:
+            bind.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except Exception, e:
+            logger.debug('cannot install pg_trgm: %s(%s)' % (type(e), e))
+            raise BaubleError(
+                _('the pg_trgm extension is not installed, and could not '
+                  'be installed: %s') % e)
+    existing = existing_indexes(bind)
+    created = []
+    for domain, table, column in _indexed_columns():
+        if (table, column) in existing:
+            continue
+        name = index_name(table, column)
+        logger.debug('creating trigram index %s' % name)
+        bind.execute('CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)'
+                     % (name, table, column))
+        existing.add((table, column))
+        created.append(name)
+    return created
+
+
+def drop_index(bind=None):
+    """drop all trigram indexes on the search columns"""
+    bind = _bind(bind)
+    for table, column in existing_indexes(bind):
+        bind.execute('DROP INDEX IF EXISTS %s' % index_name(table, column))
+    _existing.pop(bind.engine, None)
+
+
+def describe(bind=None):
+    """a human readable report of which searches use trigram indexes"""
+    bind = _bind(bind)
+    if not is_available(bind):
+        return _('trigram indexes are not available on this database, '
+                 'searches use plain (I)LIKE.')
+    existing = existing_indexes(bind)
+    lines = []
+    for domain, table, column in _indexed_columns():
+        if (table, column) in existing:
+            lines.append(_('%(domain)s.%(column)s: indexed, used by value '
+                           'searches and by like, contains, has') %
+                         {'domain': domain, 'column': column})
+        else:
+            lines.append(_('%(domain)s.%(column)s: not indexed') %
+                         {'domain': domain, 'column': column})
+    lines.append(_('patterns shorter than three characters do not '
+                   'benefit from the indexes.'))
+    return '\n'.join(lines)
+
+
+class TrigramCommandHandler(pluginmgr.CommandHandler):
+    """manage the trigram indexes
+
+    `:trigram=create` creates the missing indexes, `:trigram=drop`
+    removes them, `:trigram` reports which searches use them.
+    """
+
+    command = 'trigram'
+
+    def get_view(self):
+        return None
+
+    def __call__(self, cmd, arg):
+        arg = (arg or '').strip()
+        if arg == 'create':
+            try:
+                create_index()
+            except BaubleError, e:
+                utils.message_dialog(utils.xml_safe(e.msg), gtk.MESSAGE_ERROR)
+                return
+        elif arg == 'drop':
+            drop_index()
+        utils.message_dialog(utils.xml_safe(describe()))
+
+
+pluginmgr.register_command(TrigramCommandHandler)
@@ -22,6 +22,7 @@
 #
 
 import os
+import re
 import traceback
 
 import gtk
@@ -37,6 +38,7 @@ import bauble.paths as paths
 import bauble.pluginmgr as pluginmgr
 from bauble.prefs import prefs
 import bauble.search as search
+from bauble.suggest import suggestions
 import bauble.utils as utils
 import bauble.utils.desktop as desktop
 from bauble.view import SearchView
@@ -108,8 +110,12 @@ class GUI(object):
     entry_history_pref = 'bauble.history'
     history_size_pref = 'bauble.history_size'
     window_geometry_pref = "bauble.geometry"
+    suggest_pref = 'bauble.search.suggest'
     _default_history_size = 12
 
+    # the word being typed, at the end of the main entry
+    _last_word_rx = re.compile(r'[^\s,=\'"]*$', re.UNICODE)
+
     def __init__(self):
         filename = os.path.join(paths.lib_dir(), 'bauble.glade')
         self.widgets = utils.load_widgets(filename)
@@ -145,6 +151,7 @@ class GUI(object):
 
         main_entry = combo.child
         main_entry.connect('activate', self.on_main_entry_activate)
+        main_entry.connect('changed', self.on_main_entry_changed)
         accel_group = gtk.AccelGroup()
         main_entry.add_accelerator("grab-focus", accel_group, ord('L'),
                                    gtk.gdk.CONTROL_MASK, gtk.ACCEL_VISIBLE)
@@ -260,6 +267,28 @@ class GUI(object):
     def on_main_entry_activate(self, widget, data=None):
         self.widgets.go_button.emit("clicked")
 
+    def on_main_entry_changed(self, entry):
+        """complete the word being typed with the values in the database
+
+        the completions are the history entries, followed by the text with
+        its last word completed by the values of the searched columns.
+        """
+        if not prefs.get(self.suggest_pref, True):
+            return
+        completion = entry.get_completion()
+        if completion is None:
+            return
+        text = utils.to_unicode(entry.get_text())
+        match = self._last_word_rx.search(text)
+        completed = []
+        if not text.startswith(':') and len(match.group()) >= 2:
+            head = text[:match.start()]
+            for value in suggestions.suggest(match.group()):
+                if re.search(r'\s', value, re.UNICODE):
+                    value = u'"%s"' % value
+                completed.append(head + value)
+        self._fill_completion(completion.get_model(), completed)
+
     def on_home_button_clicked(self, widget):
         '''
         '''
@@ -343,7 +372,7 @@ class GUI(object):
             main_entry.set_completion(completion)
             compl_model = gtk.ListStore(str)
             completion.set_model(compl_model)
-            completion.set_popup_completion(False)
+            completion.set_popup_completion(True)
             completion.set_inline_completion(True)
             completion.set_minimum_key_length(2)
         else:
@@ -352,7 +381,14 @@ class GUI(object):
         if history is not None:
             for herstory in history:
                 main_combo.append_text(herstory)
-                compl_model.append([herstory])
+        self._fill_completion(compl_model)
+
+    def _fill_completion(self, model, completed=()):
+        model.clear()
+        for herstory in prefs[self.entry_history_pref] or []:
+            model.append([herstory])
+        for text in completed:
+            model.append([utils.utf8(text)])
 
     def __get_title(self):
         if bauble.conn_name is None:
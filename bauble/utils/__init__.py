@@ -29,6 +29,7 @@ import datetime
 import os
 import re
 import textwrap
+import weakref
 import xml.sax.saxutils as saxutils
 
 import gtk
@@ -928,17 +929,45 @@ def safe_int(s):
 __natsort_rx = re.compile('(\d+(?:\.\d+)?)')
 
 
+# the natsort keys of the objects seen so far, see clear_natsort_keys
+_natsort_keys = weakref.WeakKeyDictionary()
+
+
+def clear_natsort_keys():
+    """forget the natsort keys computed so far"""
+    _natsort_keys.clear()
+
+
+def forget_natsort_key(obj):
+    """forget the natsort key of obj, whose string changed
+
+    mapped objects are forgotten as soon as any of their attributes is
+    set, and when they are updated.
+    """
+    _natsort_keys.pop(obj, None)
+
+
 def natsort_key(obj):
     """
     a key getter for sort and sorted function
 
     the sorting is done on return value of obj.__str__() so we can sort
-    generic objects as well.
+    generic objects as well.  the key of an object is computed once and
+    remembered until clear_natsort_keys is called.
 
     use like: sorted(some_list, key=utils.natsort_key)
     """
+    try:
+        return _natsort_keys[obj]
+    except KeyError:
+        result = _natsort_keys[obj] = _natsort_key(str(obj))
+        return result
+    except TypeError:
+        # strings and numbers can't be weakly referenced
+        return _natsort_key(str(obj))
 
-    item = str(obj)
+
+def _natsort_key(item):
     chunks = __natsort_rx.split(item)
     for ii in range(len(chunks)):
         if chunks[ii] and chunks[ii][0] in '0123456789':
@@ -953,6 +982,26 @@ def natsort_key(obj):
     return (chunks, item)
 
 
+def natsort_sql_key(value, width=10, length=64):
+    """
+    a string that sorts in SQL the way natsort_key sorts value
+
+    the numbers are padded with zeros to width, so that a plain ORDER BY
+    puts 'A2' before 'A10'.  like in natsort_key, a decimal part is
+    compared as a fraction, it is left as it is.  meant for the indexed
+    sort_key columns, which are length long.
+    """
+    if value is None:
+        return None
+
+    def pad(match):
+        number = match.group(1).split('.', 1)
+        number[0] = number[0].zfill(width)
+        return '.'.join(number)
+    result = __natsort_rx.sub(pad, unicode(value))
+    return result[:length]
+
+
 def delete_or_expunge(obj):
     """
     If the object is in object_session(obj).new then expunge it from the
@@ -1158,10 +1207,16 @@ def gc_objects_by_type(tipe):
 
 
 def mem(size="rss"):
-    """Generalization; memory sizes: rss, rsz, vsz."""
+    """Generalization; memory sizes: rss, rsz, vsz.
+
+    in kB, as reported by ps, None where there is no ps to ask.
+    """
     import os
-    return int(os.popen('ps -p %d -o %s | tail -1' %
-                        (os.getpid(), size)).read())
+    try:
+        return int(os.popen('ps -p %d -o %s | tail -1' %
+                            (os.getpid(), size)).read())
+    except (ValueError, OSError):
+        return None
 
 
 def topological_sort(items, partial_order):
@@ -20,6 +20,10 @@
 #
 # Description: the default view
 #
+from array import array
+from collections import OrderedDict
+import datetime
+from functools import partial
 import itertools
 import os
 import sys
@@ -37,7 +41,11 @@ import threading
 
 
 from pyparsing import ParseException
-from sqlalchemy.orm import object_session
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.orm import class_mapper, object_session
+from sqlalchemy.orm.interfaces import MANYTOONE
+import sqlalchemy.orm.exc as orm_exc
 import sqlalchemy.exc as saexc
 
 import bauble
@@ -47,6 +55,7 @@ from bauble import paths
 from bauble import pluginmgr
 from bauble import prefs
 from bauble import search
+from bauble.profiler import profiler
 from bauble import utils
 from bauble import editor
 from bauble import pictures_view
@@ -397,6 +406,89 @@ class AddOneDot(threading.Thread):
             gobject.idle_add(self.callback, self.dotno)
 
 
+class InfoboxStatistics(object):
+    """the counters shown in the infoboxes, by (class, id)
+
+    the counters of an object are computed with db.aggregate_counts, in
+    one statement, on a worker thread, and remembered together with the
+    last id of the history table: they are computed again only when the
+    history shows that something changed since.  in-memory databases
+    are invisible to other connections, their counters are computed
+    right away.
+    """
+
+    size = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (class, id): (watermark, counts)
+        self._pending = None
+        self.worker = None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def get(self, obj, counters, callback):
+        """
+        Call callback(obj, counts) on the GUI thread with the counters
+        of obj, a dict by key.  remembered counters are shown right
+        away, and again if they turn out to be out of date.
+        """
+        key = (type(obj), obj.id)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None:
+            callback(obj, entry[1])
+        request = (key, obj, counters, callback, entry)
+        if db.engine.url.database in (None, '', ':memory:'):
+            self._compute(request, defer=lambda f, *args: f(*args))
+            return
+        with self._lock:
+            # only the last request counts, the cursor has moved on
+            self._pending = request
+            if self.worker is not None and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(target=self._run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                request, self._pending = self._pending, None
+            if request is None:
+                return
+            self._compute(request)
+
+    def _compute(self, request, defer=gobject.idle_add):
+        key, obj, counters, callback, entry = request
+        session = db.Session()
+        try:
+            history = db.History.__table__
+            watermark = session.execute(
+                sa.select([sa.func.max(history.c.id)])).scalar() or 0
+            if entry is not None and entry[0] == watermark:
+                return
+            counts = db.aggregate_counts(session, key[0], [key[1]],
+                                         counters)
+        except Exception, e:
+            logger.warning('cannot count for %s: %s(%s)' % (key, type(e), e))
+            return
+        finally:
+            session.close()
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (watermark, counts)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        if entry is None or entry[1] != counts:
+            defer(callback, obj, counts)
+
+
+infobox_statistics = InfoboxStatistics()
+
+
 class CountResultsTask(threading.Thread):
     def __init__(self, klass, ids, dots_thread,
                  group=None, verbose=None, **kwargs):
@@ -414,15 +506,28 @@ class CountResultsTask(threading.Thread):
         session = db.Session()
         klass = self.klass
         d = {}
-        for ndx in self.ids:
-            item = session.query(klass).filter(klass.id == ndx).one()
-            if self.__cancel:  # check whether caller asks to cancel
-                break
-            for k, v in item.top_level_count().items():
-                if isinstance(v, set):
-                    d[k] = v.union(d.get(k, set()))
-                else:
-                    d[k] = v + d.get(k, 0)
+        try:
+            if getattr(klass, 'top_level_counters', None) is not None:
+                # all the counters in as few statements as possible
+                d = db.aggregate_counts(session, klass, self.ids,
+                                        klass.top_level_counters)
+            else:
+                for ndx in self.ids:
+                    item = session.query(klass).filter(
+                        klass.id == ndx).one()
+                    if self.__cancel:  # check whether caller asks to cancel
+                        break
+                    for k, v in item.top_level_count().items():
+                        if isinstance(v, set):
+                            d[k] = v.union(d.get(k, set()))
+                        else:
+                            d[k] = v + d.get(k, 0)
+        except Exception, e:
+            logger.warning('cannot count the results: %s(%s)' % (type(e), e))
+            logger.debug(traceback.format_exc())
+            self.dots_thread.cancel()
+            session.close()
+            return
         result = []
         for k, v in sorted(d.items()):
             if isinstance(k, tuple):
@@ -448,6 +553,608 @@ class CountResultsTask(threading.Thread):
         session.close()
 
 
+class SearchTask(threading.Thread):
+    """run a search on a worker thread, with its own session
+
+    the search produces the (class, id) pairs of the results, these are
+    handed to `on_done` on the GUI thread, together with the error
+    messages, if any.  `on_counted` receives the preflight count.
+    `ranked` tells whether the order of the results should be kept,
+    otherwise results of more than `sort_over` objects are sorted by the
+    task, see search.natsort_identities, so that they can be shown
+    without loading them.
+    with more than `confirm_over` results, the task waits for `on_counted`
+    to call confirm() before fetching anything.
+    cancelling the task interrupts the running database statement, if
+    the database driver allows it, and the callbacks are not invoked.
+    """
+
+    def __init__(self, text, on_counted, on_done, sort_over=None,
+                 confirm_over=None, group=None, verbose=None, **kwargs):
+        super(SearchTask, self).__init__(
+            group=group, target=None, name=None, verbose=verbose)
+        self.text = text
+        self.sort_over = sort_over
+        self.confirm_over = confirm_over
+        self.on_counted = on_counted
+        self.on_done = on_done
+        self.defer = gobject.idle_add
+        self.cancelled = False
+        self.ranked = False
+        # set when the results may be fetched, or the task is cancelled
+        self._answer = threading.Event()
+        # the connections of the task and of the strategies it runs
+        self.interrupter = search.Interrupter()
+
+    def cancel(self):
+        self.cancelled = True
+        self.interrupter.cancel()
+        self._answer.set()
+
+    def needs_confirmation(self, nresults):
+        return bool(self.confirm_over) and nresults > self.confirm_over
+
+    def confirm(self, accepted):
+        """fetch the counted results, or drop them"""
+        if not accepted:
+            self.cancelled = True
+        self._answer.set()
+
+    def run(self):
+        session = db.Session()
+        identities = []
+        error_msg = error_details_msg = None
+        try:
+            self.interrupter.add_session(session)
+            results = search.search(self.text, session, lazy=True,
+                                    interrupter=self.interrupter)
+            nresults = results.count()
+            if not self.cancelled:
+                self.defer(self.on_counted, self, nresults)
+            if self.needs_confirmation(nresults):
+                # nothing more is fetched until the user decides
+                self._answer.wait()
+            if not self.cancelled:
+                identities = results.identities()
+                self.ranked = results.ranked
+                if (not self.ranked and self.sort_over is not None and
+                        len(identities) > self.sort_over):
+                    identities = search.natsort_identities(
+                        session, identities, lambda: self.cancelled)
+        except search.SearchCancelled:
+            pass
+        except ParseException, err:
+            error_msg = _('Error in search string at column %s') % err.column
+        except (BaubleError, AttributeError, Exception, SyntaxError), e:
+            logger.debug(traceback.format_exc())
+            error_msg = _('** Error: %s') % utils.xml_safe(e)
+            error_details_msg = utils.xml_safe(traceback.format_exc())
+        finally:
+            self.interrupter.remove_session(session)
+            ## we should not leave the session around
+            session.close()
+            profiler.detach()
+        if not self.cancelled:
+            self.defer(self.on_done, self, identities,
+                       error_msg, error_details_msg)
+
+
+class _ResultNode(object):
+    """a row of the SearchResultsModel, as seen by gtk
+
+    top-level rows only hold their position, their object is looked up
+    in the model; child rows hold their object.  children is None until
+    the row is expanded.
+    """
+
+    __slots__ = ('parent', 'index', 'value', 'children')
+
+    def __init__(self, parent, index, value=None):
+        self.parent = parent
+        self.index = index
+        self.value = value
+        self.children = None
+
+
+class SearchResultsModel(gtk.GenericTreeModel):
+    """a lazy tree model of search results, with a single object column
+
+    the top-level rows are kept as (class, id) pairs, in two compact
+    arrays, their objects are only loaded in the session when gtk asks
+    for their value, that is when the rows become visible: one page of
+    `page_size` rows at a time, remembering the last `cache_size`
+    objects loaded.  objects dropped from the cache are only weakly
+    referenced by the session and can be collected.
+
+    the children of a row are set when the row is expanded, with
+    set_children().  rows of the types having children in
+    SearchView.row_meta show an expander, unless their identity is in
+    the `childless` set.
+    """
+
+    cache_size = 1000
+    page_size = 100
+
+    def __init__(self, session, identities=()):
+        super(SearchResultsModel, self).__init__()
+        # the rows are referenced by the model itself
+        self.props.leak_references = False
+        self.session = session
+        self._classes = []
+        self._class_index = {}
+        self._class_ids = array('H')
+        self._ids = array('l')
+        self._nodes = []
+        self._cache = OrderedDict()
+        self.childless = set()
+        for cls, id in identities:
+            self._append(cls, id)
+
+    def _append(self, cls, id):
+        if cls not in self._class_index:
+            self._class_index[cls] = len(self._classes)
+            self._classes.append(cls)
+        self._class_ids.append(self._class_index[cls])
+        self._ids.append(id)
+        self._nodes.append(None)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def identity(self, index):
+        """the (class, id) pair of the top-level row at index"""
+        return self._classes[self._class_ids[index]], self._ids[index]
+
+    def _node(self, index):
+        node = self._nodes[index]
+        if node is None:
+            node = self._nodes[index] = _ResultNode(None, index)
+        return node
+
+    ## the objects
+
+    def _remember(self, key, value):
+        self._cache.pop(key, None)
+        self._cache[key] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def prime(self, objects):
+        """remember objects already loaded, so they are not loaded again"""
+        for obj in objects[-self.cache_size:]:
+            self._remember((type(obj), obj.id), obj)
+
+    def _load(self, index):
+        # load the objects of the page of top-level rows starting at index
+        stop = min(index + self.page_size, len(self._ids))
+        wanted = [self.identity(i) for i in range(index, stop)]
+        wanted = [i for i in wanted if i not in self._cache]
+        with profiler.attached():
+            found = dict(((type(obj), obj.id), obj) for obj in
+                         search.load_identities(self.session, wanted))
+        for key in wanted:
+            # None stands for a deleted object
+            self._remember(key, found.get(key))
+
+    def get_object(self, index):
+        """the object of the top-level row at index, None if deleted"""
+        key = self.identity(index)
+        if key not in self._cache:
+            self._load(index)
+        value = self._cache[key]
+        self._remember(key, value)
+        return value
+
+    def loaded(self):
+        """the objects in the model loaded so far"""
+        result = [i for i in self._cache.values() if i is not None]
+        stack = [n for n in self._nodes if n is not None and n.children]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                result.append(child.value)
+                if child.children:
+                    stack.append(child)
+        return result
+
+    ## changing the rows
+
+    def clear(self):
+        for index in reversed(range(len(self._ids))):
+            self._class_ids.pop()
+            self._ids.pop()
+            self._nodes.pop()
+            self.row_deleted((index, ))
+        self._cache.clear()
+        self.invalidate_iters()
+
+    def append(self, obj):
+        """add obj as a top-level row, return its gtk.TreeIter"""
+        self._append(type(obj), obj.id)
+        self._remember((type(obj), obj.id), obj)
+        index = len(self._ids) - 1
+        treeiter = self.get_iter((index, ))
+        self.row_inserted((index, ), treeiter)
+        if self.on_iter_has_child(self._node(index)):
+            self.row_has_child_toggled((index, ), treeiter)
+        return treeiter
+
+    def remove(self, treeiter):
+        """remove the row at treeiter, with its children"""
+        node = self.get_user_data(treeiter)
+        path = self.get_path(treeiter)
+        if node.parent is None:
+            self._class_ids.pop(node.index)
+            self._ids.pop(node.index)
+            siblings = self._nodes
+        else:
+            siblings = node.parent.children
+        del siblings[node.index]
+        for index in range(node.index, len(siblings)):
+            if siblings[index] is not None:
+                siblings[index].index = index
+        self.invalidate_iters()
+        self.row_deleted(path)
+        if node.parent is not None and not siblings:
+            parent_path = path[:-1]
+            self.row_has_child_toggled(parent_path,
+                                       self.get_iter(parent_path))
+
+    def set_children(self, treeiter, kids):
+        """replace the children of the row at treeiter with kids"""
+        node = self.get_user_data(treeiter)
+        path = self.get_path(treeiter)
+        old = node.children or []
+        for index in reversed(range(len(old))):
+            node.children.pop()
+            self.row_deleted(path + (index, ))
+        node.children = [_ResultNode(node, index, kid)
+                         for index, kid in enumerate(kids)]
+        if not kids:
+            value = self.on_get_value(node, 0)
+            if value is not None:
+                self.childless.add((type(value), value.id))
+        for index in range(len(kids)):
+            child_path = path + (index, )
+            child_iter = self.get_iter(child_path)
+            self.row_inserted(child_path, child_iter)
+            if self.on_iter_has_child(node.children[index]):
+                self.row_has_child_toggled(child_path, child_iter)
+        self.row_has_child_toggled(path, self.get_iter(path))
+
+    def find(self, obj):
+        """the gtk.TreeIter of the rows showing obj, without loading any"""
+        key = (type(obj), obj.id)
+        result = []
+        class_id = self._class_index.get(key[0])
+        for index, id in enumerate(self._ids):
+            if id == key[1] and self._class_ids[index] == class_id:
+                result.append(self.get_iter((index, )))
+        stack = [n for n in self._nodes if n is not None and n.children]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                if child.value is obj or child.value == obj:
+                    result.append(self.create_tree_iter(child))
+                if child.children:
+                    stack.append(child)
+        return result
+
+    def remove_object(self, obj):
+        """remove all the rows showing obj"""
+        paths = [self.get_path(i) for i in self.find(obj)]
+        # the last rows first, so the paths of the others don't change
+        for path in sorted(paths, reverse=True):
+            self.remove(self.get_iter(path))
+
+    ## the gtk.GenericTreeModel interface
+
+    def on_get_flags(self):
+        return 0
+
+    def on_get_n_columns(self):
+        return 1
+
+    def on_get_column_type(self, index):
+        return object
+
+    def on_get_iter(self, path):
+        if path[0] >= len(self._ids):
+            return None
+        node = self._node(path[0])
+        for index in path[1:]:
+            if not node.children or index >= len(node.children):
+                return None
+            node = node.children[index]
+        return node
+
+    def on_get_path(self, node):
+        path = []
+        while node is not None:
+            path.insert(0, node.index)
+            node = node.parent
+        return tuple(path)
+
+    def on_get_value(self, node, column):
+        if node.parent is None:
+            return self.get_object(node.index)
+        return node.value
+
+    def on_iter_next(self, node):
+        index = node.index + 1
+        if node.parent is None:
+            if index < len(self._ids):
+                return self._node(index)
+        elif index < len(node.parent.children):
+            return node.parent.children[index]
+        return None
+
+    def on_iter_children(self, node):
+        return self.on_iter_nth_child(node, 0)
+
+    def on_iter_has_child(self, node):
+        if node.children is not None:
+            return len(node.children) > 0
+        if node.parent is None:
+            key = self.identity(node.index)
+        else:
+            key = (type(node.value), getattr(node.value, 'id', None))
+        return (SearchView.row_meta[key[0]].children is not None and
+                key not in self.childless)
+
+    def on_iter_n_children(self, node):
+        if node is None:
+            return len(self._ids)
+        return len(node.children or [])
+
+    def on_iter_nth_child(self, node, n):
+        if node is None:
+            if n < len(self._ids):
+                return self._node(n)
+        elif node.children and n < len(node.children):
+            return node.children[n]
+        return None
+
+    def on_iter_parent(self, node):
+        return node.parent
+
+
+def markup_pair(obj):
+    """the two lines describing obj in the search results"""
+    r = obj.search_view_markup_pair()
+    try:
+        main, substr = r
+    except:
+        main = r
+        substr = '(%s)' % type(obj).__name__
+    return utils.utf8(main), utils.utf8(substr)
+
+
+class MarkupCache(object):
+    """the markup of the objects in the search results, by (class, id)
+
+    an object is rendered again after it is inserted, updated or
+    deleted, and so are the objects it refers to, whose markup may
+    count it, like the accession of a plant, and the objects referring
+    to it, whose markup may show it, like the species of a genus.  the
+    latter are found by their parents, the (class, id) keys of the
+    objects a pair was rendered from, remembered with the pair, so that
+    unloaded collections don't matter.  the last `size` pairs are kept.
+    """
+
+    size = 5000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pairs = OrderedDict()  # key: (pair, parents)
+        self._dependents = {}  # parent key: set of keys
+        self._engine = None
+        # changed at every invalidation, so that a pair computed while
+        # an object changes isn't stored
+        self._generation = 0
+
+    def clear(self):
+        with self._lock:
+            self._pairs.clear()
+            self._dependents.clear()
+            self._generation += 1
+
+    def _forget(self, key):
+        # called holding the lock
+        pair, parents = self._pairs.pop(key, (None, ()))
+        for parent in parents:
+            dependents = self._dependents.get(parent)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[parent]
+
+    def get(self, obj):
+        """the (main, substr) markup pair of obj, rendered if needed"""
+        key = (type(obj), obj.id)
+        with self._lock:
+            if self._engine is not db.engine:
+                # another database, other objects under the same ids
+                self._engine = db.engine
+                self._pairs.clear()
+                self._dependents.clear()
+            entry = self._pairs.pop(key, None)
+            if entry is not None:
+                self._pairs[key] = entry
+                return entry[0]
+            generation = self._generation
+        pair = markup_pair(obj)
+        parents = self._parents(obj)
+        with self._lock:
+            if key[1] is not None and generation == self._generation:
+                self._forget(key)
+                self._pairs[key] = (pair, parents)
+                for parent in parents:
+                    self._dependents.setdefault(parent, set()).add(key)
+                while len(self._pairs) > self.size:
+                    self._forget(next(iter(self._pairs)))
+        return pair
+
+    def invalidate(self, keys):
+        """forget the pairs of the (class, id) keys, and their dependents"""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                for dependent in list(self._dependents.get(key, ())):
+                    self._forget(dependent)
+                self._forget(key)
+
+    @staticmethod
+    def _foreign_key(mapper, prop):
+        # the attribute holding the id prop refers to, or None
+        if len(prop.local_columns) != 1:
+            return None
+        column = list(prop.local_columns)[0]
+        try:
+            return mapper.get_property_by_column(column).key
+        except orm_exc.UnmappedColumnError:
+            return None
+
+    @classmethod
+    def _parents(cls, obj):
+        # the (class, id) keys of the objects obj refers to, those its
+        # markup may show: the loaded ones and those they refer to, up
+        # to the first one not loaded, known by its id.
+        result = set()
+        stack = [obj]
+        while stack:
+            state = sa.inspect(stack.pop())
+            for prop in state.mapper.relationships:
+                if prop.direction is not MANYTOONE:
+                    continue
+                value = state.dict.get(prop.key)
+                if value is not None:
+                    key = (type(value), value.id)
+                    if key not in result:
+                        result.add(key)
+                        stack.append(value)
+                    continue
+                attr = cls._foreign_key(state.mapper, prop)
+                if attr is not None and state.dict.get(attr) is not None:
+                    result.add((prop.mapper.class_, state.dict[attr]))
+        return result
+
+    @classmethod
+    def _affected(cls, mapper, instance):
+        # the (class, id) keys whose markup may count instance: its own
+        # and its parents, old and new, even if not loaded
+        state = sa.inspect(instance)
+        yield type(instance), instance.id
+        for prop in mapper.relationships:
+            if prop.direction is not MANYTOONE:
+                continue
+            attr = cls._foreign_key(mapper, prop)
+            if attr is None:
+                continue
+            for id in state.attrs[attr].history.sum():
+                if id is not None:
+                    yield prop.mapper.class_, id
+
+    def on_change(self, mapper, connection, instance):
+        if not isinstance(instance, db.Base):
+            return
+        self.invalidate(list(self._affected(mapper, instance)))
+
+
+markup_cache = MarkupCache()
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    sa.event.listen(orm.Mapper, _event, markup_cache.on_change)
+
+
+def reachable_objects(roots):
+    """the objects roots reach through the relations loaded so far"""
+    seen = {}
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        try:
+            state = sa.inspect(obj)
+        except saexc.NoInspectionAvailable:
+            continue
+        seen[id(obj)] = obj
+        for prop in state.mapper.relationships:
+            # only what is loaded, without loading anything
+            value = state.dict.get(prop.key)
+            if value is None:
+                continue
+            if prop.uselist:
+                stack.extend(value)
+            else:
+                stack.append(value)
+    return seen.values()
+
+
+def recycle_session(session, keep):
+    """close session, return a new one holding the objects in keep
+
+    the objects in keep stay usable, the others are detached and left to
+    the garbage collector.
+    """
+    result = db.Session()
+    session.expunge_all()
+    for obj in keep:
+        result.add(obj)
+    session.close()
+    return result
+
+
+class AttachmentsCache(object):
+    """the objects attached to the search results, by bottom_info class
+
+    the attachments of the selected row are fetched together with those
+    of the rows in sight, with one attached_to_many call per class, so
+    that moving the cursor costs no query.  they are all forgotten as
+    soon as anything is written.
+    """
+
+    size = 2000
+
+    def __init__(self):
+        self._attached = {}  # klass: {(class, id): [objects]}
+
+    def clear(self):
+        self._attached.clear()
+
+    def get(self, klass, obj, prefetch=()):
+        """
+        Return the objects of klass attached to obj, fetching also those
+        attached to the prefetch (class, id) pairs.
+        """
+        if (not hasattr(klass, 'attached_to_many') or
+                getattr(obj, 'id', None) is None):
+            return klass.attached_to(obj)
+        session = object_session(obj)
+        if session is None:
+            return []
+        key = (type(obj), obj.id)
+        attached = self._attached.setdefault(klass, {})
+        if key not in attached:
+            if len(attached) > self.size:
+                attached.clear()
+            wanted = [key] + [i for i in prefetch if i not in attached]
+            found = klass.attached_to_many(session, wanted)
+            for i in wanted:
+                attached[i] = found.get(i, [])
+        return attached[key]
+
+    def on_change(self, mapper, connection, instance):
+        self._attached.clear()
+
+
+attachments_cache = AttachmentsCache()
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    sa.event.listen(orm.Mapper, _event, attachments_cache.on_change)
+
+
 class SearchView(pluginmgr.View):
     """
     The SearchView is the main view for Ghini.  It manages the search
@@ -507,6 +1214,21 @@ class SearchView(pluginmgr.View):
                     return self.children(obj)
                 return getattr(obj, self.children)
 
+            @property
+            def relation(self):
+                '''
+                the name of the relation holding the children, if
+                self.children is one, directly or through db.natsort,
+                otherwise None.
+                '''
+                children = self.children
+                if isinstance(children, partial) and \
+                        children.func is db.natsort and children.args:
+                    children = children.args[0]
+                if isinstance(children, basestring) and '.' not in children:
+                    return children
+                return None
+
         def __getitem__(self, item):
             if item not in self:  # create on demand
                 self[item] = self.Meta()
@@ -615,7 +1337,8 @@ class SearchView(pluginmgr.View):
             if not hasattr(klass, 'attached_to'):
                 logging.warn('class %s does not implement attached_to' % klass)
                 continue
-            objs = klass.attached_to(row)
+            objs = attachments_cache.get(klass, row,
+                                         self.visible_identities())
             model = bottom_info['tree'].get_model()
             model.clear()
             if len(objs) == 0:
@@ -628,6 +1351,17 @@ class SearchView(pluginmgr.View):
                     model.append([getattr(obj, k)
                                   for k in bottom_info['fields_used']])
 
+    def visible_identities(self):
+        """
+        Return the (class, id) pairs of the top level rows in sight.
+        """
+        model = self.results_view.get_model()
+        visible = self.results_view.get_visible_range()
+        if not isinstance(model, SearchResultsModel) or not visible:
+            return []
+        start, end = visible
+        return [model.identity(i) for i in range(start[0], end[0] + 1)]
+
     def update_infobox(self):
         '''
         Sets the infobox according to the currently selected row.
@@ -766,17 +1500,36 @@ class SearchView(pluginmgr.View):
 
     nresults_statusbar_context = 'searchview.nresults'
 
+    # ask for confirmation before retrieving more results than this,
+    # zero or None never asks
+    confirm_threshold_pref = 'bauble.search.confirm_threshold'
+
+    # run the searches on a worker thread
+    run_in_thread_pref = 'bauble.search.run_in_thread'
+
+    # the number of objects in the session above which it is replaced
+    # by a new one, zero or None never replaces it
+    session_limit_pref = 'bauble.search.session_limit'
+
+    # the number of results above which the rows are only loaded when
+    # they become visible, the search task sorts them
+    lazy_threshold = 1000
+
     def search(self, text):
         """
         search the database using text
+
+        the search runs in a SearchTask, on a worker thread with its own
+        session, unless this is disabled by the run_in_thread_pref or the
+        database is an in-memory one, invisible to other connections.
+        the results are shown by on_search_done, on the GUI thread.
         """
         # set the text in the entry even though in most cases the entry already
         # has the same text in it, this is in case this method was called from
         # outside the class so the entry and search results match
         logger.debug('SearchView.search(%s)' % text)
-        error_msg = None
-        error_details_msg = None
-        # stop whatever it might still be doing
+        # stop whatever it might still be doing, including a previous
+        # search still running
         self.cancel_threads()
         if False:
             # create a new session for each search...
@@ -785,86 +1538,154 @@ class SearchView(pluginmgr.View):
         else:
             # reuse session, but undo all that has not been committed
             self.session.rollback()
-        bold = '<b>%s</b>'
-        results = []
-        try:
-            results = search.search(text, self.session)
-        except ParseException, err:
-            error_msg = _('Error in search string at column %s') % err.column
-        except (BaubleError, AttributeError, Exception, SyntaxError), e:
-            logger.debug(traceback.format_exc())
-            error_msg = _('** Error: %s') % utils.xml_safe(e)
-            error_details_msg = utils.xml_safe(traceback.format_exc())
+        task = SearchTask(
+            text, self.on_search_counted, self.on_search_done,
+            sort_over=self.lazy_threshold,
+            confirm_over=prefs.prefs.get(self.confirm_threshold_pref, 5000))
+        if (prefs.prefs.get(self.run_in_thread_pref, True) and
+                db.engine.url.database not in (None, '', ':memory:')):
+            self.start_thread(task)
+        else:
+            task.defer = lambda callback, *args: callback(*args)
+            task.run()
+
+    def on_search_counted(self, task, nresults):
+        """the preflight count of a search is available
+
+        large results are only fetched if the user confirms.
+        """
+        if task.cancelled:
+            return
+        statusbar = bauble.gui.widgets.statusbar
+        sbcontext_id = statusbar.get_context_id('searchview.nresults')
+        statusbar.pop(sbcontext_id)
+        if task.needs_confirmation(nresults):
+            msg = _('This query returned %s results.  It may take a '
+                    'long time to get all the data. Are you sure you '
+                    'want to continue?') % nresults
+            accepted = utils.yes_no_dialog(msg)
+            task.confirm(accepted)
+            if not accepted:
+                return
+        statusbar.push(sbcontext_id, _("Retrieving %s search "
+                                       "results…") % nresults)
 
+    def on_search_done(self, task, identities, error_msg, error_details_msg):
+        """show the results of a SearchTask
+
+        identities are (class, id) pairs, the objects are loaded in the
+        session of the view, one page at a time.
+        """
+        if task.cancelled:
+            return
         if error_msg:
             bauble.gui.show_error_box(error_msg, error_details_msg)
             return
 
         # not error
-        utils.clear_model(self.results_view)
+        text = task.text
+        bold = '<b>%s</b>'
+        nresults = len(identities)
+        self.clear_results()
         self.update_infobox()
+        self.check_session()
         statusbar = bauble.gui.widgets.statusbar
         sbcontext_id = statusbar.get_context_id('searchview.nresults')
         statusbar.pop(sbcontext_id)
-        if len(results) == 0:
+        if nresults == 0:
             model = gtk.ListStore(str)
             msg = bold % cgi.escape(
                 _('Couldn\'t find anything for search: "%s"') % text)
             model.append([msg])
             self.results_view.set_model(model)
         else:
-            if len(results) > 5000:
-                msg = _('This query returned %s results.  It may take a '
-                        'long time to get all the data. Are you sure you '
-                        'want to continue?') % len(results)
-                if not utils.yes_no_dialog(msg):
-                    return
+            # only identities have been fetched so far, no rows.
             statusbar.push(sbcontext_id, _("Retrieving %s search "
-                                           "results…") % len(results))
+                                           "results…") % nresults)
             try:
-                # don't bother with a task if the results are small,
-                # this keeps the screen from flickering when the main
-                # window is set to a busy state
+                # small results are loaded and naturally sorted right
+                # away.  large results come grouped by type from the
+                # task, sorted by the database where possible: their
+                # objects are only loaded when their rows become
+                # visible.  ranked results, like the fuzzy
+                # matches, keep their order.
                 import time
                 start = time.time()
-                if len(results) > 1000:
-                    self.populate_results(results)
+                if nresults > self.lazy_threshold:
+                    self.results_view.set_model(
+                        SearchResultsModel(self.session, identities))
                 else:
-                    task = self._populate_worker(results)
-                    while True:
-                        try:
-                            task.next()
-                        except StopIteration:
-                            break
+                    results = search.SearchResults(
+                        [search.IdentityList(self.session, identities)])
+                    with profiler.attached():
+                        worker = self._populate_worker(
+                            list(results), ranked=task.ranked)
+                        while True:
+                            try:
+                                worker.next()
+                            except StopIteration:
+                                break
                 logger.debug(time.time() - start)
+                profiler.add_time('populate', time.time() - start)
             except StopIteration:
                 return
             else:
                 statusbar.pop(sbcontext_id)
                 statusbar.push(sbcontext_id, _('counting results'))
-                if len(set(item.__class__ for item in results)) == 1:
+                classes = set(cls for cls, id in identities)
+                if len(classes) == 1:
                     dots_thread = self.start_thread(AddOneDot())
                     self.start_thread(CountResultsTask(
-                        results[0].__class__, [i.id for i in results],
+                        classes.pop(), [id for cls, id in identities],
                         dots_thread))
                 else:
                     statusbar.push(sbcontext_id,
                                    _('size of non homogeneous result: %s') %
-                                   len(results))
+                                   len(identities))
                 self.results_view.set_cursor(0)
                 gobject.idle_add(lambda: self.results_view.scroll_to_cell(0))
 
         self.update_bottom_notebook()
 
-    def remove_children(self, model, parent):
+    def check_session(self):
         """
-        Remove all children of some parent in the model, reverse
-        iterate through them so you don't invalidate the iter
+        Replace the session by a new one when its identity map grows
+        beyond the session_limit_pref.
+
+        The objects the rows shown can reach are moved to the new
+        session, the others are left to the garbage collector.
         """
-        while model.iter_has_child(parent):
-            nkids = model.iter_n_children(parent)
-            child = model.iter_nth_child(parent, nkids-1)
-            model.remove(child)
+        size = len(self.session.identity_map)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('search session: %s objects, memory %s kB'
+                         % (size, utils.mem()))
+        limit = prefs.prefs.get(self.session_limit_pref, 20000)
+        if not limit or size <= limit:
+            return False
+        if self.session.new or self.session.dirty or self.session.deleted:
+            # never lose what was not committed
+            return False
+        model = self.results_view.get_model()
+        keep = []
+        if isinstance(model, SearchResultsModel):
+            keep = reachable_objects(model.loaded())
+        self.session = recycle_session(self.session, keep)
+        if isinstance(model, SearchResultsModel):
+            model.session = self.session
+        attachments_cache.clear()
+        logger.info('search session recycled: %s objects, %s kept, '
+                    'memory %s kB' % (size, len(keep), utils.mem()))
+        return True
+
+    def clear_results(self):
+        """
+        Remove the results model from the view, without loading the
+        objects of its rows.
+        """
+        model = self.results_view.get_model()
+        self.results_view.set_model(None)
+        if isinstance(model, SearchResultsModel):
+            model.clear()
 
     def on_test_expand_row(self, view, treeiter, path, data=None):
         '''
@@ -874,26 +1695,77 @@ class SearchView(pluginmgr.View):
         model = view.get_model()
         row = model.get_value(treeiter, 0)
         view.collapse_row(path)
-        self.remove_children(model, treeiter)
         try:
-            kids = self.row_meta[type(row)].get_children(row)
+            kids = self.get_children(row)
+            model.childless.update(self.childless_kids(kids))
+            model.set_children(treeiter, kids)
             if len(kids) == 0:
                 return True
         except saexc.InvalidRequestError, e:
             logger.debug(utils.utf8(e))
-            model = self.results_view.get_model()
-            for found in utils.search_tree_model(model, row):
-                model.remove(found)
+            model.remove_object(row)
             return True
         except Exception, e:
             logger.debug(utils.utf8(e))
             logger.debug(traceback.format_exc())
             return True
         else:
-            self.append_children(
-                model, treeiter, sorted(kids, key=utils.natsort_key))
             return False
 
+    def _relation(self, cls):
+        # the relation holding the children of the objects of cls, or None
+        name = self.row_meta[cls].relation
+        if name is None:
+            return None
+        return class_mapper(cls).relationships.get(name)
+
+    def get_children(self, row):
+        """
+        Return the children of row, naturally sorted.
+
+        The children in a relation are loaded with one query, together
+        with the objects their markup needs, and sorted by the database
+        when their class has a natsort_order.
+        """
+        prop = self._relation(type(row))
+        if prop is None:
+            kids = self.row_meta[type(row)].get_children(row)
+        else:
+            cls = prop.mapper.class_
+            query = self.session.query(cls).options(
+                *search.eager_options(cls)).with_parent(row, prop.key)
+            if hasattr(cls, 'natsort_order'):
+                return cls.natsort_order(query).all()
+            kids = query.all()
+        return sorted(kids, key=utils.natsort_key)
+
+    def childless_kids(self, kids):
+        """
+        Return the (class, id) pairs of the kids having no children,
+        so that they show no expander.
+
+        The kids whose children are in a relation are looked up with
+        one query per class, instead of loading the children of each.
+        """
+        by_class = {}
+        for kid in kids:
+            if getattr(kid, 'id', None) is not None:
+                by_class.setdefault(type(kid), []).append(kid.id)
+        result = []
+        for cls, ids in by_class.iteritems():
+            prop = self._relation(cls)
+            if prop is None:
+                continue
+            relation = getattr(cls, prop.key)
+            with_kids = set()
+            # in chunks, for the bind parameters limit of SQLite
+            for i in range(0, len(ids), 500):
+                query = self.session.query(cls.id).filter(
+                    cls.id.in_(ids[i:i + 500])).filter(relation.any())
+                with_kids.update(id for (id, ) in query)
+            result.extend((cls, id) for id in ids if id not in with_kids)
+        return result
+
     def populate_results(self, results, check_for_kids=False):
         """
         Adds results to the search view in a task.
@@ -903,80 +1775,61 @@ class SearchView(pluginmgr.View):
         """
         bauble.task.queue(self._populate_worker(results, check_for_kids))
 
-    def _populate_worker(self, results, check_for_kids=False):
+    def _populate_worker(self, results, check_for_kids=False, ranked=False):
         """
         Generator function for adding the search results to the
         model. This method is usually called by self.populate_results()
+
+        ranked results are added in their order, the others are grouped
+        by type and naturally sorted.
         """
         nresults = len(results)
-        model = gtk.TreeStore(object)
-        model.set_default_sort_func(lambda *args: -1)
-        model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
-        utils.clear_model(self.results_view)
+        self.clear_results()
 
         groups = []
 
-        # sort by type so that groupby works properly
-        results = sorted(results, key=lambda x: type(x))
-
-        for key, group in itertools.groupby(results, key=lambda x: type(x)):
-            # return groups by type and natural sort each of the
-            # groups by their strings
-            groups.append(sorted(group, key=utils.natsort_key, reverse=True))
+        if ranked:
+            groups.append(results)
+        else:
+            # sort by type so that groupby works properly, by name so we
+            # always get the results by type in the same order
+            results = sorted(results, key=lambda x: type(x).__name__)
 
-        # sort the groups by type so we more or less always get the
-        # results by type in the same order
-        groups = sorted(groups, key=lambda x: type(x[0]), reverse=True)
+            for key, group in itertools.groupby(results,
+                                                key=lambda x: type(x)):
+                # natural sort each of the groups by their strings
+                groups.append(sorted(group, key=utils.natsort_key))
 
         update_every = 200
         steps_so_far = 0
 
-        # iterate over slice of size "steps", yield after adding each
-        # slice to the model
-        #for obj in itertools.islice(itertools.chain(*groups), 0,None, steps):
-        #for obj in itertools.islice(itertools.chain(results), 0,None, steps):
-
         added = set()
+        objects = []
+        childless = []
         for obj in itertools.chain(*groups):
             if obj in added:  # only add unique object
                 continue
             else:
                 added.add(obj)
-            parent = model.prepend(None, [obj])
-            obj_type = type(obj)
+            objects.append(obj)
             if check_for_kids:
-                kids = self.row_meta[obj_type].get_children(obj)
-                if len(kids) > 0:
-                    model.prepend(parent, ['-'])
-            elif self.row_meta[obj_type].children is not None:
-                model.prepend(parent, ['-'])
-            #steps_so_far += chunk_size
+                if not self.row_meta[type(obj)].get_children(obj):
+                    childless.append((type(obj), obj.id))
             steps_so_far += 1
             if steps_so_far % update_every == 0:
                 percent = float(steps_so_far)/float(nresults)
                 if 0 < percent < 1.0:
                     bauble.gui.progressbar.set_fraction(percent)
                 yield
+        model = SearchResultsModel(self.session,
+                                   [(type(i), i.id) for i in objects])
+        model.childless.update(childless)
+        # the first rows are the visible ones
+        model.prime(objects[:model.cache_size])
         self.results_view.freeze_child_notify()
         self.results_view.set_model(model)
         self.results_view.thaw_child_notify()
 
-    def append_children(self, model, parent, kids):
-        """
-        append object to a parent iter in the model
-
-        :param model: the model the append to
-        :param parent:  the parent gtk.TreeIter
-        :param kids: a list of kids to append
-        @return: the model with the kids appended
-        """
-        check(parent is not None, "append_children(): need a parent")
-        for k in kids:
-            i = model.append(parent, [k])
-            if self.row_meta[type(k)].children is not None:
-                model.append(i, ["_dummy"])
-        return model
-
     def cell_data_func(self, col, cell, model, treeiter):
         # start with a (redundant) check, whether the cell is visible.
         path = model.get_path(treeiter)
@@ -988,7 +1841,10 @@ class SearchView(pluginmgr.View):
         value = model[treeiter][0]
         #logger.debug('TBR: far too detailed, please do not keep us here')
         #logger.debug('TBR: %s' % value)
-        if isinstance(value, basestring):
+        if value is None:
+            # the object was deleted since the search
+            cell.set_property('markup', '')
+        elif isinstance(value, basestring):
             cell.set_property('markup', value)
         else:
             # if the value isn't part of a session then add it to the
@@ -1003,18 +1859,12 @@ class SearchView(pluginmgr.View):
                     self.session.expire(value)
                 else:
                     self.session.merge(value)
+            profiler.shown(value)
             try:
-                r = value.search_view_markup_pair()
-                #logger.debug('TBR: %s' % str(r))
-                try:
-                    main, substr = r
-                except:
-                    main = r
-                    substr = '(%s)' % type(value).__name__
+                main, substr = markup_cache.get(value)
                 cell.set_property(
                     'markup', '%s\n%s' %
-                    (_mainstr_tmpl % utils.utf8(main),
-                     _substr_tmpl % utils.utf8(substr)))
+                    (_mainstr_tmpl % main, _substr_tmpl % substr))
 
             except (saexc.InvalidRequestError, TypeError), e:
                 logger.warning(
@@ -1024,8 +1874,7 @@ class SearchView(pluginmgr.View):
                 def remove():
                     model = self.results_view.get_model()
                     self.results_view.set_model(None)  # detach model
-                    for found in utils.search_tree_model(model, value):
-                        model.remove(found)
+                    model.remove_object(value)
                     self.results_view.set_model(model)
                 gobject.idle_add(remove)
 
@@ -1144,17 +1993,21 @@ class SearchView(pluginmgr.View):
         except:
             pass
 
+        self.check_session()
         self.session.expire_all()
+        markup_cache.clear()
+        attachments_cache.clear()
+        utils.clear_natsort_keys()
 
         # the invalidate_str_cache() method are specific to Species
         # and Accession right now....it's a bit of a hack since there's
         # no real interface that the method complies to...but it does
-        # fix our string caching issues
-        def invalidate_cache(model, path, treeiter, data=None):
-            obj = model[path][0]
-            if hasattr(obj, 'invalidate_str_cache'):
-                obj.invalidate_str_cache()
-        model.foreach(invalidate_cache)
+        # fix our string caching issues.  only the objects loaded so
+        # far can have a cached string.
+        if isinstance(model, SearchResultsModel):
+            for obj in model.loaded():
+                if hasattr(obj, 'invalidate_str_cache'):
+                    obj.invalidate_str_cache()
         expanded_rows = self.get_expanded_rows()
         self.results_view.collapse_all()
         # expand_to_all_refs will invalidate the ref so get the path first
@@ -1272,41 +2125,101 @@ class Note:
         except:
             return []
 
+    @classmethod
+    def attached_to_many(cls, session, identities):
+        '''return the notes of many objects, with one query per class
+
+        identities is a list of (class, id) pairs, the result is a dict
+        with the list of notes of each pair having any.
+        '''
+        ids_by_class = {}
+        for klass, obj_id in identities:
+            ids_by_class.setdefault(klass, []).append(obj_id)
+        result = {}
+        for klass, ids in ids_by_class.iteritems():
+            prop = class_mapper(klass).relationships.get('notes')
+            if prop is None or len(prop.local_remote_pairs) != 1:
+                continue
+            [(local, remote)] = prop.local_remote_pairs
+            key = prop.mapper.get_property_by_column(remote).key
+            # in chunks, for the bind parameters limit of SQLite
+            for i in range(0, len(ids), 500):
+                query = session.query(prop.mapper.class_).filter(
+                    remote.in_(ids[i:i + 500]))
+                for note in query:
+                    result.setdefault((klass, getattr(note, key)),
+                                      []).append(note)
+        return result
+
+
+def history_query(session, table_name=None, user=None, operation=None,
+                  since=None, until=None):
+    """the history rows matching the filters, most recent first
+
+    since and until are dates, both included.  the rows are ordered on
+    (timestamp, id), descending, which the history indexes serve.
+    """
+    History = db.History
+    query = session.query(History)
+    if table_name:
+        query = query.filter(History.table_name == table_name)
+    if user:
+        query = query.filter(History.user == user)
+    if operation:
+        query = query.filter(History.operation == operation)
+    if since:
+        query = query.filter(History.timestamp >= since)
+    if until:
+        query = query.filter(
+            History.timestamp < until + datetime.timedelta(days=1))
+    return query.order_by(History.timestamp.desc(), History.id.desc())
+
+
+def history_page(query, after=None, limit=200):
+    """the rows of a history_query following the (timestamp, id) after
+
+    keyset pagination: every page costs as much as the first one, while
+    OFFSET makes the database skip all previous rows.
+    """
+    History = db.History
+    if after is not None:
+        timestamp, id = after
+        query = query.filter(sa.or_(
+            History.timestamp < timestamp,
+            sa.and_(History.timestamp == timestamp, History.id < id)))
+    return query.limit(limit).all()
+
 
-class AppendThousandRows(threading.Thread):
+class AppendHistoryPage(threading.Thread):
+    """load the next page of the HistoryView, on a worker thread"""
 
     def callback(self, rows):
+        if self.__stopped.isSet():
+            return
         for row in rows:
             self.view.add_row(row)
+        self.view.on_page_loaded(rows)
 
-    def cancel_callback(self):
-        row = ['---'] * 6
-        row[4] = '** ' + _('interrupted') + ' **'
-        self.view.liststore.append(row)
-
-    def __init__(self, view, group=None, verbose=None, **kwargs):
-        super(AppendThousandRows, self).__init__(
+    def __init__(self, view, after, group=None, verbose=None, **kwargs):
+        super(AppendHistoryPage, self).__init__(
             group=group, target=None, name=None, verbose=verbose)
         self.__stopped = threading.Event()
         self.view = view
+        self.after = after
 
     def cancel(self):
         self.__stopped.set()
 
     def run(self):
         session = db.Session()
-        q = session.query(db.History).order_by(db.History.timestamp.desc())
-        # add rows in small batches
-        offset = 0
-        step = 200
-        count = q.count()
-        while offset < count and not self.__stopped.isSet():
-            rows = q.offset(offset).limit(step).all()
-            gobject.idle_add(self.callback, rows)
-            offset += step
-        session.close()
-        if offset < count:
-            gobject.idle_add(self.cancel_callback)
+        try:
+            query = history_query(session, **self.view.filters)
+            rows = history_page(query, self.after, self.view.page_size)
+            # detached, but already loaded
+            session.expunge_all()
+        finally:
+            session.close()
+        gobject.idle_add(self.callback, rows)
 
 
 class HistoryView(pluginmgr.View):
@@ -1327,6 +2240,14 @@ class HistoryView(pluginmgr.View):
             root_widget_name='history_window')
         self.view.connect_signals(self)
         self.liststore = self.view.widgets.history_ls
+        self.filters = {}
+        self.loader = None
+        self.last_key = None
+        self.exhausted = False
+        # the next page is loaded when scrolling near to the end
+        adjustment = self.view.widgets.history_sv.get_vadjustment()
+        adjustment.connect('value-changed', self.on_scrolled)
+        adjustment.connect('changed', self.on_scrolled)
         self.update()
 
     @staticmethod
@@ -1393,12 +2314,43 @@ class HistoryView(pluginmgr.View):
             bauble.gui.widgets.main_comboentry.child.set_text(query)
             bauble.gui.widgets.go_button.emit("clicked")
 
-    def update(self):
+    page_size = 200
+
+    def update(self, filters=None):
         """
-        Add the history items to the view.
+        Show the most recent history items matching filters, the
+        keyword arguments of history_query, one page at a time.
         """
+        if filters is not None:
+            self.filters = filters
+        self.cancel_threads()
         self.liststore.clear()
-        self.start_thread(AppendThousandRows(self))
+        self.last_key = None
+        self.exhausted = False
+        self.load_next_page()
+
+    def load_next_page(self):
+        if self.exhausted or \
+                (self.loader is not None and self.loader.is_alive()):
+            return
+        self.loader = self.start_thread(
+            AppendHistoryPage(self, self.last_key))
+
+    def on_page_loaded(self, rows):
+        self.running_threads = [t for t in self.running_threads
+                                if t.is_alive()]
+        self.loader = None
+        if rows:
+            self.last_key = rows[-1].timestamp, rows[-1].id
+        self.exhausted = len(rows) < self.page_size
+        # the view may not be scrollable yet
+        self.on_scrolled(self.view.widgets.history_sv.get_vadjustment())
+
+    def on_scrolled(self, adjustment):
+        remaining = adjustment.upper - adjustment.value - \
+            adjustment.page_size
+        if remaining <= adjustment.page_size:
+            self.load_next_page()
 
 
 class HistoryCommandHandler(pluginmgr.CommandHandler):
@@ -1414,8 +2366,59 @@ class HistoryCommandHandler(pluginmgr.CommandHandler):
             self.__class__.view = HistoryView()
         return self.view
 
+    # the :history arguments, and the history_query filters they set
+    filter_names = {'table': 'table_name', 'user': 'user',
+                    'operation': 'operation', 'since': 'since',
+                    'until': 'until'}
+
+    @classmethod
+    def parse_filters(cls, arg):
+        """
+        Return the history_query filters in arg, as in
+        `table=plant user=mario since=2017-01-31`.
+        """
+        filters = {}
+        for item in (arg or '').split():
+            key, sep, value = item.partition('=')
+            if key not in cls.filter_names or not value:
+                raise BaubleError(_('unknown history filter: %s') % item)
+            if key in ('since', 'until'):
+                try:
+                    value = datetime.datetime.strptime(value, '%Y-%m-%d')
+                except ValueError:
+                    raise BaubleError(_('not a date: %s') % value)
+            filters[cls.filter_names[key]] = value
+        return filters
+
     def __call__(self, cmd, arg):
-        self.view.update()
+        if (arg or '').strip() == 'index':
+            self.create_indexes()
+            arg = None
+        try:
+            filters = self.parse_filters(arg)
+        except BaubleError, e:
+            utils.message_dialog(utils.utf8(e), gtk.MESSAGE_ERROR)
+            return
+        self.view.update(filters)
+
+    @staticmethod
+    def create_indexes():
+        """`:history index` adds the indexes the history view pages on
+
+        to databases created before they existed.
+        """
+        try:
+            added = db.ensure_history_indexes()
+        except Exception, e:
+            utils.message_dialog(
+                utils.xml_safe(_('cannot index the history: %s') % e),
+                gtk.MESSAGE_ERROR)
+            return
+        if added:
+            msg = _('history indexes added: %s') % ', '.join(added)
+        else:
+            msg = _('the history indexes exist')
+        utils.message_dialog(msg)
 
 
 pluginmgr.register_command(HistoryCommandHandler)
@@ -1438,13 +2441,17 @@ def select_in_search_results(obj):
     logger.debug("select_in_search_results %s is in session %s" %
                  (obj, obj in view.session))
     model = view.results_view.get_model()
-    found = utils.search_tree_model(model, obj)
+    if not isinstance(model, SearchResultsModel):
+        # nothing was found, or nothing was searched yet
+        view.clear_results()
+        model = SearchResultsModel(view.session)
+        view.results_view.set_model(model)
+    found = model.find(obj)
     row_iter = None
     if len(found) > 0:
         row_iter = found[0]
     else:
-        row_iter = model.append(None, [obj])
-        model.append(row_iter, ['-'])
+        row_iter = model.append(obj)
     view.results_view.set_cursor(model.get_path(row_iter))
     return row_iter
 